@@ -1,14 +1,36 @@
 from rtree.index import Rtree, Property
+from rtree import core
+import ctypes
+import time
 import transaction
+from ZODB.POSException import ConflictError
 from persistent import Persistent
 from persistent.dict import PersistentDict
 import BTrees
+from BTrees.Length import Length
+from array import array
+from itertools import islice
 
 from datamanager import DataManager
-from storage import Storage
+from storage import Storage, InstrumentedStorage, PageIdAllocator
+from coordinates import CoordinateMap
+from rebuild import Rebuild, ChangeLog, buildPages
+from pagestore import createPageStore, PageStore, PageChanges, StoreWriters
+import instrumentation
+from cache import pageCache, resultCache, treePool, databaseToken
+from compression import getCompressor
+from curve import spatialSort
+from pages import TreeReader, toBounds, fromBounds, contains, packBounds, overlapVolume
+import parallel as parallelQueries
 import zope.interface
 from zope.index import interfaces as zopeindexinterfaces
 
+
+# settings which configure the index, all other settings are rtree properties
+indexSettings = ( 'interleaved', 'random_page_ids', 'page_cache', 'compression', 'compression_level',
+                  'page_objects', 'result_cache', 'prefetch', 'write_overlay', 'page_store',
+                  'page_store_path' )
+
     
 class SpatialIndex(Persistent):
     ''' A spatial index. You can insert objects with their coordinates and later
@@ -21,6 +43,12 @@ class SpatialIndex(Persistent):
         )
 
     default_family = BTrees.family32
+    pageIds = None          # indexes created before page id allocators existed don't have one
+    generation = None       # neither do indexes created before the page cache existed
+    numDocuments = None     # or before documents were counted
+    rebuilding = None       # the state of a running rebuild(), see rebuild.py
+    changeLog = None        # joined by every writer, see rebuild.ChangeLog
+    storeWriters = None     # joined by every writer of a PageStore, see pagestore.StoreWriters
     
     def __init__(self, settings = {}, initialValuesGenerator = None):
         ''' Init. settings provide many means to customize the spatial tree.
@@ -48,67 +76,368 @@ class SpatialIndex(Persistent):
                 tpr_horizon
                 reinsert_factor
                 
+            The following settings configure the index itself:
+            
+                interleaved         coordinates are (minx, miny, maxx, maxy)
+                                    instead of (minx, maxx, miny, maxy),
+                                    default True
+                random_page_ids     allocate random instead of sequential page
+                                    ids, default False
+                page_cache          keep the pages in the process wide page cache
+                                    cache.pageCache, default True
+                compression         compress the pages with "zlib", "lz4" or
+                                    "fast" (lz4 if installed, zlib otherwise),
+                                    default None
+                compression_level   the zlib compression level, default 6
+                page_objects        store each page as its own persistent object,
+                                    so concurrent writers changing different
+                                    pages don't conflict in pageData's buckets.
+                                    Costs an extra object load per page.
+                                    Default False
+                result_cache        cache the results of intersection(), count()
+                                    and apply( 'intersection', ... ) in the
+                                    process wide cache.resultCache until the
+                                    index is changed, default False
+                prefetch            when a node page is loaded from the
+                                    database, ask the database to load its
+                                    children in the background (needs a ZODB
+                                    with Connection.prefetch), default True
+                write_overlay       keep the pages changed in a transaction in
+                                    memory and store only their final version
+                                    on commit, and only if it differs from the
+                                    stored page, default True
+                page_store          where the pages are kept: "btree" in the
+                                    database, "memory" in this process, "file"
+                                    in an append-only local file or "sqlite"
+                                    in a local SQLite table. The stores other
+                                    than btree are written after the
+                                    transaction committed, see pagestore.py.
+                                    Default
+                                    "btree"
+                page_store_path     the path of the file or sqlite store
+                
             If you supply an initialValuesGenerator you can build a spatial index
             from initial values. This is much faster than doing repeated insert()s.
         '''
         Persistent.__init__( self )
         self.family = settings.pop( 'family', self.default_family )
         self.settings = PersistentDict( settings )
-        self.pageData = self.family.IO.BTree()             # here we save the actual rtree data in
-        self.idToCoordinates = self.family.IO.BTree()      # we need to know the coordinates for each objectid to be able to delete it
+        self.pageData = createPageStore( self.family,      # here we save the actual rtree data in
+                                         self.settings.get( 'page_store', 'btree' ),
+                                         self.settings.get( 'page_store_path' ) )
+        self.idToCoordinates = self._createCoordinateMap() # we need to know the coordinates for each objectid to be able to delete it
+        self.pageIds = PageIdAllocator( self.family, randomIds = self.settings.get( 'random_page_ids', False ) )
+        self.generation = Length()                         # changed by every transaction which changes the index
+        self.numDocuments = Length()
+        self.changeLog = ChangeLog()
+        if isinstance( self.pageData, PageStore ):
+            self.storeWriters = StoreWriters()
 
         # this creates the tree and creates header and root pages
         self._getTree( initialValuesGenerator )
 
     def index_doc(self, docid, coordinates):
-        ''' Inserts object with bounds into this index. Returns the added item. '''
-        self._registerDataManager()
-        self.tree.add( docid, coordinates )
+        ''' Inserts object with bounds into this index. If docid is already indexed
+            it is moved: Nothing happens if the coordinates did not change. If the
+            new bounds stay within the bounds of the leaf holding docid the leaf
+            page is updated in place, otherwise the old entry is deleted and the
+            new one inserted.
+        '''
+        oldCoordinates = self.idToCoordinates.get( docid )
+        if oldCoordinates is not None and tuple(oldCoordinates) == tuple(coordinates):
+            return
+        self._markChanged()
+        self._logChanges( [ (docid, oldCoordinates) ] )
+        if oldCoordinates is None:
+            self.tree.add( docid, coordinates )
+        elif self._moveInPlace( [ (docid, oldCoordinates, coordinates) ] ):
+            tree = self.tree
+            tree.delete( docid, oldCoordinates )
+            tree.add( docid, coordinates )
         self.idToCoordinates[docid] = coordinates
+        if oldCoordinates is None:
+            self._changeDocumentCount( 1 )
+        self._endChange()
         
     def unindex_doc(self, docid):
         ''' Deletes an item from this index '''
-        self._registerDataManager()
         try:
             coordinates = self.idToCoordinates.pop( docid )
         except KeyError:
             # docid was not indexed
             return
+        self._markChanged()
+        self._logChanges( [ (docid, coordinates) ] )
         self.tree.delete( docid, coordinates )
+        self._changeDocumentCount( -1 )
+        self._endChange()
+
+    def index_docs(self, docs, chunkSize = 10000):
+        ''' Inserts many (docid, coordinates) pairs at once. If the index is empty
+            the tree is bulk loaded. Otherwise the pairs are consumed in chunks,
+            each chunk is sorted along a hilbert curve so consecutive inserts hit
+            the same pages and the coordinates are written to the BTree in key
+            order. If a docid occurs more than once the last coordinates win.
+        '''
+        self._markChanged()
+        if not self.idToCoordinates:
+            coordinates = dict( docs )
+            if not coordinates:
+                return
+            self._logChanges( (docid, None) for docid in coordinates )
+            self._resetTree( ( (docid, coords, None) for docid, coords in coordinates.iteritems() ) )
+            self.idToCoordinates.update( sorted( coordinates.iteritems() ) )
+            self._changeDocumentCount( len(coordinates) )
+            self._endChange()
+            return
+        tree = self.tree
+        dimension = tree.properties.dimension
+        for chunk in _chunks( docs, chunkSize ):
+            chunk = dict( chunk )
+            added = 0
+            existing = dict( self._getCoordinates( chunk ) )
+            self._logChanges( (docid, existing.get( docid )) for docid in chunk )
+            moves = [ (docid, existing[docid], chunk[docid]) for docid in sorted( existing ) ]
+            reinserted = dict( (docid, old) for docid, old, new in self._moveInPlace( moves ) ) if moves else {}
+            for docid, coordinates in spatialSort( chunk.iteritems(), dimension, tree.interleaved ):
+                if docid not in existing:
+                    added += 1
+                elif docid in reinserted:
+                    tree.delete( docid, reinserted[docid] )
+                else:
+                    # not moved or moved in place
+                    continue
+                tree.add( docid, coordinates )
+            self.idToCoordinates.update( sorted( chunk.iteritems() ) )
+            self._changeDocumentCount( added )
+        self._endChange()
+
+    def unindex_docs(self, docids, chunkSize = 10000):
+        ''' Deletes many items at once. Works like index_docs(), the docids are
+            consumed in chunks and each chunk is deleted in hilbert order.
+        '''
+        self._markChanged()
+        tree = self.tree
+        dimension = tree.properties.dimension
+        for chunk in _chunks( docids, chunkSize ):
+            entries = self._getCoordinates( chunk, remove = True )
+            self._logChanges( entries )
+            for docid, coordinates in spatialSort( entries, dimension, tree.interleaved ):
+                tree.delete( docid, coordinates )
+            self._changeDocumentCount( -len(entries) )
+        self._endChange()
 
     def clear(self):
-        self._clearBuffer(True)
-        del self._v_tree
-        self.pageData.clear()
+        self._markChanged()
+        self._cancelRebuild()
         self.idToCoordinates.clear()        
-        self._getTree()     # this creates the tree and creates header and root pages
+        self._changeDocumentCount( -self.documentCount() )
+        self._resetTree()
+        self._endChange()
+
+    def recompress(self):
+        ''' Rewrites all pages which are not stored with the current compression
+            and page_objects settings. Pages are converted whenever they are
+            written anyway, this migrates the pages which are never written. '''
+        self._markChanged()
+        self._clearBuffer(False)
+        storage = self.tree.customstorage
+        storage.compressor = self._getCompressor()
+        storage.pageObjects = self._pageObjects()
+        storage.rewritePages()
+
+    def migrateCoordinates(self):
+        ''' Converts the idToCoordinates BTree of indexes created before
+            CoordinateMap existed. Returns False if there was nothing to do. '''
+        if isinstance( self.idToCoordinates, CoordinateMap ):
+            return False
+        coordinates = self._createCoordinateMap()
+        coordinates.update( self.idToCoordinates.iteritems() )
+        self.idToCoordinates = coordinates
+        return True
+
+    def rebuild(self, pagesPerTransaction = 1000, progress = None, attempts = 10):
+        ''' Rebuilds the tree from idToCoordinates without stopping queries or
+            writers, e.g. to get rid of the overlap and the under-filled pages
+            years of changes left behind. The index must not have uncommitted
+            changes. The rebuild runs in its own connection and transactions,
+            the current transaction is left alone and sees the rebuilt tree once
+            it's over:
+            
+            The new tree is bulk loaded in memory and its pages are copied to a
+            shadow pageData, pagesPerTransaction pages per transaction. progress(
+            copiedPages, pageCount ) is called after every one of them. Until the
+            last transaction replaces the old pages with the new ones, queries
+            use the old tree and the docids changed meanwhile are logged. The
+            last transaction applies their changes to the new tree. Writers which
+            started before the first or the last transaction of the rebuild and
+            commit after it get a ConflictError (see rebuild.ChangeLog). The
+            first and the last transaction are retried up to attempts times if
+            they conflict with a writer.
+            
+            An index which was never committed is rebuilt in the current
+            transaction.
+            
+            Returns False if the rebuild was cancelled by clear() or another
+            rebuild, True otherwise.
+        '''
+        if getattr( self, '_v_dataManagerRegistered', False ):
+            raise ValueError( 'The index has uncommitted changes' )
+        jar = self._p_jar
+        if jar is None:
+            pages, pageIds = buildPages( self )
+            self._replacePages( pages, pageIds.counter() )
+            return True
+        manager = transaction.TransactionManager()
+        connection = jar.db().open( transaction_manager = manager )
+        try:
+            index = connection.get( self._p_oid )
+            return index._rebuild( manager, pagesPerTransaction, progress, attempts )
+        finally:
+            manager.abort()
+            connection.close()
+
+    def _rebuild(self, manager, pagesPerTransaction, progress, attempts):
+        ''' Runs rebuild() in the transactions of manager '''
+        def start():
+            pages, pageIds = buildPages( self )
+            self._getChangeLog().newEpoch()
+            self.rebuilding = Rebuild( self.family, pageIds, len(pages) )
+            return pages
+        pages = _retry( manager, attempts, start )
+        state = self.rebuilding
+        pageIdList = sorted( pages )
+        for start in xrange( 0, len(pageIdList), pagesPerTransaction ):
+            if self.rebuilding is not state:
+                return False
+            chunk = pageIdList[start:start + pagesPerTransaction]
+            state.pageData.update( [ (pageId, pages[pageId]) for pageId in chunk ] )
+            state.copiedPages += len(chunk)
+            manager.commit()
+            if progress is not None:
+                progress( state.copiedPages, state.pageCount )
+        del pages, pageIdList
+        def finish():
+            if self.rebuilding is not state:
+                return False
+            self._finishRebuild( state )
+            return True
+        return _retry( manager, attempts, finish )
+
+    def rebuildProgress(self):
+        ''' Returns (copiedPages, pageCount) of a running rebuild() or None '''
+        state = self.rebuilding
+        if state is None:
+            return None
+        return state.copiedPages, state.pageCount
 
     def documentCount(self):
         """See interface IStatistics"""        
-        return len(self.idToCoordinates)    # Could use BTree.Len() instead for better performance
+        numDocuments = self.numDocuments
+        if numDocuments is None:
+            # index created before the counter existed and not changed since
+            return len(self.idToCoordinates)
+        return numDocuments()
 
     def wordCount(self):
         """See interface IStatistics"""
         return 0                            # no meaning really
+
+    def statistics(self):
+        ''' Returns a dict with statistics about the tree. Use these to find out
+            whether the tree has degraded and should be rebuilt:
+            
+                documents       number of indexed documents
+                pages           number of pages in pageData
+                storedBytes     bytes stored in pageData
+                height          height of the tree
+                nodes           number of nodes
+                nodesInLevel    number of nodes per level, leaves first
+                fillFactors     average fraction of the node capacity which
+                                is used per level, leaves first
+                overlap         the total volume in which the bounds of
+                                children of the same node overlap
+            
+            All pages are visited, so this is expensive for big trees. The
+            height and the nodes are counted while walking the tree, the
+            counters of the header page may lag behind.
+        '''
+        self._beginRead()
+        reader = self._treeReader()
+        header = reader.header
+        height = reader.root().level + 1
+        children = [ 0 ] * height
+        nodes = [ 0 ] * height
+        overlap = 0.0
+        stack = [ header.rootId ]
+        while stack:
+            node = reader.node( stack.pop() )
+            nodes[node.level] += 1
+            children[node.level] += len(node.ids)
+            if node.isLeaf:
+                continue
+            stack.extend( node.ids )
+            for i in range( len(node.ids) ):
+                for j in range( i + 1, len(node.ids) ):
+                    overlap += overlapVolume( node.lows[i], node.highs[i], node.lows[j], node.highs[j] )
+        fillFactors = []
+        for level, count in enumerate( nodes ):
+            capacity = header.leafCapacity if level == 0 else header.indexCapacity
+            fillFactors.append( float(children[level]) / (count * capacity) if count else 0.0 )
+        storage = self.tree.customstorage
+        return dict( documents = self.documentCount(),
+                     pages = storage.pageCount(),
+                     storedBytes = storage.storedBytes(),
+                     height = height,
+                     nodes = sum( nodes ),
+                     nodesInLevel = nodes,
+                     fillFactors = fillFactors,
+                     overlap = overlap )
         
     def apply(self, queryName, *args, **keys):
+        if queryName == 'intersection' and not keys:
+            # fast path, the set is built from the tree's id array in one go
+            return self.family.IF.multiunion( self._cachedResult( 'intersection', args[0], self._intersectionIds ) )
         queryFunc = getattr( self, queryName )
         generator = queryFunc( *args, **keys )
         return self.family.IF.Set( generator )
     # query methods
     
-    def count(self, coordinates):
-        ''' Counts the number of objects within coordinates '''
-        self._registerDataManager()
+    def count(self, coordinates, max_count = None):
+        ''' Counts the number of objects within coordinates. If max_count is
+            given counting stops once max_count objects were found, so this is
+            cheap for testing whether there are at least max_count objects.
+        '''
+        if max_count is not None:
+            self._beginRead()
+            lows, highs = self._queryBounds( coordinates )
+            return self._treeReader().count( lows, highs, max_count )
+        return self._cachedResult( 'count', coordinates, self._count )
+
+    def _count(self, coordinates):
+        self._beginRead()
         count = self.tree.count( coordinates )
         if self.family == BTrees.family32:
             count = int(count)
         return count
     
-    def intersection(self, coordinates):
-        ''' Returns all docids which are within the given bounds.
+    def intersection(self, coordinates, limit = None, offset = 0):
+        ''' Returns all docids which are within the given bounds. If limit or
+            offset are given, only limit results after the first offset ones
+            are returned and the tree is only read as far as needed.
         '''
-        self._registerDataManager()
+        if limit is not None or offset:
+            self._beginRead()
+            lows, highs = self._queryBounds( coordinates )
+            stop = None if limit is None else offset + limit
+            for id, position in islice( self._treeReader().intersection( lows, highs ), offset, stop ):
+                yield id
+            return
+        if self.settings.get( 'result_cache', False ):
+            for id in self._cachedResult( 'intersection', coordinates, self._intersectionIds ):
+                yield id
+            return
+        self._beginRead()
         tree = self.tree
         if self.family == BTrees.family32:
             for id in tree.intersection( coordinates, objects = False ):
@@ -117,10 +446,49 @@ class SpatialIndex(Persistent):
             for id in tree.intersection( coordinates, objects = False ):
                 yield id
 
+    def intersection_page(self, coordinates, limit, cursor = None):
+        ''' Returns ( docids, cursor ) with at most limit docids within
+            coordinates. Pass cursor back in to get the next page, it is None
+            when there are no more results. The cursor is a tuple of strings and
+            numbers, so it can be stored between requests. If the index was
+            changed in between, the next page is found by skipping as many
+            results as were returned before, so results may be repeated or
+            missed.
+        '''
+        self._beginRead()
+        lows, highs = self._queryBounds( coordinates )
+        key = self._pageCacheKey()
+        serial = key[2] if key is not None else None
+        returned, position, skip = 0, None, 0
+        if cursor is not None:
+            cursorSerial, returned, position = cursor
+            if serial is None or cursorSerial != serial:
+                position, skip = None, returned
+        ids = []
+        for id, livePosition in self._treeReader().intersection( lows, highs, position ):
+            if skip:
+                skip -= 1
+                continue
+            ids.append( id )
+            if len(ids) >= limit:
+                position = tuple( [ tuple(entry) for entry in livePosition ] )
+                return ids, ( serial, returned + len(ids), position )
+        return ids, None
+
+    def intersection_array(self, coordinates, sort = False):
+        ''' Returns all docids which are within the given bounds as an array. Use
+            this instead of intersection() if you don't need a BTrees set, the ids
+            are unsorted unless sort is True.
+        '''
+        ids = self._intersectionIds( coordinates )
+        if sort:
+            ids.sort()
+        return array( 'i' if self.family == BTrees.family32 else 'l', ids )
+
     def nearest(self, coordinates, num_results = 1):
         ''' Returns the num_results docids which are closest to coordinates
         '''
-        self._registerDataManager()
+        self._beginRead()
         tree = self.tree
         if self.family == BTrees.family32:
             for id in tree.nearest( coordinates, num_results, objects = False ):
@@ -129,81 +497,528 @@ class SpatialIndex(Persistent):
             for id in tree.nearest( coordinates, num_results, objects = False ):
                 yield id
 
+    def nearest_iter(self, coordinates, max_distance = None):
+        ''' Yields (docid, distance) for the objects closest to coordinates,
+            closest first, optionally only up to max_distance. The distance is
+            the euclidean distance between the closest points of the bounds.
+            Pages are only loaded as far as the results are consumed.
+        '''
+        self._beginRead()
+        lows, highs = self._queryBounds( coordinates )
+        for id, distance in self._treeReader().nearest( lows, highs, max_distance ):
+            yield id, distance
+
+    def within_distance(self, coordinates, radius):
+        ''' Returns all docids whose bounds are within radius of coordinates, in
+            no particular order.
+        '''
+        self._beginRead()
+        lows, highs = self._queryBounds( coordinates )
+        for id in self._treeReader().within( lows, highs, radius ):
+            yield id
+
+    # batched query methods
+
+    def intersection_many(self, windows, flat = False, parallel = False):
+        ''' Runs intersection() for every window in windows, a sequence of
+            coordinates, e.g. a numpy array with one window per row. Returns a
+            list with a family IF.Set of docids per window or, if flat is True, a
+            list of (window index, docid) pairs. If parallel is True the windows
+            are queried in several threads, see parallel.py.
+        '''
+        results = self._runMany( windows, _intersectionIds, parallel )
+        if flat:
+            return [ (i, id) for i, ids in enumerate( results ) for id in ids ]
+        return [ self.family.IF.multiunion( ids ) for ids in results ]
+
+    def count_many(self, windows, parallel = False):
+        ''' Runs count() for every window in windows and returns the counts as an
+            array. '''
+        return array( 'l', self._runMany( windows, lambda tree, window: tree.count( window ), parallel ) )
+
+    def nearest_many(self, points, num_results = 1, parallel = False):
+        ''' Runs nearest() for every point in points and returns a list with the
+            list of docids for every point. '''
+        return self._runMany( points, lambda tree, point: list( tree.nearest( point, num_results, objects = False ) ),
+                              parallel )
+
+    def intersection_parallel(self, coordinates, parts = None):
+        ''' Returns the docids within coordinates as a family IF.Set like
+            apply( 'intersection', coordinates ). The window is split into parts
+            (default: parallel.workers) slices along its longest axis which are
+            queried in several threads. Use this for huge windows.
+        '''
+        tree = self.tree
+        dimension, interleaved = tree.properties.dimension, tree.interleaved
+        lows, highs = toBounds( coordinates, dimension, interleaved )
+        windows = [ fromBounds( boxLows, boxHighs, interleaved )
+                    for boxLows, boxHighs in parallelQueries.split( lows, highs, parts or parallelQueries.workers ) ]
+        # ids of boxes which overlap several slices are found more than once
+        return self.family.IF.multiunion( [ id for ids in self._runMany( windows, _intersectionIds, True ) for id in ids ] )
+
     def leaves(self):
         ''' Returns all leaves in the tree. A leaf is a tuple (id, child_ids, bounds) '''
-        self._registerDataManager()
+        self._beginRead()
         for leaf in self.tree.leaves():
             yield leaf
 
     def get_bounds(self, coordinate_interleaved = None):
         ''' Returns the bounds of the whole tree '''
-        self._registerDataManager()
+        self._beginRead()
         return self.tree.get_bounds( coordinate_interleaved )
     
     bounds = property( get_bounds )
     
     # implementation helpers
     
+    def _resetTree(self, initialValuesGenerator = None):
+        ''' Throws away all pages and creates a new tree, optionally bulk loaded
+            from initialValuesGenerator. '''
+        self._discardTree()
+        self.pageData.clear()
+        self._getPageIds().reset()
+        self._getTree( initialValuesGenerator )     # this creates the tree and creates header and root pages
+
+    def _replacePages(self, pages, nextPageId):
+        ''' Replaces all pages with pages, a dict page id -> stored page, e.g.
+            the pageData of an index with the same settings which was built
+            elsewhere. nextPageId is the next unused page id of that index. '''
+        self._markChanged()
+        self._cancelRebuild()
+        self._discardTree()
+        self.pageData.clear()
+        pageIds = self._getPageIds()
+        pageIds.reset()
+        pageIds.counter.set( nextPageId )
+        self.pageData.update( pages )
+
+    def _finishRebuild(self, state):
+        ''' Replaces the pages with the ones of the rebuild state and applies the
+            changes which were logged meanwhile to the new tree '''
+        log = self._getChangeLog()
+        changes = sorted( log.changes.items() )
+        self.rebuilding = None
+        self._markChanged()
+        log.newEpoch()
+        self._discardTree()
+        if isinstance( self.pageData, Persistent ):
+            self.pageData = state.pageData
+        else:
+            # the store lives outside of the database, the new pages are copied
+            self.pageData.clear()
+            self.pageData.update( state.pageData.iteritems() )
+        self.pageIds = state.pageIds
+        tree = self.tree
+        for docid, oldCoordinates in changes:
+            if oldCoordinates:
+                tree.delete( docid, oldCoordinates )
+            coordinates = self.idToCoordinates.get( docid )
+            if coordinates is not None:
+                tree.add( docid, coordinates )
+
+    def _treeDifferences(self):
+        ''' Returns a list of (docid, coordinates in the tree) of the docids whose
+            entry in the tree doesn't match idToCoordinates. The coordinates are
+            () for docids which aren't in the tree. '''
+        tree = self.tree
+        self._clearBuffer(False)
+        dimension = tree.properties.dimension
+        interleaved = tree.interleaved
+        inTree = dict( (docid, (lows, highs)) for docid, lows, highs in TreeReader( tree.customstorage.readPage ).entries() )
+        changes = []
+        for docid, coordinates in self.idToCoordinates.iteritems():
+            bounds = inTree.pop( docid, None )
+            if bounds != toBounds( coordinates, dimension, interleaved ):
+                changes.append( (docid, fromBounds( bounds[0], bounds[1], interleaved ) if bounds else ()) )
+        changes.extend( [ (docid, fromBounds( lows, highs, interleaved )) for docid, (lows, highs) in inTree.items() ] )
+        return changes
+
+    def _cancelRebuild(self):
+        if self.rebuilding is not None:
+            self.rebuilding = None
+            self._getChangeLog().newEpoch()
+
+    def _logChanges(self, entries):
+        ''' Records the (docid, coordinates before the change) entries while
+            the index is rebuilt '''
+        if self.rebuilding is not None:
+            self._getChangeLog().record( entries )
+
+    def _discardTree(self):
+        ''' Throws away the tree along with the pages it buffered or wrote to the
+            overlay, called before all pages are replaced '''
+        self._clearBuffer(True)
+        tree = getattr( self, '_v_tree', None )
+        if tree is None:
+            return
+        self._v_treeHandles = None
+        overlay = tree.customstorage.overlay
+        tree.customstorage.detach()
+        del self._v_tree, tree
+        if overlay is not None:
+            overlay.clear()
+
+    def _endChange(self):
+        ''' Called at the end of every change. Writes the dirty pages of the
+            tree's buffer to the overlay or pageData, so a savepoint finds the
+            changes in the database objects and the overlay already, no matter
+            whether the connection or our data manager takes its savepoint
+            first. Without a data manager the header is stored as well, it's
+            stored on commit otherwise, and the tree's writes are blocked until
+            the next change (see _markChanged). '''
+        if getattr( self, '_v_dataManagerRegistered', False ):
+            self._clearBuffer(False)
+            return
+        storage = self.tree.customstorage
+        storage.blockWrites = False
+        self._storeHeader()
+        self._clearBuffer(False)
+        storage.blockWrites = True
+
+    def _flushOverlay(self):
+        ''' Writes the pages changed in this transaction to pageData '''
+        self.tree.customstorage.flush()
+
+    def _storeHeader(self):
+        ''' Makes the tree store its header page. The C side keeps the height
+            and the node and data counters in memory and only stores them when
+            it's flushed or destroyed, a tree opened later reads them from the
+            header page. This flushes the buffer and the storage's overlay as
+            well. '''
+        _flushIndex( self.tree.handle )
+
     def _clearBuffer(self, blockWrites):
         tree = getattr( self, '_v_tree', None )
         if not tree:
             return
         if blockWrites:
+            blocked = tree.customstorage.blockWrites
             tree.customstorage.blockWrites = True
         #log( 'PRE-CLEAR blockWrites:%s tree:%s bounds:%s' % ( blockWrites, self.tree, self.bounds ) )
         #log( 'PRE-CLEAR' )
-        tree.clearBuffer()
+        stats = tree.customstorage.stats
+        if stats is None:
+            tree.clearBuffer()
+        else:
+            start = time.time()
+            tree.clearBuffer()
+            stats.flushTime += time.time() - start
+            stats.flushes += 1
         #log( 'POST-CLEAR bounds:%s' % self.bounds )
         #log( 'POST-CLEAR' )
         if blockWrites:
-            tree.customstorage.blockWrites = False
+            tree.customstorage.blockWrites = blocked
+
+    def _intersectionIds(self, coordinates):
+        ''' Returns a list with the docids within coordinates '''
+        self._beginRead()
+        return _intersectionIds( self.tree, coordinates )
+
+    def _treeReader(self):
+        ''' Returns a TreeReader for the pages of the tree, flushes the buffer
+            if it holds changes '''
+        tree = self.tree
+        if getattr( self, '_v_dataManagerRegistered', False ):
+            self._clearBuffer( False )
+        return TreeReader( tree.customstorage.readPage )
+
+    def _queryBounds(self, coordinates):
+        ''' Returns the (lows, highs) of query coordinates '''
+        tree = self.tree
+        return toBounds( coordinates, tree.properties.dimension, tree.interleaved )
+
+    def _cachedResult(self, queryName, coordinates, compute):
+        ''' Returns compute( coordinates ). With the result_cache setting the
+            result is cached until a transaction changes the index. Results of
+            uncommitted changes are never cached. Id lists are cached as arrays,
+            so callers must not modify the result. '''
+        if not self.settings.get( 'result_cache', False ):
+            return compute( coordinates )
+        prefix = self._pageCacheKey()
+        if prefix is None:
+            return compute( coordinates )
+        key = prefix + ( queryName, tuple( [ float(value) for value in coordinates ] ) )
+        result = resultCache.get( key )
+        if result is None:
+            result = compute( coordinates )
+            if isinstance( result, list ):
+                result = array( 'l', result )
+            resultCache.set( key, result )
+        return result
+
+    def _runMany(self, queries, query, parallel = False):
+        ''' Returns [ query( tree, coordinates ) for coordinates in queries ]. The
+            queries are run in hilbert order, so consecutive queries visit the
+            same pages, and every page is loaded from the storage only once. If
+            parallel is True the queries are spread over the worker threads. '''
+        self._beginRead()
+        tree = self.tree
+        entries = spatialSort( enumerate( queries ), tree.properties.dimension, tree.interleaved )
+        results = [ None ] * len(entries)
+        storage = tree.customstorage
+        storage.beginBatch()
+        try:
+            if parallel:
+                handles = self._treeHandles( min( len(entries), parallelQueries.workers ) or 1 )
+                sortedResults = parallelQueries.run( handles, [ coordinates for i, coordinates in entries ], query )
+            else:
+                sortedResults = [ query( tree, coordinates ) for i, coordinates in entries ]
+            for (i, coordinates), result in zip( entries, sortedResults ):
+                if self.family == BTrees.family32:
+                    result = [ int(id) for id in result ] if isinstance( result, list ) else int(result)
+                results[i] = result
+        finally:
+            storage.endBatch()
+        return results
+
+    def _treeHandles(self, count):
+        ''' Returns count read-only tree handles for parallel queries. The
+            handles are kept until the index changes or the tree is dropped. '''
+        if getattr( self, '_v_dataManagerRegistered', False ):
+            # the handles read the pages from the storage, not from our buffer
+            self._clearBuffer( False )
+        key = self._pageCacheKey()
+        cached = getattr( self, '_v_treeHandles', None )
+        if key is not None and cached is not None and cached[0] == key:
+            return cached[1].get( count )
+        tree = self.tree
+        handles = parallelQueries.TreeHandles( tree.customstorage.readPage, self._getProperties, tree.interleaved )
+        self._v_treeHandles = ( key, handles ) if key is not None else None
+        return handles.get( count )
+
+    def _moveInPlace(self, moves):
+        ''' Replaces the bounds of docids directly in their leaf pages if the
+            new bounds are within the leaf's bounds, so no node bounds change.
+            moves is a list of (docid, oldCoordinates, newCoordinates). Returns
+            the moves which have to be done by deleting and inserting the entry.
+        '''
+        tree = self.tree
+        # the leaf pages are patched in the storage, so make sure the C side
+        #  doesn't hold a (dirty) copy of them. This flushes and empties the
+        #  whole buffer, so it's done once for all moves.
+        self._clearBuffer(False)
+        storage = tree.customstorage
+        reader = TreeReader( storage.readPage )
+        dimension, interleaved = reader.dimension, tree.interleaved
+        remaining = []
+        for docid, oldCoordinates, newCoordinates in moves:
+            if tuple(oldCoordinates) == tuple(newCoordinates):
+                continue
+            oldLows, oldHighs = toBounds( oldCoordinates, dimension, interleaved )
+            newLows, newHighs = toBounds( newCoordinates, dimension, interleaved )
+            found = reader.findLeaf( docid, oldLows, oldHighs )
+            if found is None or not contains( found[0].low, found[0].high, newLows, newHighs ):
+                remaining.append( (docid, oldCoordinates, newCoordinates) )
+                continue
+            leaf, i = found
+            data = storage.readPage( leaf.pageId )
+            bounds = packBounds( newLows, newHighs )
+            offset = leaf.offsets[i]
+            storage.writePage( leaf.pageId, data[:offset] + bounds + data[offset + len(bounds):] )
+        return remaining
+
+    def _transactionManager(self):
+        ''' Returns the transaction manager of the index' connection or None if
+            the index isn't stored in a connection yet. Which transaction it's
+            committed with is only known once it is. '''
+        jar = self._p_jar
+        if jar is None:
+            return None
+        return jar.transaction_manager
+
+    def _beginRead(self):
+        ''' Called before a query. Queries don't join the transaction, the tree's
+            buffer only holds clean pages unless the index was changed in this
+            transaction. Pages buffered in an earlier transaction may be stale
+            though, so they are discarded. '''
+        manager = self._transactionManager()
+        if manager is None:
+            # nobody else can change an index which isn't stored yet
+            return
+        current = manager.get()
+        previous = getattr( self, '_v_transaction', None )
+        if previous is current:
+            return
+        if not getattr( self, '_v_dataManagerRegistered', False ):
+            if previous is not None:
+                # the queries of the previous transaction
+                self._recordStats( None )
+            self._clearBuffer( True )
+            self._checkTree()
+        self._v_transaction = current
 
     def _registerDataManager(self):
         ''' This registers a custom data manager to flush all the buffers when
-             they are dirty. '''
+             they are dirty. Only called by write methods. An index which isn't
+             stored in a connection yet has no transaction to join, its changes
+             are written straight to pageData (see _endChange). '''
         registered = getattr( self, '_v_dataManagerRegistered', False )
-        if registered:
+        if registered or self._p_jar is None:
             return
+        self._beginRead()
         self._v_dataManagerRegistered = True
+        if self._registeredDataManager() is not None:
+            # joined before the index was deactivated
+            return
         
-        # haha, this is really ugly, but zodb's transaction module sorts
-        #  data managers only on commit(). That's not good for us, our data
-        #  manager's savepoint/rollback/abort calls need to be executed before
-        #  the connection's savepoint/rollback/abort.
-        t = transaction.get()
-        org_join = t.join
-        def join(resource):
-            org_join( resource )
-            t._resources = sorted( t._resources, transaction._transaction.rm_cmp )
-        t.join = join
-        t.join( DataManager(self) )
+        # the sortKey of our data manager puts its tpc_begin, which writes the
+        #  overlay to pageData, before the connection's commit. Its savepoint
+        #  and abort may run after the connection's: the buffer holds no dirty
+        #  pages between changes (see _endChange) and the tree is dropped when
+        #  the connection invalidates the index (see _p_invalidate).
+        manager = self._transactionManager()
+        dataManager = DataManager( self )
+        dataManager.transaction_manager = manager
+        if self.settings.get( 'write_overlay', True ):
+            dataManager.overlay = {}
+        if isinstance( self.pageData, PageStore ):
+            dataManager.pageStore = self.pageData
+            self.pageData.changes = PageChanges()
+        tree = getattr( self, '_v_tree', None )
+        if tree is not None:
+            tree.customstorage.overlay = dataManager.overlay
+            tree.customstorage.blockWrites = False
+        t = manager.get()
+        t.join( dataManager )
+        t.set_data( self, dataManager )
+        t.addAfterCommitHook( self._afterCommit )
         
-    def _unregisterDataManager(self):
+    def _registeredDataManager(self):
+        ''' Returns the data manager of this index which joined the current
+            transaction or None. _v_ attributes are lost when the index is
+            deactivated, so the data manager is kept with the transaction. '''
+        manager = self._transactionManager()
+        if manager is None:
+            return None
+        try:
+            return manager.get().data( self )
+        except KeyError:
+            return None
+
+    def _unregisterDataManager(self, committed = False):
         self._v_dataManagerRegistered = False
+        if isinstance( self.pageData, PageStore ):
+            self.pageData.changes = None
+        tree = getattr( self, '_v_tree', None )
+        if tree is None:
+            return
+        tree.customstorage.overlay = None
+        # the tree stays valid for the committed state, but it mustn't store
+        #  anything when it's destroyed
+        tree.customstorage.blockWrites = True
+        self._recordStats( committed )
+        if not committed:
+            # the tree still holds the header of the aborted changes
+            self._dropTree()
+
+    def _afterCommit(self, committed):
+        ''' Called after a transaction which changed the index, the tree is valid
+            for the committed state now '''
+        if committed and getattr( self, '_v_tree', None ) is not None:
+            self._v_treeKey = self._pageCacheKey()
+
+    def _recordStats(self, committed):
+        ''' Reports the instrumentation counters of the tree, committed is None
+            if the index was only queried '''
+        tree = getattr( self, '_v_tree', None )
+        stats = tree.customstorage.stats if tree is not None else None
+        if stats is not None and ( committed is not None or stats.used() ):
+            instrumentation.record( self._statsKey(), stats, committed )
+
+    def _statsKey(self):
+        ''' Returns the key of this index in the instrumentation statistics '''
+        jar = self._p_jar
+        return ( jar.db().database_name if jar is not None else None, self._p_oid )
+
+    def _createCoordinateMap(self):
+        return CoordinateMap( self.family, 2 * self.settings.get( 'dimension', 2 ) )
+
+    def _getCoordinates(self, docids, remove = False):
+        ''' Returns a list of (docid, coordinates) of the indexed docids, sorted
+            by docid, and removes them from idToCoordinates if remove is True '''
+        mapping = self.idToCoordinates
+        if isinstance( mapping, CoordinateMap ):
+            return mapping.popMany( docids ) if remove else mapping.getMany( docids )
+        entries = []
+        for docid in sorted( set( docids ) ):
+            coordinates = mapping.pop( docid, None ) if remove else mapping.get( docid )
+            if coordinates is not None:
+                entries.append( (docid, coordinates) )
+        return entries
+
+    def _changeDocumentCount(self, delta):
+        ''' Called after docids were added to or removed from idToCoordinates '''
+        numDocuments = self.numDocuments
+        if numDocuments is None:
+            self.numDocuments = Length( len(self.idToCoordinates) )
+        elif delta:
+            numDocuments.change( delta )
+
+    def _markChanged(self):
+        ''' Called before the index is changed. Changes the generation once per
+            transaction, so its serial is the serial of the last transaction which
+            changed the index. '''
+        self._registerDataManager()
+        if self._p_jar is None:
+            # blocked again by _endChange
+            self.tree.customstorage.blockWrites = False
+        self._v_treeKey = None
+        generation = self.generation
+        if generation is None:
+            generation = self.generation = Length()
+        if not generation._p_changed:
+            generation.change( 1 )
+            self._getChangeLog().join()
+            if isinstance( self.pageData, PageStore ):
+                self._getStoreWriters().join()
+
+    def _pageCacheKey(self):
+        ''' Returns the key prefix of our pages in the page cache or None if the
+            pages must not be cached, e.g. because they were changed in the
+            current transaction. '''
+        generation = self.generation
+        jar = self._p_jar
+        if generation is None or jar is None or generation._p_jar is None or generation._p_changed:
+            return None
+        generation._p_activate()
+        return ( databaseToken( jar.db() ), self._p_oid, generation._p_serial )
 
     def _getTree(self, initialValuesGenerator = None):
-        ''' Creates the r-tree if it is not already created yet and returns it '''
+        ''' Creates the r-tree if it is not already created yet and returns it.
+            A tree for the committed state of the index is taken from the
+            treePool if it has one. '''
         tree = getattr( self, '_v_tree', None )
         if not tree:
-            # create r-tree property object
-            properties = Property()
-            settings = getattr(self, 'settings', None)
-            if not settings:
-                raise ValueError('invalid spatial index')
-            # check interleaved setting
-            interleaved = settings.pop('interleaved', True)
-            for name, value in settings.items():
-                if not hasattr( properties, name ):
-                    raise ValueError( 'Invalid setting "%s"' % name )
-                setattr( properties, name, value )
-            # create r-tree storage object
-            storage = Storage( self.pageData, convertToInt = (self.family == BTrees.family32) )
-            # create r-tree
-            if not initialValuesGenerator:
-                tree = Rtree( storage, properties = properties, interleaved = interleaved )
+            storageClass = InstrumentedStorage if instrumentation.enabled else Storage
+            key = self._pageCacheKey() if not initialValuesGenerator else None
+            tree = treePool.checkout( key ) if key is not None else None
+            if tree is not None and type( tree.customstorage ) is storageClass:
+                self._bindStorage( tree.customstorage, tree.properties.dimension )
             else:
-                tree = Rtree( storage, initialValuesGenerator, properties = properties, interleaved = interleaved )
+                pageData = self.pageData
+                if not initialValuesGenerator and isinstance( pageData, PageStore ) and not pageData and self.idToCoordinates:
+                    # e.g. a memory store after a restart or a deleted file, the
+                    #  tree would come up empty
+                    raise ValueError( 'The page store at %s has no pages but the index has documents, rebuild() the index' % pageData.location )
+                properties = self._getProperties()
+                # check interleaved setting
+                interleaved = self.settings.get('interleaved', True)
+                # create r-tree storage object
+                storage = storageClass( None, None, convertToInt = (self.family == BTrees.family32) )
+                self._bindStorage( storage, properties.dimension )
+                # create r-tree, a new one stores its header and root pages
+                blockWrites, storage.blockWrites = storage.blockWrites, False
+                if not initialValuesGenerator:
+                    tree = Rtree( storage, properties = properties, interleaved = interleaved )
+                else:
+                    tree = Rtree( storage, initialValuesGenerator, properties = properties, interleaved = interleaved )
+                if blockWrites:
+                    # the pages of a bulk load may still be buffered
+                    tree.clearBuffer()
+                    storage.blockWrites = True
             self._v_tree = tree
+            # the committed state the tree is valid for, None if unknown
+            self._v_treeKey = key
         else:
             if initialValuesGenerator:
                 raise ValueError(initialValuesGenerator)
@@ -211,5 +1026,192 @@ class SpatialIndex(Persistent):
         return tree
         
     tree = property( _getTree )
-    
 
+    def _bindStorage(self, storage, dimension):
+        ''' Points storage at the pages of this index and configures it from the
+            settings '''
+        settings = self.settings
+        storage.mapping = self.pageData
+        storage.pageIds = self._getPageIds()
+        # the tree only writes while the index is changed, so it never stores
+        #  its header when it's destroyed, e.g. after the connection was closed
+        storage.blockWrites = True
+        storage.compressor = self._getCompressor()
+        storage.pageObjects = self._pageObjects()
+        if settings.get( 'page_cache', True ):
+            storage.cache = pageCache
+            storage.cacheKey = self._pageCacheKey
+        else:
+            storage.cache = storage.cacheKey = None
+        if settings.get( 'prefetch', True ) and isinstance( self.pageData, Persistent ):
+            storage.prefetch = self._prefetch
+            storage.dimension = dimension
+        else:
+            storage.prefetch = None
+        dataManager = self._registeredDataManager()
+        if dataManager is not None:
+            # the pages written before the index was deactivated
+            storage.overlay = dataManager.overlay
+            storage.blockWrites = False
+            self._v_dataManagerRegistered = True
+
+    def _checkTree(self):
+        ''' Called at the start of a transaction. Drops the tree if the index
+            was changed since the tree read its header. '''
+        tree = getattr( self, '_v_tree', None )
+        if tree is None:
+            return
+        treeKey = getattr( self, '_v_treeKey', None )
+        if treeKey is None or treeKey != self._pageCacheKey():
+            self._dropTree()
+
+    def _dropTree(self):
+        tree = getattr( self, '_v_tree', None )
+        if tree is None:
+            return
+        # the handles of parallel queries read through the tree's storage
+        self._v_treeHandles = None
+        tree.customstorage.detach()
+        del self._v_tree
+
+    def _releaseTree(self):
+        ''' Puts the tree into the treePool if it's valid for a committed state
+            of the index '''
+        tree = getattr( self, '_v_tree', None )
+        key = getattr( self, '_v_treeKey', None )
+        if tree is None or key is None or getattr( self, '_v_dataManagerRegistered', False ):
+            return
+        self._recordStats( None )
+        del self._v_tree
+        self._v_treeHandles = None
+        tree.customstorage.detach()
+        treePool.checkin( key, tree )
+
+    def __setstate__(self, state):
+        Persistent.__setstate__( self, state )
+        if isinstance( self.pageData, PageStore ):
+            dataManager = self._registeredDataManager()
+            if dataManager is not None:
+                # reloaded after it was deactivated, the store keeps the changes
+                #  of the transaction
+                self.pageData.changes = dataManager.pageStore.changes
+
+    def _p_deactivate(self):
+        # changed objects are not deactivated
+        if self._p_changed is False:
+            self._releaseTree()
+        Persistent._p_deactivate( self )
+
+    def _p_invalidate(self):
+        if self._p_changed is not None:
+            if getattr( self, '_v_dataManagerRegistered', False ):
+                # aborted by the connection before our data manager, the tree
+                #  mustn't write the aborted changes when it's destroyed
+                self._dropTree()
+            else:
+                self._releaseTree()
+        Persistent._p_invalidate( self )
+
+    def _prefetch(self, objects):
+        ''' Asks the database to load objects in the background '''
+        prefetch = getattr( self._p_jar, 'prefetch', None )
+        if prefetch is not None:
+            prefetch( objects )
+
+    def _getProperties(self):
+        ''' Returns a new r-tree property object for the settings '''
+        properties = Property()
+        settings = getattr(self, 'settings', None)
+        if not settings:
+            raise ValueError('invalid spatial index')
+        for name, value in settings.items():
+            if name in indexSettings:
+                continue
+            if not hasattr( properties, name ):
+                raise ValueError( 'Invalid setting "%s"' % name )
+            setattr( properties, name, value )
+        return properties
+
+    def _getCompressor(self):
+        ''' Returns the page compressor configured in the settings or None '''
+        name = self.settings.get( 'compression' )
+        if not name:
+            return None
+        return getCompressor( name, self.settings.get( 'compression_level', 6 ) )
+
+    def _pageObjects(self):
+        ''' Returns True if the pages are stored as Page objects. Only the
+            btree page store can hold persistent objects. '''
+        return self.settings.get( 'page_objects', False ) and isinstance( self.pageData, Persistent )
+
+    def _getChangeLog(self):
+        ''' Returns the change log, creates one for old indexes '''
+        changeLog = self.changeLog
+        if changeLog is None:
+            changeLog = self.changeLog = ChangeLog()
+        return changeLog
+
+    def _getStoreWriters(self):
+        ''' Returns the writers of the page store, creates them for old indexes '''
+        storeWriters = self.storeWriters
+        if storeWriters is None:
+            storeWriters = self.storeWriters = StoreWriters()
+        return storeWriters
+
+    def _getPageIds(self):
+        ''' Returns the page id allocator, creates one for old indexes '''
+        pageIds = self.pageIds
+        if pageIds is None:
+            nextId = self.pageData.maxKey() + 1 if self.pageData else 0
+            randomIds = self.settings.get( 'random_page_ids', False )
+            pageIds = self.pageIds = PageIdAllocator( self.family, nextId, randomIds )
+        return pageIds
+
+
+def _retry(manager, attempts, change):
+    ''' Calls change() and commits, up to attempts times if the commit raises
+        a ConflictError. Returns the result of change(). '''
+    for attempt in xrange( attempts ):
+        try:
+            result = change()
+            manager.commit()
+            return result
+        except ConflictError:
+            manager.abort()
+            if attempt == attempts - 1:
+                raise
+
+# rtree doesn't declare Index_Flush, it stores the header of the tree
+_flushIndex = core.rt.Index_Flush
+_flushIndex.argtypes = [ ctypes.c_void_p ]
+_flushIndex.restype = ctypes.c_int
+_flushIndex.errcheck = core.check_return
+
+def _intersectionIds(tree, coordinates):
+    ''' Returns the ids within coordinates as a list. The ids are copied from
+        the array the C library returns in one go instead of yielding them one
+        by one like tree.intersection() does. '''
+    getCoordinatePointers = getattr( tree, 'get_coordinate_pointers', None )
+    if getCoordinatePointers is None:
+        # rtree version without the low level api
+        return list( tree.intersection( coordinates, objects = False ) )
+    mins, maxs = getCoordinatePointers( coordinates )
+    numResults = ctypes.c_uint64( 0 )
+    ids = ctypes.pointer( ctypes.c_int64() )
+    core.rt.Index_Intersects_id( tree.handle, mins, maxs, tree.properties.dimension,
+                                 ctypes.byref( ids ), ctypes.byref( numResults ) )
+    try:
+        return ctypes.cast( ids, ctypes.POINTER( ctypes.c_int64 * numResults.value ) ).contents[:]
+    finally:
+        core.rt.Index_Free( ctypes.cast( ids, ctypes.POINTER( ctypes.c_void_p ) ) )
+
+def _chunks(iterable, size):
+    ''' Yields lists of at most size items from iterable '''
+    chunk = []
+    for item in iterable:
+        chunk.append( item )
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,312 @@
+''' Benchmarks for the spatial index.
+
+    Run them with e.g.
+
+        python -m zope.index.SpatialIndex.benchmarks --storage file --documents 100000
+
+    The results are written as JSON (to stdout or --output), one entry per
+    benchmark with the elapsed seconds and operations per second, so runs can be
+    compared to catch regressions. All random data is generated from --seed, so
+    runs with the same options work on the same data.
+
+    Benchmarks:
+
+        bulk load           SpatialIndex( initialValuesGenerator = ... ) and
+                            index_docs() on an empty index
+        index_doc           incremental inserts, committed every
+                            --transaction-size documents
+        unindex_doc         incremental deletes of half of the documents
+        intersection/count  random windows covering 0.01%, 0.1% and 1% of the
+                            extent
+        nearest             the 10 nearest documents to random points
+        savepoint/commit    the time to flush the buffer of --transaction-size
+                            inserts on a savepoint and on commit
+        conflicts           --writers threads inserting concurrently, reports
+                            the rate of transactions which had a ConflictError
+
+    Storages: "mapping" (MappingStorage), "file" (FileStorage in a temporary
+    directory) and "zeo" (a local ZEO server, needs the ZEO package).
+'''
+import json
+import math
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import BTrees
+import transaction
+import ZODB
+from ZODB.POSException import ConflictError
+from ZODB.MappingStorage import MappingStorage
+from ZODB.FileStorage import FileStorage
+
+from baseIndex import SpatialIndex
+
+extent = 1000.0
+selectivities = ( 0.0001, 0.001, 0.01 )
+
+
+def generateDocuments(count, distribution = 'uniform', shape = 'boxes', seed = 0):
+    ''' Yields count (docid, coordinates) pairs within (0, 0, extent, extent).
+        distribution is "uniform" or "clustered" (gaussian clusters of about
+        1000 documents), shape is "boxes" or "points". '''
+    rnd = random.Random( seed )
+    centers = [ (rnd.uniform( 0, extent ), rnd.uniform( 0, extent )) for i in range( max( 1, count // 1000 ) ) ]
+    for docid in xrange( count ):
+        if distribution == 'uniform':
+            x, y = rnd.uniform( 0, extent ), rnd.uniform( 0, extent )
+        elif distribution == 'clustered':
+            cx, cy = rnd.choice( centers )
+            x = min( max( rnd.gauss( cx, extent / 100 ), 0 ), extent )
+            y = min( max( rnd.gauss( cy, extent / 100 ), 0 ), extent )
+        else:
+            raise ValueError( 'Unknown distribution "%s"' % distribution )
+        if shape == 'points':
+            yield docid, (x, y)
+        else:
+            width, height = rnd.uniform( 0, extent / 1000 ), rnd.uniform( 0, extent / 1000 )
+            yield docid, (x, y, x + width, y + height)
+
+def generateWindows(count, selectivity, seed = 0):
+    ''' Yields count random windows each covering selectivity of the extent '''
+    rnd = random.Random( seed )
+    size = extent * math.sqrt( selectivity )
+    for i in xrange( count ):
+        x, y = rnd.uniform( 0, extent - size ), rnd.uniform( 0, extent - size )
+        yield (x, y, x + size, y + size)
+
+def openDatabase(kind, directory):
+    ''' Returns (database, close function) for the storage kind '''
+    if kind == 'mapping':
+        db = ZODB.DB( MappingStorage() )
+        return db, db.close
+    if kind == 'file':
+        db = ZODB.DB( FileStorage( os.path.join( directory, 'Data.fs' ) ) )
+        return db, db.close
+    if kind == 'zeo':
+        import ZEO
+        address, stop = ZEO.server( path = os.path.join( directory, 'Data.fs' ) )
+        db = ZEO.DB( address )
+        def close():
+            db.close()
+            stop()
+        return db, close
+    raise ValueError( 'Unknown storage "%s"' % kind )
+
+
+class Benchmarks(object):
+    ''' Runs all benchmarks against one database '''
+    def __init__(self, db, options):
+        self.db = db
+        self.options = options
+        self.results = []
+
+    def settings(self):
+        settings = dict( dimension = 2, leaf_capacity = 50, near_minimum_overlap_factor = 32,
+                         writethrough = False, buffering_capacity = 100, family = BTrees.family64 )
+        settings.update( self.options.settings )
+        return settings
+
+    def documents(self):
+        options = self.options
+        return generateDocuments( options.documents, options.distribution, options.shape, options.seed )
+
+    def record(self, name, seconds, operations, **extra):
+        result = dict( name = name, seconds = seconds, operations = operations,
+                       operationsPerSecond = operations / seconds if seconds else None )
+        result.update( extra )
+        self.results.append( result )
+
+    def run(self):
+        connection = self.db.open()
+        root = connection.root()
+        try:
+            self.benchBulkLoad( root )
+            self.benchIncremental( root )
+            self.benchQueries( root['batch'] )
+            self.benchFlushes( root['incremental'] )
+        finally:
+            transaction.abort()
+            connection.close()
+        self.benchConflicts()
+        return self.results
+
+    def benchBulkLoad(self, root):
+        start = time.time()
+        root['bulk'] = SpatialIndex( self.settings(), ( (docid, coordinates, None) for docid, coordinates in self.documents() ) )
+        transaction.commit()
+        self.record( 'bulk load (initialValuesGenerator)', time.time() - start, self.options.documents )
+
+        root['batch'] = index = SpatialIndex( self.settings() )
+        transaction.commit()
+        start = time.time()
+        index.index_docs( self.documents() )
+        transaction.commit()
+        self.record( 'bulk load (index_docs)', time.time() - start, self.options.documents )
+
+    def benchIncremental(self, root):
+        transactionSize = self.options.transactionSize
+        root['incremental'] = index = SpatialIndex( self.settings() )
+        transaction.commit()
+        start = time.time()
+        for i, (docid, coordinates) in enumerate( self.documents() ):
+            index.index_doc( docid, coordinates )
+            if i % transactionSize == transactionSize - 1:
+                transaction.commit()
+        transaction.commit()
+        self.record( 'index_doc', time.time() - start, self.options.documents )
+
+        docids = range( 0, self.options.documents, 2 )
+        start = time.time()
+        for i, docid in enumerate( docids ):
+            index.unindex_doc( docid )
+            if i % transactionSize == transactionSize - 1:
+                transaction.commit()
+        transaction.commit()
+        self.record( 'unindex_doc', time.time() - start, len(docids) )
+
+    def benchQueries(self, index):
+        queries = self.options.queries
+        for selectivity in selectivities:
+            windows = list( generateWindows( queries, selectivity, self.options.seed ) )
+            start = time.time()
+            found = 0
+            for window in windows:
+                found += len( list( index.intersection( window ) ) )
+            self.record( 'intersection', time.time() - start, queries, selectivity = selectivity, found = found )
+            start = time.time()
+            for window in windows:
+                index.count( window )
+            self.record( 'count', time.time() - start, queries, selectivity = selectivity )
+            start = time.time()
+            for window in windows:
+                index.apply( 'intersection', window )
+            self.record( 'apply', time.time() - start, queries, selectivity = selectivity )
+        rnd = random.Random( self.options.seed )
+        points = [ (rnd.uniform( 0, extent ), rnd.uniform( 0, extent )) for i in xrange( queries ) ]
+        start = time.time()
+        for point in points:
+            list( index.nearest( point, 10 ) )
+        self.record( 'nearest', time.time() - start, queries, num_results = 10 )
+
+    def benchFlushes(self, index):
+        transactionSize = self.options.transactionSize
+        documents = generateDocuments( transactionSize * 2, self.options.distribution, self.options.shape, self.options.seed + 1 )
+        offset = self.options.documents
+        for i, (docid, coordinates) in enumerate( documents ):
+            index.index_doc( offset + docid, coordinates )
+            if i == transactionSize - 1:
+                start = time.time()
+                transaction.savepoint()
+                self.record( 'savepoint', time.time() - start, transactionSize )
+        start = time.time()
+        transaction.commit()
+        self.record( 'commit', time.time() - start, transactionSize )
+
+    def benchConflicts(self):
+        options = self.options
+        connection = self.db.open()
+        connection.root()['concurrent'] = SpatialIndex( self.settings() )
+        transaction.commit()
+        connection.close()
+        counts = dict( commits = 0, conflicts = 0 )
+        lock = threading.Lock()
+
+        def write(writer):
+            connection = self.db.open()
+            try:
+                documents = list( generateDocuments( options.documents // options.writers, options.distribution,
+                                                     options.shape, options.seed + writer ) )
+                offset = writer * len(documents)
+                for i in xrange( 0, len(documents), options.transactionSize ):
+                    batch = documents[i:i + options.transactionSize]
+                    while True:
+                        try:
+                            index = connection.root()['concurrent']
+                            for docid, coordinates in batch:
+                                index.index_doc( offset + docid, coordinates )
+                            transaction.commit()
+                        except ConflictError:
+                            transaction.abort()
+                            with lock:
+                                counts['conflicts'] += 1
+                        else:
+                            with lock:
+                                counts['commits'] += 1
+                            break
+            finally:
+                transaction.abort()
+                connection.close()
+
+        threads = [ threading.Thread( target = write, args = (writer,) ) for writer in range( options.writers ) ]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        attempts = counts['commits'] + counts['conflicts']
+        self.record( 'conflicts', time.time() - start, counts['commits'], writers = options.writers,
+                     conflicts = counts['conflicts'],
+                     conflictRate = float(counts['conflicts']) / attempts if attempts else 0.0 )
+
+
+def parseSetting(option, optionString, value, parser):
+    name, value = value.split( '=', 1 )
+    for convert in (int, float):
+        try:
+            value = convert( value )
+            break
+        except ValueError:
+            pass
+    parser.values.settings[name] = value
+
+def main(args = None):
+    parser = optparse.OptionParser( description = 'Benchmarks the spatial index.' )
+    parser.add_option( '--storage', action = 'append', dest = 'storages', choices = ('mapping', 'file', 'zeo'),
+                       help = 'mapping, file or zeo, can be given more than once (default: mapping)' )
+    parser.add_option( '--documents', type = 'int', default = 10000, help = 'number of documents (default: %default)' )
+    parser.add_option( '--distribution', choices = ('uniform', 'clustered'), default = 'uniform',
+                       help = 'uniform or clustered (default: %default)' )
+    parser.add_option( '--shape', choices = ('boxes', 'points'), default = 'boxes', help = 'boxes or points (default: %default)' )
+    parser.add_option( '--queries', type = 'int', default = 1000, help = 'queries per query benchmark (default: %default)' )
+    parser.add_option( '--transaction-size', dest = 'transactionSize', type = 'int', default = 1000,
+                       help = 'documents per transaction (default: %default)' )
+    parser.add_option( '--writers', type = 'int', default = 4, help = 'concurrent writer threads (default: %default)' )
+    parser.add_option( '--seed', type = 'int', default = 0, help = 'random seed (default: %default)' )
+    parser.add_option( '--setting', action = 'callback', callback = parseSetting, type = 'string',
+                       help = 'an index setting like compression=zlib, can be given more than once' )
+    parser.add_option( '--output', help = 'write the results to this file instead of stdout' )
+    parser.set_defaults( settings = {} )
+    options, args = parser.parse_args( args )
+
+    results = []
+    for kind in options.storages or [ 'mapping' ]:
+        directory = tempfile.mkdtemp()
+        try:
+            db, close = openDatabase( kind, directory )
+            try:
+                for result in Benchmarks( db, options ).run():
+                    result['storage'] = kind
+                    results.append( result )
+            finally:
+                close()
+        finally:
+            shutil.rmtree( directory )
+
+    report = dict( python = sys.version, options = dict( vars( options ), storages = options.storages or [ 'mapping' ] ),
+                   results = results )
+    output = open( options.output, 'w' ) if options.output else sys.stdout
+    try:
+        json.dump( report, output, indent = 2, sort_keys = True )
+        output.write( '\n' )
+    finally:
+        if options.output:
+            output.close()
+
+if __name__ == '__main__':
+    main()
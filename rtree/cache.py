@@ -0,0 +1,166 @@
+''' Process wide caches which are shared between all connections.
+
+    Entries are never invalidated explicitly. Instead the keys contain the serial
+    of the index's generation counter, so when a transaction changes the index
+    (and ZODB invalidates the counter) the connections compute new keys and the
+    old entries simply age out of the cache.
+'''
+import atexit
+import itertools
+import threading
+from array import array
+from collections import OrderedDict
+
+_databaseTokens = itertools.count( 1 )
+_databaseTokenLock = threading.Lock()
+
+
+class LRUCache(object):
+    """ A thread safe mapping which evicts the least recently used entries once
+        it holds more than maxEntries entries or more than maxBytes bytes. The
+        size of an entry is computed by sizeOf(value).
+    """
+    def __init__(self, maxEntries = 100000, maxBytes = 64 * 1024 * 1024, sizeOf = len):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Removes all entries and resets the statistics """
+        with self.lock:
+            self.entries = OrderedDict()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            try:
+                value, size = self.entries.pop( key )
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value, size
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        """ Returns True if key is cached, doesn't count as a hit or miss """
+        with self.lock:
+            return key in self.entries
+
+    def set(self, key, value):
+        size = self.sizeOf( value )
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            old = self.entries.pop( key, None )
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = value, size
+            self.bytes += size
+            while len(self.entries) > self.maxEntries or self.bytes > self.maxBytes:
+                oldKey, (oldValue, oldSize) = self.entries.popitem( last = False )
+                self.bytes -= oldSize
+                self.evictions += 1
+
+    def statistics(self):
+        """ Returns a dict with the hit/miss counters and the memory use """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict( hits = self.hits, misses = self.misses,
+                         hitRate = float(self.hits) / lookups if lookups else 0.0,
+                         evictions = self.evictions, entries = len(self.entries),
+                         bytes = self.bytes, maxEntries = self.maxEntries,
+                         maxBytes = self.maxBytes )
+
+
+class TreePool(object):
+    """ Ready tree handles of all indexes, so an index which is activated in a
+        connection doesn't need to build its tree and read its header again.
+        The trees are keyed by (database, index oid, generation serial) like
+        the pages. A tree is checked out by one connection at a time. Trees of
+        older serials are dropped when a newer one is checked in or out. At
+        most maxTrees trees are kept per index.
+    """
+    def __init__(self, maxTrees = 4):
+        self.maxTrees = maxTrees
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Removes all trees and resets the statistics """
+        with self.lock:
+            self.trees = {}
+            self.hits = 0
+            self.misses = 0
+
+    def checkout(self, key):
+        """ Returns a tree for key or None """
+        indexKey, serial = key[:-1], key[-1]
+        with self.lock:
+            trees = self._current( indexKey, serial )
+            for i in range( len(trees) - 1, -1, -1 ):
+                if trees[i][0] == serial:
+                    self.hits += 1
+                    return trees.pop( i )[1]
+            self.misses += 1
+            return None
+
+    def checkin(self, key, tree):
+        """ Returns a tree which is valid for key to the pool """
+        indexKey, serial = key[:-1], key[-1]
+        with self.lock:
+            trees = self._current( indexKey, serial )
+            if len(trees) >= self.maxTrees:
+                return
+            trees.append( (serial, tree) )
+
+    def _current(self, indexKey, serial):
+        """ Drops the trees of indexKey which are older than serial and returns
+            the list of the remaining (serial, tree) """
+        trees = self.trees.setdefault( indexKey, [] )
+        trees[:] = [ entry for entry in trees if entry[0] >= serial ]
+        return trees
+
+    def statistics(self):
+        with self.lock:
+            return dict( hits = self.hits, misses = self.misses,
+                         trees = sum( [ len(trees) for trees in self.trees.values() ] ) )
+
+
+def databaseToken(db):
+    ''' Returns the number which stands for db in the keys of the caches. It is
+        set on the database once, unlike id(db) it isn't reused by a database
+        which is opened after db was closed. '''
+    token = getattr( db, '_spatialIndexCacheToken', None )
+    if token is None:
+        with _databaseTokenLock:
+            token = getattr( db, '_spatialIndexCacheToken', None )
+            if token is None:
+                token = db._spatialIndexCacheToken = next( _databaseTokens )
+    return token
+
+
+def resultSize(value):
+    ''' Returns the approximate size of a cached query result '''
+    if isinstance( value, array ):
+        return 64 + value.itemsize * len(value)
+    return 64
+
+
+# the pages of all indexes, keyed by (database, index oid, generation serial, page id)
+pageCache = LRUCache()
+
+# the results of queries of indexes with the result_cache setting, keyed by
+#  (database, index oid, generation serial, query name, coordinates)
+resultCache = LRUCache( maxEntries = 10000, maxBytes = 32 * 1024 * 1024, sizeOf = resultSize )
+
+# the tree handles of indexes which were deactivated, see SpatialIndex._getTree
+treePool = TreePool()
+# a tree which is destroyed while the interpreter shuts down calls into
+#  modules which are gone already, so the pooled trees are destroyed before
+atexit.register( treePool.clear )
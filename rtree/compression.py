@@ -0,0 +1,93 @@
+''' Page compression.
+
+    Compressed pages start with a tag which no uncompressed page starts with:
+    node pages start with their node type (1 or 2) and the header page starts
+    with the 64 bit id of the root page, which is always smaller than 2 ** 31.
+    So compressed and uncompressed pages can live side by side and an index can
+    switch its compression on or off at any time.
+
+    The tag is followed by the id of the codec and the compression level, so a
+    page can be compressed again like it was, e.g. when the header page merges
+    concurrent changes. Pages which were written before the level was stored
+    carry the lower case id of their codec and no level.
+'''
+import zlib
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+_tag = '\x00\x00\x00\x00\xffZC'
+
+
+class Codec(object):
+    ''' A compression algorithm. id is the single character which is stored in
+        the page tag, upper case if the level follows it. '''
+    def __init__(self, id, compress, decompress):
+        self.id = id
+        self.compress = compress
+        self.decompress = decompress
+
+    def prefix(self, level):
+        return _tag + self.id.upper() + chr(level)
+
+codecs = {
+    'zlib' : Codec( 'z', zlib.compress, zlib.decompress ),
+    }
+if lz4 is not None:
+    codecs['lz4'] = Codec( 'l', lambda data, level: lz4.compress( data ), lz4.decompress )
+
+_codecsById = dict( (codec.id, codec) for codec in codecs.values() )
+_codecsById.update( (codec.id.upper(), codec) for codec in codecs.values() )
+
+
+def getCompressor(name, level = 6):
+    ''' Returns a function which compresses a page with codec name. "fast" means
+        lz4 if it is installed or zlib at level 1 otherwise.
+    '''
+    if name == 'fast':
+        if lz4 is not None:
+            name = 'lz4'
+        else:
+            name, level = 'zlib', 1
+    try:
+        codec = codecs[name]
+    except KeyError:
+        raise ValueError( 'Unknown compression "%s"' % name )
+    prefix = codec.prefix( level )
+    compress = codec.compress
+    def compressor(data):
+        compressed = prefix + compress( data, level )
+        # it's not worth it for pages which don't shrink
+        if len(compressed) >= len(data):
+            return data
+        return compressed
+    return compressor
+
+def _parseTag(data):
+    ''' Returns the codec and level of compressed data and the offset of the
+        compressed bytes '''
+    codecId = data[len(_tag)]
+    try:
+        codec = _codecsById[codecId]
+    except KeyError:
+        raise ValueError( 'Page compressed with unknown codec "%s"' % codecId )
+    if codecId == codec.id:
+        # written before the level was stored, at the default level
+        return codec, 6, len(_tag) + 1
+    return codec, ord( data[len(_tag) + 1] ), len(_tag) + 2
+
+def decompress(data):
+    ''' Returns the uncompressed page data, data may be compressed or not '''
+    if not data.startswith( _tag ):
+        return data
+    codec, level, offset = _parseTag( data )
+    return codec.decompress( data[offset:] )
+
+def compressLike(data, other):
+    ''' Compresses data with the codec and level other was compressed with '''
+    if not other.startswith( _tag ):
+        return data
+    codec, level, offset = _parseTag( other )
+    return codec.prefix( level ) + codec.compress( data, level )
@@ -0,0 +1,342 @@
+''' A compact mapping docid -> coordinates.
+
+    A BTree of tuples pickles every float and every tuple separately, which
+    makes idToCoordinates the biggest part of an index. CoordinateMap stores the
+    coordinates in blocks of up to blockSize docids instead. Each block is one
+    persistent object with the sorted docids and the coordinates packed into
+    fixed width arrays of doubles. The blocks are kept in a BTree keyed by their
+    smallest docid. Blocks which become empty are deleted, blocks which shrink
+    below half of blockSize are merged with a neighbor if the two fit into one.
+'''
+import bisect
+import struct
+import sys
+from array import array
+
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+
+
+def _packIds(ids):
+    return struct.pack( '<%dq' % len(ids), *ids )
+
+def _unpackIds(data):
+    return list( struct.unpack( '<%dq' % (len(data) // 8), data ) )
+
+def _packDoubles(values):
+    if sys.byteorder == 'big':
+        values = array( 'd', values )
+        values.byteswap()
+    return values.tostring()
+
+def _unpackDoubles(data):
+    values = array( 'd' )
+    values.fromstring( data )
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class CoordinateBlock(Persistent):
+    """ The coordinates of a range of docids. The coordinates of docid ids[i]
+        are values[i * width:i * width + sizes[i]], so points and bounding boxes
+        can be mixed. The state is stored as little endian byte strings. """
+    def __init__(self, width):
+        Persistent.__init__( self )
+        self.width = width
+        self.ids = []
+        self.values = array( 'd' )
+        self.sizes = array( 'B' )
+        # changed when the block is split, merged or deleted, blocks which were
+        #  split can't be merged on conflicts
+        self.splits = 0
+
+    def __getstate__(self):
+        return dict( width = self.width, splits = self.splits, ids = _packIds( self.ids ),
+                     values = _packDoubles( self.values ), sizes = self.sizes.tostring() )
+
+    def __setstate__(self, state):
+        self.width = state['width']
+        self.splits = state['splits']
+        self.ids = _unpackIds( state['ids'] )
+        self.values = _unpackDoubles( state['values'] )
+        self.sizes = array( 'B' )
+        self.sizes.fromstring( state['sizes'] )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, docid):
+        ''' Returns the position of docid or -1 '''
+        i = bisect.bisect_left( self.ids, docid )
+        if i < len(self.ids) and self.ids[i] == docid:
+            return i
+        return -1
+
+    def get(self, i):
+        ''' Returns the coordinates at position i '''
+        start = i * self.width
+        return tuple( self.values[start:start + self.sizes[i]] )
+
+    def set(self, docid, coordinates):
+        ''' Stores the coordinates of docid '''
+        padded = array( 'd', coordinates )
+        size = len(padded)
+        padded.extend( [ 0.0 ] * (self.width - size) )
+        i = bisect.bisect_left( self.ids, docid )
+        start = i * self.width
+        if i < len(self.ids) and self.ids[i] == docid:
+            self.values[start:start + self.width] = padded
+            self.sizes[i] = size
+        else:
+            self.ids.insert( i, docid )
+            self.values[start:start] = padded
+            self.sizes.insert( i, size )
+        self._p_changed = True
+
+    def remove(self, i):
+        ''' Removes the docid at position i '''
+        del self.ids[i]
+        del self.values[i * self.width:(i + 1) * self.width]
+        del self.sizes[i]
+        self._p_changed = True
+
+    def split(self):
+        ''' Moves the upper half of the docids to a new block and returns it '''
+        middle = len(self.ids) // 2
+        upper = CoordinateBlock( self.width )
+        upper.ids = self.ids[middle:]
+        upper.values = self.values[middle * self.width:]
+        upper.sizes = self.sizes[middle:]
+        del self.ids[middle:]
+        del self.values[middle * self.width:]
+        del self.sizes[middle:]
+        self.splits += 1
+        self._p_changed = True
+        return upper
+
+    def merge(self, upper):
+        ''' Moves the docids of upper, whose docids are all bigger, to this
+            block. upper is discarded. '''
+        self.ids.extend( upper.ids )
+        self.values.extend( upper.values )
+        self.sizes.extend( upper.sizes )
+        self.splits += 1
+        self._p_changed = True
+        upper.discard()
+
+    def discard(self):
+        ''' Called when the block is deleted from the map. Concurrent changes of
+            the block conflict then instead of being merged into a block which
+            isn't in the map anymore. '''
+        del self.ids[:]
+        del self.values[:]
+        del self.sizes[:]
+        self.splits += 1
+        self._p_changed = True
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        ''' Merges concurrent changes of different docids '''
+        if not oldState['splits'] == savedState['splits'] == newState['splits']:
+            raise ConflictError
+        old, saved, new = [ _entries( state ) for state in (oldState, savedState, newState) ]
+        merged = dict( saved )
+        for docid in set( old ) | set( new ):
+            if old.get( docid ) == new.get( docid ):
+                continue
+            if saved.get( docid ) != old.get( docid ):
+                # changed by both transactions
+                raise ConflictError
+            if docid in new:
+                merged[docid] = new[docid]
+            else:
+                merged.pop( docid, None )
+        ids = sorted( merged )
+        state = dict( savedState )
+        state['ids'] = _packIds( ids )
+        state['values'] = ''.join( [ merged[docid][1] for docid in ids ] )
+        state['sizes'] = array( 'B', [ merged[docid][0] for docid in ids ] ).tostring()
+        return state
+
+
+def _entries(state):
+    ''' Returns a dict docid -> (size, packed values) of a block state '''
+    rowSize = state['width'] * 8
+    ids = _unpackIds( state['ids'] )
+    sizes = array( 'B' )
+    sizes.fromstring( state['sizes'] )
+    values = state['values']
+    return dict( (docid, (sizes[i], values[i * rowSize:(i + 1) * rowSize])) for i, docid in enumerate( ids ) )
+
+
+class CoordinateMap(Persistent):
+    """ A mapping docid -> coordinates tuple with the api of the BTree it
+        replaces. Coordinates are returned as tuples of floats. """
+    blockSize = 256
+
+    def __init__(self, family, width):
+        ''' width is the maximum number of values of the coordinates, i.e. two
+            times the dimension '''
+        Persistent.__init__( self )
+        self.width = width
+        self.blocks = family.IO.BTree()
+
+    def _block(self, docid):
+        ''' Returns (key, block) of the block which holds docid or would hold it
+            or (None, None) if there are no blocks '''
+        blocks = self.blocks
+        try:
+            key = blocks.maxKey( docid )
+        except ValueError:
+            if not blocks:
+                return None, None
+            key = blocks.minKey()
+        return key, blocks[key]
+
+    def get(self, docid, default = None):
+        key, block = self._block( docid )
+        if block is None:
+            return default
+        i = block.find( docid )
+        if i < 0:
+            return default
+        return block.get( i )
+
+    def __getitem__(self, docid):
+        coordinates = self.get( docid )
+        if coordinates is None:
+            raise KeyError( docid )
+        return coordinates
+
+    def __contains__(self, docid):
+        return self.get( docid ) is not None
+
+    has_key = __contains__
+
+    def __setitem__(self, docid, coordinates):
+        if len(coordinates) > self.width:
+            raise ValueError( 'Expected at most %d coordinates, got %d' % (self.width, len(coordinates)) )
+        key, block = self._block( docid )
+        if block is None:
+            block = self.blocks[docid] = CoordinateBlock( self.width )
+        elif docid < key:
+            # the first block always has the smallest key
+            del self.blocks[key]
+            self.blocks[docid] = block
+        block.set( docid, coordinates )
+        if len(block) > self.blockSize:
+            upper = block.split()
+            self.blocks[upper.ids[0]] = upper
+
+    def pop(self, docid, *default):
+        key, block = self._block( docid )
+        i = block.find( docid ) if block is not None else -1
+        if i < 0:
+            if default:
+                return default[0]
+            raise KeyError( docid )
+        coordinates = block.get( i )
+        block.remove( i )
+        self._shrunk( key )
+        return coordinates
+
+    def __delitem__(self, docid):
+        self.pop( docid )
+
+    def update(self, items):
+        ''' Stores the (docid, coordinates) pairs of items, a mapping or a
+            sequence. Sorted items are stored block by block. '''
+        if hasattr( items, 'iteritems' ):
+            items = items.iteritems()
+        for docid, coordinates in items:
+            self[docid] = coordinates
+
+    def getMany(self, docids):
+        ''' Returns a list of (docid, coordinates) for the docids which are in
+            the map. Each block is looked up only once. '''
+        return self._many( docids, False )
+
+    def popMany(self, docids):
+        ''' Removes docids and returns a list of their (docid, coordinates), like
+            getMany() '''
+        return self._many( docids, True )
+
+    def _many(self, docids, remove):
+        found = []
+        shrunk = []
+        block = blockEnd = None
+        for docid in sorted( set( docids ) ):
+            if block is None or (blockEnd is not None and docid >= blockEnd):
+                key, block = self._block( docid )
+                if block is None:
+                    break
+                if remove:
+                    shrunk.append( key )
+                try:
+                    blockEnd = self.blocks.minKey( docid + 1 )
+                except ValueError:
+                    blockEnd = None
+            i = block.find( docid )
+            if i >= 0:
+                found.append( (docid, block.get( i )) )
+                if remove:
+                    block.remove( i )
+        for key in shrunk:
+            self._shrunk( key )
+        return found
+
+    def _shrunk(self, key):
+        ''' Called after docids were removed from the block at key. Deletes the
+            block if it is empty, merges it with its next or previous block if
+            it is less than half full and the two fit into one block. '''
+        blocks = self.blocks
+        block = blocks.get( key )
+        if block is None or len(block) >= self.blockSize // 2:
+            # merged into its previous block already
+            return
+        if not len(block):
+            del blocks[key]
+            block.discard()
+            return
+        try:
+            lowerKey, upperKey = key, blocks.minKey( key + 1 )
+        except ValueError:
+            try:
+                lowerKey, upperKey = blocks.maxKey( key - 1 ), key
+            except ValueError:
+                # the only block
+                return
+        lower, upper = blocks[lowerKey], blocks[upperKey]
+        if len(lower) + len(upper) > self.blockSize:
+            return
+        lower.merge( upper )
+        del blocks[upperKey]
+
+    def clear(self):
+        self.blocks.clear()
+
+    def __len__(self):
+        return sum( [ len(block) for block in self.blocks.values() ] )
+
+    def __nonzero__(self):
+        for block in self.blocks.values():
+            if len(block):
+                return True
+        return False
+
+    def iteritems(self):
+        for block in self.blocks.values():
+            for i, docid in enumerate( block.ids ):
+                yield docid, block.get( i )
+
+    def items(self):
+        return list( self.iteritems() )
+
+    def keys(self):
+        return [ docid for block in self.blocks.values() for docid in block.ids ]
+
+    def values(self):
+        return [ coordinates for docid, coordinates in self.iteritems() ]
+
+    def __iter__(self):
+        return iter( self.keys() )
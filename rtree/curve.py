@@ -0,0 +1,88 @@
+''' Space filling curves. They map n-d coordinates to a single integer in a way
+    that keeps coordinates which are close to each other close on the curve.
+    The index uses them to sort coordinates spatially, e.g. before inserting
+    many of them into the tree at once.
+'''
+
+def hilbertKey(point, bits = 16):
+    ''' Returns the position of an integer point on the hilbert curve. Each
+        coordinate must be in range(2 ** bits). Works for any dimension, this is
+        John Skilling's "transpose" algorithm.
+    '''
+    x = list(point)
+    n = len(x)
+    m = 1 << (bits - 1)
+    # inverse undo
+    q = m
+    while q > 1:
+        p = q - 1
+        for i in range(n):
+            if x[i] & q:
+                x[0] ^= p
+            else:
+                t = (x[0] ^ x[i]) & p
+                x[0] ^= t
+                x[i] ^= t
+        q >>= 1
+    # gray encode
+    for i in range(1, n):
+        x[i] ^= x[i - 1]
+    t = 0
+    q = m
+    while q > 1:
+        if x[n - 1] & q:
+            t ^= q - 1
+        q >>= 1
+    for i in range(n):
+        x[i] ^= t
+    return _interleaveBits(x, bits)
+
+def zorderKey(point, bits = 16):
+    ''' Returns the position of an integer point on the z-order (morton) curve.
+        Each coordinate must be in range(2 ** bits).
+    '''
+    return _interleaveBits(point, bits)
+
+def _interleaveBits(point, bits):
+    key = 0
+    for b in range(bits - 1, -1, -1):
+        for value in point:
+            key = (key << 1) | ((value >> b) & 1)
+    return key
+
+def center(coordinates, dimension, interleaved = True):
+    ''' Returns the center of a point or bounding box '''
+    if len(coordinates) == dimension:
+        return tuple(coordinates)
+    if interleaved:
+        return tuple( (coordinates[i] + coordinates[i + dimension]) / 2.0 for i in range(dimension) )
+    return tuple( (coordinates[2 * i] + coordinates[2 * i + 1]) / 2.0 for i in range(dimension) )
+
+def quantize(point, lows, highs, bits = 16):
+    ''' Maps a point within the box lows/highs to integer coordinates in
+        range(2 ** bits). Points outside the box are clamped.
+    '''
+    maxValue = (1 << bits) - 1
+    result = []
+    for value, low, high in zip(point, lows, highs):
+        extent = high - low
+        if extent <= 0:
+            result.append(0)
+            continue
+        value = int((value - low) / extent * maxValue)
+        result.append(min(max(value, 0), maxValue))
+    return result
+
+def spatialSort(entries, dimension, interleaved = True, bits = 16, keyFunction = hilbertKey):
+    ''' Returns the (id, coordinates) entries sorted along a space filling curve
+        through their centers.
+    '''
+    entries = list(entries)
+    if len(entries) < 2:
+        return entries
+    centers = [ center(coordinates, dimension, interleaved) for id, coordinates in entries ]
+    lows = [ min(c[i] for c in centers) for i in range(dimension) ]
+    highs = [ max(c[i] for c in centers) for i in range(dimension) ]
+    keys = [ keyFunction(quantize(c, lows, highs, bits), bits) for c in centers ]
+    order = sorted( range(len(entries)), key = keys.__getitem__ )
+    return [ entries[i] for i in order ]
@@ -7,28 +7,60 @@ class DataManager(object):
         def __init__(self, dataManager):
             self.dataManager = dataManager
             self.dataManager.clearBuffer( blockWrites = False )
+            overlay = self.dataManager.overlay
+            self.pages = dict( overlay ) if overlay is not None else None
+            pageStore = self.dataManager.pageStore
+            self.pageChanges = pageStore.changes.copy() if pageStore is not None else None
         
         def rollback(self):
             self.dataManager.clearBuffer( blockWrites = True )
+            self.dataManager.resetOverlay( self.pages )
+            self.dataManager.resetPageChanges( self.pageChanges )
 
     def __init__(self, spatialIndex):
         self.spatialIndex = spatialIndex
+        # the storage overlay of the index' tree, see Storage.overlay. It's
+        #  kept here because the index loses its tree when it is deactivated.
+        self.overlay = None
+        # the page store of the index if it lives outside of the database, its
+        #  changes are written when the transaction committed, see pagestore.py
+        self.pageStore = None
+        # set by tpc_finish and tpc_abort. The transaction calls abort() of all
+        #  its data managers again after its after commit hooks ran.
+        self.finished = False
         
     def clearBuffer(self, blockWrites):
         self.spatialIndex._clearBuffer( blockWrites )
+
+    def resetOverlay(self, pages = None):
+        overlay = self.overlay
+        if overlay is not None:
+            overlay.clear()
+            if pages:
+                overlay.update( pages )
         
-    def unregister(self):
-        self.spatialIndex._unregisterDataManager()
+    def resetPageChanges(self, changes = None):
+        if self.pageStore is not None:
+            self.pageStore.changes.reset( changes )
+
+    def unregister(self, committed = False):
+        self.spatialIndex._unregisterDataManager( committed )
 
     def abort(self, transaction):
+        if self.finished:
+            return
         self.clearBuffer( blockWrites = True )
+        self.resetOverlay()
+        self.resetPageChanges()
         self.unregister()
     
     def savepoint(self):
         return self.Savepoint(self)
 
     def tpc_begin(self, transaction):
+        self.spatialIndex._storeHeader()
         self.clearBuffer( blockWrites = False )
+        self.spatialIndex._flushOverlay()
 
     def commit(self, transaction):
         pass
@@ -37,9 +69,15 @@ class DataManager(object):
         pass
 
     def tpc_finish(self, transaction):
-        self.unregister()
+        self.finished = True
+        if self.pageStore is not None:
+            self.pageStore.commit()
+        self.unregister( committed = True )
 
     def tpc_abort(self, transaction):
+        self.finished = True
+        self.resetOverlay()
+        self.resetPageChanges()
         self.unregister()
 
     def sortKey(self):
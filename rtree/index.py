@@ -1,5 +1,7 @@
 # index for catalog    
 import baseIndex
+import sharded
+import pointindex
 
 import zope.interface
 import zope.catalog.attribute
@@ -16,3 +18,15 @@ class SpatialIndex(zope.catalog.attribute.AttributeIndex,
                    zope.container.contained.Contained):
 
     zope.interface.implements(ISpatialIndex)
+
+class ShardedSpatialIndex(zope.catalog.attribute.AttributeIndex,
+                          sharded.ShardedSpatialIndex,
+                          zope.container.contained.Contained):
+
+    zope.interface.implements(ISpatialIndex)
+
+class PointIndex(zope.catalog.attribute.AttributeIndex,
+                 pointindex.PointIndex,
+                 zope.container.contained.Contained):
+
+    zope.interface.implements(ISpatialIndex)
@@ -0,0 +1,87 @@
+''' Counters and timers for the page I/O and buffer flushes of the indexes.
+
+    Instrumentation is off by default. After enable() indexes create their
+    trees with an InstrumentedStorage (see storage.py), which counts and times
+    every page load, store and delete. The data manager adds the counters of a
+    transaction to the process wide totals of the index when the transaction
+    ends and passes them to the callbacks, e.g. to feed a metrics exporter.
+    Queries don't join the transaction, the counters of a transaction which
+    only queried an index are added when the index is used again or is
+    deactivated.
+
+    Trees which were created while instrumentation was disabled are not
+    instrumented, so a disabled instrumentation costs nothing.
+'''
+import threading
+
+enabled = False
+callbacks = []
+
+_lock = threading.Lock()
+_totals = {}
+
+
+class Counters(object):
+    """ The counters of one tree handle during one transaction. Times are in
+        seconds. """
+    names = ( 'loads', 'loadedBytes', 'loadTime', 'stores', 'storedBytes',
+              'storeTime', 'deletes', 'flushes', 'flushTime' )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name in self.names:
+            setattr( self, name, 0 )
+
+    def used(self):
+        return any( getattr( self, name ) for name in self.names )
+
+    def asDict(self):
+        return dict( (name, getattr( self, name )) for name in self.names )
+
+
+def enable(callback = None):
+    ''' Enables the instrumentation. callback( key, counters, committed ) is
+        called at the end of each transaction which used an index. key is the
+        (database name, oid) of the index, counters a dict. committed is None
+        if the transaction only queried the index, such transactions are
+        reported when the index is used in a later transaction or deactivated.
+    '''
+    global enabled
+    if callback is not None and callback not in callbacks:
+        callbacks.append( callback )
+    enabled = True
+
+def disable():
+    ''' Disables the instrumentation for trees created from now on and removes
+        all callbacks. '''
+    global enabled
+    enabled = False
+    del callbacks[:]
+
+def statistics():
+    ''' Returns the totals per index as a dict key -> counters dict '''
+    with _lock:
+        return dict( (key, dict(counters)) for key, counters in _totals.items() )
+
+def reset():
+    ''' Resets the totals of all indexes '''
+    with _lock:
+        _totals.clear()
+
+def record(key, counters, committed):
+    ''' Adds the Counters of a finished transaction to the totals of the index
+        key and resets them. '''
+    values = counters.asDict()
+    counters.reset()
+    with _lock:
+        totals = _totals.get( key )
+        if totals is None:
+            totals = _totals[key] = dict.fromkeys( Counters.names, 0 )
+            totals['transactions'] = 0
+        for name, value in values.items():
+            totals[name] += value
+        totals['transactions'] += 1
+    for callback in list( callbacks ):
+        callback( key, values, committed )
@@ -0,0 +1,280 @@
+''' Decoding of the pages libspatialindex hands to the custom storage.
+
+    The header page is the second page a new tree allocates, see headerPageId.
+    All other pages are nodes. The layouts below mirror
+    RTree::storeHeader() and Node::storeToByteArray(), all values are stored in
+    native byte order.
+
+    header: rootID (int64), variant (int32), fillFactor (double),
+            indexCapacity, leafCapacity, nearMinimumOverlapFactor (uint32),
+            splitDistributionFactor, reinsertFactor (double), dimension (uint32),
+            tightMBRs (char), nodes (uint32), data (uint64), treeHeight (uint32),
+            nodesInLevel (uint32 * treeHeight)
+
+    node:   nodeType (uint32), level (uint32), children (uint32),
+            children * ( low (double * dimension), high (double * dimension),
+                         id (int64), dataLength (uint32), data ),
+            node low (double * dimension), node high (double * dimension)
+'''
+import heapq
+import math
+import struct
+
+# a new tree stores its root node first and its header second, and Rtree
+#  opens an existing tree with the header at index_id 1
+headerPageId = 1
+
+PersistentIndex = 1
+PersistentLeaf = 2
+
+_headerFormat = struct.Struct( '=qidIIIddIBIQI' )
+_nodeFormat = struct.Struct( '=III' )
+_entryFormat = struct.Struct( '=qI' )
+_uint32 = struct.Struct( '=I' )
+
+
+class Header(object):
+    ''' The decoded header page '''
+    def __init__(self, data):
+        ( self.rootId, self.variant, self.fillFactor, self.indexCapacity,
+          self.leafCapacity, self.nearMinimumOverlapFactor,
+          self.splitDistributionFactor, self.reinsertFactor, self.dimension,
+          self.tightMBRs, self.nodes, self.data, self.treeHeight ) = _headerFormat.unpack_from( data )
+        offset = _headerFormat.size
+        self.nodesInLevel = list( struct.unpack_from( '=%dI' % self.treeHeight, data, offset ) )
+
+    def pack(self):
+        ''' Returns the header page data '''
+        return _headerFormat.pack( self.rootId, self.variant, self.fillFactor,
+                                   self.indexCapacity, self.leafCapacity,
+                                   self.nearMinimumOverlapFactor,
+                                   self.splitDistributionFactor, self.reinsertFactor,
+                                   self.dimension, self.tightMBRs, self.nodes,
+                                   self.data, self.treeHeight ) + \
+               struct.pack( '=%dI' % self.treeHeight, *self.nodesInLevel )
+
+    def sameStructure(self, other):
+        ''' Returns True if both headers describe a tree with the same root and
+            height, i.e. they only differ in the node and data counters '''
+        return self.rootId == other.rootId and self.treeHeight == other.treeHeight
+
+
+class Node(object):
+    ''' A decoded node page. Child i has the id ids[i] and the bounds
+        lows[i]/highs[i], the child's bounds start at offsets[i] in the page.
+        For index nodes the ids are page ids, for leaves they are docids.
+    '''
+    def __init__(self, pageId, data, dimension):
+        self.pageId = pageId
+        self.nodeType, self.level, children = _nodeFormat.unpack_from( data )
+        boundsFormat = struct.Struct( '=%dd' % dimension )
+        self.ids = []
+        self.lows = []
+        self.highs = []
+        self.offsets = []
+        offset = _nodeFormat.size
+        for i in xrange( children ):
+            self.offsets.append( offset )
+            self.lows.append( boundsFormat.unpack_from( data, offset ) )
+            offset += boundsFormat.size
+            self.highs.append( boundsFormat.unpack_from( data, offset ) )
+            offset += boundsFormat.size
+            id, dataLength = _entryFormat.unpack_from( data, offset )
+            offset += _entryFormat.size + dataLength
+            self.ids.append( id )
+        self.low = boundsFormat.unpack_from( data, offset )
+        self.high = boundsFormat.unpack_from( data, offset + boundsFormat.size )
+
+    isLeaf = property( lambda self: self.nodeType == PersistentLeaf )
+
+
+def childPageIds(data, dimension):
+    ''' Returns the page ids of the children of an index node page without
+        decoding their bounds, or an empty list for leaves '''
+    nodeType, level, children = _nodeFormat.unpack_from( data )
+    if nodeType != PersistentIndex:
+        return []
+    ids = []
+    boundsSize = 16 * dimension
+    offset = _nodeFormat.size + boundsSize
+    for i in xrange( children ):
+        id, dataLength = _entryFormat.unpack_from( data, offset )
+        ids.append( id )
+        offset += _entryFormat.size + dataLength + boundsSize
+    return ids
+
+def packBounds(lows, highs):
+    ''' Returns the bytes of the bounds of a child entry '''
+    values = tuple(lows) + tuple(highs)
+    return struct.pack( '=%dd' % len(values), *values )
+
+def toBounds(coordinates, dimension, interleaved = True):
+    ''' Splits point or bounding box coordinates into (lows, highs) '''
+    coordinates = [ float(value) for value in coordinates ]
+    if len(coordinates) == dimension:
+        return tuple(coordinates), tuple(coordinates)
+    if interleaved:
+        return tuple(coordinates[:dimension]), tuple(coordinates[dimension:])
+    return tuple(coordinates[0::2]), tuple(coordinates[1::2])
+
+def fromBounds(lows, highs, interleaved = True):
+    ''' Returns the bounding box coordinates of (lows, highs) '''
+    if interleaved:
+        return tuple(lows) + tuple(highs)
+    return tuple( [ value for bounds in zip( lows, highs ) for value in bounds ] )
+
+def contains(lows, highs, innerLows, innerHighs):
+    ''' Returns True if the box lows/highs contains the box innerLows/innerHighs '''
+    for low, high, innerLow, innerHigh in zip(lows, highs, innerLows, innerHighs):
+        if innerLow < low or innerHigh > high:
+            return False
+    return True
+
+def intersects(lowsA, highsA, lowsB, highsB):
+    ''' Returns True if the two boxes intersect, touching boxes intersect '''
+    for lowA, highA, lowB, highB in zip(lowsA, highsA, lowsB, highsB):
+        if lowA > highB or lowB > highA:
+            return False
+    return True
+
+def distance(lowsA, highsA, lowsB, highsB):
+    ''' Returns the euclidean distance between the closest points of two boxes '''
+    total = 0.0
+    for lowA, highA, lowB, highB in zip(lowsA, highsA, lowsB, highsB):
+        gap = max(0.0, lowB - highA, lowA - highB)
+        total += gap * gap
+    return math.sqrt(total)
+
+def overlapVolume(lowsA, highsA, lowsB, highsB):
+    ''' Returns the volume of the intersection of two boxes '''
+    volume = 1.0
+    for lowA, highA, lowB, highB in zip(lowsA, highsA, lowsB, highsB):
+        extent = min(highA, highB) - max(lowA, lowB)
+        if extent <= 0:
+            return 0.0
+        volume *= extent
+    return volume
+
+
+class TreeReader(object):
+    ''' Walks the tree by decoding the pages returned by readPage(pageId). The
+        C side buffer must have been flushed before, otherwise the pages might
+        be outdated.
+    '''
+    def __init__(self, readPage):
+        self.readPage = readPage
+        self.header = Header( readPage( headerPageId ) )
+        self.dimension = self.header.dimension
+
+    def node(self, pageId):
+        return Node( pageId, self.readPage( pageId ), self.dimension )
+
+    def root(self):
+        return self.node( self.header.rootId )
+
+    def entries(self):
+        ''' Yields (docid, lows, highs) for all entries of the tree '''
+        stack = [ self.header.rootId ]
+        while stack:
+            node = self.node( stack.pop() )
+            if node.isLeaf:
+                for i, id in enumerate( node.ids ):
+                    yield id, node.lows[i], node.highs[i]
+            else:
+                stack.extend( node.ids )
+
+    def findLeaf(self, docid, lows, highs):
+        ''' Returns (leaf, childIndex) of the entry docid with the given bounds or
+            None if there's no such entry. '''
+        stack = [ self.header.rootId ]
+        while stack:
+            node = self.node( stack.pop() )
+            for i, id in enumerate( node.ids ):
+                if node.isLeaf:
+                    if id == docid and node.lows[i] == lows and node.highs[i] == highs:
+                        return node, i
+                elif contains( node.lows[i], node.highs[i], lows, highs ):
+                    stack.append( id )
+        return None
+
+    def intersection(self, lows, highs, position = None):
+        ''' Yields (docid, position) for every entry which intersects the box
+            lows/highs, depth first in page order. The tree is only read as far
+            as the results are consumed. position is the live traversal state, a
+            list of [pageId, next child index] from the root down to the leaf of
+            docid. Pass a copy of it back in to resume after docid. '''
+        if position is None:
+            position = [ [self.header.rootId, 0] ]
+        else:
+            position = [ list(entry) for entry in position ]
+        nodes = [ self.node( pageId ) for pageId, i in position ]
+        while position:
+            node, entry = nodes[-1], position[-1]
+            i = entry[1]
+            if i >= len(node.ids):
+                position.pop()
+                nodes.pop()
+                continue
+            entry[1] += 1
+            if not intersects( lows, highs, node.lows[i], node.highs[i] ):
+                continue
+            if node.isLeaf:
+                yield node.ids[i], position
+            else:
+                position.append( [node.ids[i], 0] )
+                nodes.append( self.node( node.ids[i] ) )
+
+    def nearest(self, lows, highs, maxDistance = None):
+        ''' Yields (docid, distance) for the entries closest to the box
+            lows/highs in increasing distance, up to maxDistance. This is a best
+            first traversal, pages are only read as far as the results are
+            consumed. '''
+        # heap entries are (distance, sequence, isEntry, id), the sequence
+        #  number keeps the order of equally distant items stable
+        heap = [ (0.0, 0, False, self.header.rootId) ]
+        sequence = 1
+        while heap:
+            itemDistance, ignored, isEntry, id = heapq.heappop( heap )
+            if maxDistance is not None and itemDistance > maxDistance:
+                return
+            if isEntry:
+                yield id, itemDistance
+                continue
+            node = self.node( id )
+            for i, childId in enumerate( node.ids ):
+                childDistance = distance( lows, highs, node.lows[i], node.highs[i] )
+                if maxDistance is None or childDistance <= maxDistance:
+                    heapq.heappush( heap, (childDistance, sequence, node.isLeaf, childId) )
+                    sequence += 1
+
+    def within(self, lows, highs, maxDistance):
+        ''' Yields the ids of the entries within maxDistance of the box
+            lows/highs, depth first in page order. '''
+        stack = [ self.header.rootId ]
+        while stack:
+            node = self.node( stack.pop() )
+            for i, id in enumerate( node.ids ):
+                if distance( lows, highs, node.lows[i], node.highs[i] ) > maxDistance:
+                    continue
+                if node.isLeaf:
+                    yield id
+                else:
+                    stack.append( id )
+
+    def count(self, lows, highs, maxCount = None):
+        ''' Returns the number of entries which intersect the box lows/highs.
+            Stops and returns maxCount once maxCount entries were found. '''
+        count = 0
+        stack = [ self.header.rootId ]
+        while stack:
+            node = self.node( stack.pop() )
+            if not node.isLeaf:
+                stack.extend( [ id for i, id in enumerate( node.ids ) if intersects( lows, highs, node.lows[i], node.highs[i] ) ] )
+                continue
+            if node.ids and contains( lows, highs, node.low, node.high ):
+                count += len(node.ids)
+            else:
+                count += len( [ i for i in range( len(node.ids) ) if intersects( lows, highs, node.lows[i], node.highs[i] ) ] )
+            if maxCount is not None and count >= maxCount:
+                return maxCount
+        return count
@@ -0,0 +1,429 @@
+''' The stores for the pages of an index, see the page_store setting of
+    SpatialIndex.
+
+    By default the pages are kept in an IOBTree, i.e. in the database along
+    with the index. Indexes which don't have to be durable in the database,
+    e.g. scratch indexes or offline builds, can keep their pages in memory, in
+    an append-only local file or in a local SQLite table instead. These stores
+    have the part of the mapping api of the BTree which Storage and the index
+    use. They aren't part of the database's two phase commit: the pages an
+    index changes in a transaction are kept in a PageChanges and are written to
+    the store once the transaction committed, an abort drops them. A crash in
+    between loses them, like any other change of a store which isn't durable.
+    Their pages can't be merged like the buckets of a BTree either, so every
+    writer changes the index' StoreWriters and concurrent writers conflict.
+
+    Only the location of a store is pickled with the index. All stores of the
+    process with the same location share their pages, so the index can be
+    loaded by several connections. A memory store lives as long as the
+    process, so an index which uses one must not outlive the process.
+'''
+import mmap
+import os
+import struct
+import threading
+import uuid
+
+from persistent import Persistent
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+pageStores = ( 'btree', 'memory', 'file', 'sqlite' )
+
+_lock = threading.Lock()
+_openPages = {}         # (store class, location) -> the pages of the store
+
+
+def createPageStore(family, name, path = None):
+    ''' Returns a new page store, name is one of pageStores. The file and sqlite
+        stores need the path of their file. '''
+    if name == 'btree':
+        return family.IO.BTree()
+    if name == 'memory':
+        return MemoryPageStore()
+    if name not in pageStores:
+        raise ValueError( 'Unknown page store "%s"' % name )
+    if not path:
+        raise ValueError( 'The %s page store needs a page_store_path' % name )
+    if name == 'file':
+        return FilePageStore( path )
+    return SQLitePageStore( path )
+
+
+class MemoryPages(object):
+    """ The pages of a MemoryPageStore """
+    def __init__(self, location):
+        self.pages = {}
+
+    def get(self, pageId):
+        return self.pages.get( pageId )
+
+    def set(self, pageId, data):
+        self.pages[pageId] = data
+
+    def delete(self, pageId):
+        return self.pages.pop( pageId, None ) is not None
+
+    def keys(self):
+        return sorted( self.pages )
+
+    def clear(self):
+        self.pages.clear()
+
+    def sync(self):
+        pass
+
+    def __len__(self):
+        return len(self.pages)
+
+
+class PageFile(object):
+    """ The pages of a FilePageStore. The file is a log of records: the page id
+        and the length of the data followed by the data. The latest record of a
+        page wins, deleted pages are recorded with length -1. The offsets of the
+        current records are kept in memory and the data is read through a
+        memory map of the file. """
+    recordHeader = struct.Struct( '<qi' )
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self.file = open( self.path, 'a+b' )
+        self.map = None
+        self.offsets = {}       # page id -> (offset of the data, length)
+        self.size = 0
+        self._scan()
+
+    def _scan(self):
+        ''' Reads the offsets of the records, cuts off a record which was only
+            partly written '''
+        self.file.seek( 0, os.SEEK_END )
+        fileSize = self.file.tell()
+        headerSize = self.recordHeader.size
+        offset = 0
+        if fileSize:
+            view = self._mapped( fileSize )
+            while offset + headerSize <= fileSize:
+                pageId, length = self.recordHeader.unpack_from( view, offset )
+                if offset + headerSize + max( length, 0 ) > fileSize:
+                    break
+                if length < 0:
+                    self.offsets.pop( pageId, None )
+                else:
+                    self.offsets[pageId] = (offset + headerSize, length)
+                offset += headerSize + max( length, 0 )
+        if offset < fileSize:
+            self._unmap()
+            self.file.truncate( offset )
+        self.size = offset
+
+    def _mapped(self, end):
+        ''' Returns a map of the file which reaches at least up to end '''
+        view = self.map
+        if view is None or len(view) < end:
+            self._unmap()
+            self.file.flush()
+            view = self.map = mmap.mmap( self.file.fileno(), 0, access = mmap.ACCESS_READ )
+        return view
+
+    def _unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def _append(self, pageId, data, length):
+        self.file.write( self.recordHeader.pack( pageId, length ) + data )
+        self.size += self.recordHeader.size + len(data)
+
+    def get(self, pageId):
+        with self.lock:
+            entry = self.offsets.get( pageId )
+            if entry is None:
+                return None
+            offset, length = entry
+            return self._mapped( offset + length )[offset:offset + length]
+
+    def set(self, pageId, data):
+        with self.lock:
+            self._append( pageId, data, len(data) )
+            self.offsets[pageId] = (self.size - len(data), len(data))
+
+    def delete(self, pageId):
+        with self.lock:
+            if self.offsets.pop( pageId, None ) is None:
+                return False
+            self._append( pageId, '', -1 )
+            return True
+
+    def keys(self):
+        with self.lock:
+            return sorted( self.offsets )
+
+    def clear(self):
+        with self.lock:
+            self._unmap()
+            self.file.truncate( 0 )
+            self.offsets.clear()
+            self.size = 0
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync( self.file.fileno() )
+
+    def compact(self):
+        ''' Rewrites the file with the current records only '''
+        with self.lock:
+            compacted = open( self.path + '.compact', 'wb' )
+            try:
+                for pageId, (offset, length) in sorted( self.offsets.items() ):
+                    data = self._mapped( offset + length )[offset:offset + length]
+                    compacted.write( self.recordHeader.pack( pageId, length ) + data )
+                compacted.flush()
+                os.fsync( compacted.fileno() )
+            finally:
+                compacted.close()
+            self._unmap()
+            self.file.close()
+            os.rename( self.path + '.compact', self.path )
+            self._open()
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class PageTable(object):
+    """ The pages of a SQLitePageStore, a table with the page ids and data """
+    def __init__(self, path):
+        if sqlite3 is None:
+            raise ValueError( 'The sqlite page store needs the sqlite3 module' )
+        # the workers of parallel queries read pages, one at a time
+        self.connection = sqlite3.connect( path, check_same_thread = False )
+        self.lock = threading.Lock()
+        self.connection.execute( 'CREATE TABLE IF NOT EXISTS pages (id INTEGER PRIMARY KEY, data BLOB NOT NULL)' )
+        self.connection.commit()
+
+    def get(self, pageId):
+        with self.lock:
+            row = self.connection.execute( 'SELECT data FROM pages WHERE id = ?', (pageId,) ).fetchone()
+        return str(row[0]) if row is not None else None
+
+    def set(self, pageId, data):
+        with self.lock:
+            self.connection.execute( 'INSERT OR REPLACE INTO pages (id, data) VALUES (?, ?)', (pageId, sqlite3.Binary( data )) )
+
+    def delete(self, pageId):
+        with self.lock:
+            return self.connection.execute( 'DELETE FROM pages WHERE id = ?', (pageId,) ).rowcount > 0
+
+    def keys(self):
+        with self.lock:
+            return [ row[0] for row in self.connection.execute( 'SELECT id FROM pages ORDER BY id' ) ]
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute( 'DELETE FROM pages' )
+
+    def sync(self):
+        with self.lock:
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute( 'SELECT COUNT(*) FROM pages' ).fetchone()[0]
+
+
+class StoreWriters(Persistent):
+    """ Changed by every transaction which changes the pages of a PageStore.
+        It doesn't resolve conflicts, so of two concurrent writers of the store
+        the second one to commit gets a ConflictError and is retried. """
+    def __init__(self):
+        Persistent.__init__( self )
+        self.writers = 0
+
+    def join(self):
+        ''' Called once by every transaction which changes the store '''
+        self.writers += 1
+
+
+class PageChanges(object):
+    """ The pages an index changed in the current transaction, see
+        PageStore.changes """
+    def __init__(self, pages = None, cleared = False):
+        # page id -> data or None for deleted pages
+        self.pages = dict( pages or {} )
+        # True if all pages which were stored before were deleted
+        self.cleared = cleared
+
+    def copy(self):
+        return PageChanges( self.pages, self.cleared )
+
+    def reset(self, other = None):
+        self.pages.clear()
+        self.cleared = False
+        if other is not None:
+            self.pages.update( other.pages )
+            self.cleared = other.cleared
+
+
+class PageStore(object):
+    """ A store which keeps the pages outside of the database, with the mapping
+        api of the IOBTree it replaces. pagesClass opens the pages at a
+        location.
+        
+        While the index changes the store in a transaction, changes is set to
+        the PageChanges of the transaction (see DataManager). Writes go there,
+        reads see them, and commit() writes them to the pages. """
+    pagesClass = None
+    changes = None
+
+    def __init__(self, location):
+        self.location = location
+        self.pages = self._openPages()
+
+    def _openPages(self):
+        key = (self.__class__, self.location)
+        with _lock:
+            pages = _openPages.get( key )
+            if pages is None:
+                pages = _openPages[key] = self.pagesClass( self.location )
+        return pages
+
+    def __getstate__(self):
+        return dict( location = self.location )
+
+    def __setstate__(self, state):
+        self.location = state['location']
+        self.pages = self._openPages()
+
+    def _get(self, pageId):
+        changes = self.changes
+        if changes is not None:
+            if pageId in changes.pages:
+                return changes.pages[pageId]
+            if changes.cleared:
+                return None
+        return self.pages.get( pageId )
+
+    def get(self, pageId, default = None):
+        data = self._get( pageId )
+        if data is None:
+            return default
+        return data
+
+    def __getitem__(self, pageId):
+        data = self._get( pageId )
+        if data is None:
+            raise KeyError( pageId )
+        return data
+
+    def __setitem__(self, pageId, data):
+        if self.changes is not None:
+            self.changes.pages[pageId] = data
+        else:
+            self.pages.set( pageId, data )
+
+    def __delitem__(self, pageId):
+        if self.changes is not None:
+            if self._get( pageId ) is None:
+                raise KeyError( pageId )
+            self.changes.pages[pageId] = None
+        elif not self.pages.delete( pageId ):
+            raise KeyError( pageId )
+
+    def __contains__(self, pageId):
+        return self._get( pageId ) is not None
+
+    has_key = __contains__
+
+    def update(self, items):
+        if hasattr( items, 'iteritems' ):
+            items = items.iteritems()
+        for pageId, data in items:
+            self[pageId] = data
+
+    def keys(self):
+        changes = self.changes
+        if changes is None:
+            return self.pages.keys()
+        keys = set() if changes.cleared else set( self.pages.keys() )
+        for pageId, data in changes.pages.iteritems():
+            if data is None:
+                keys.discard( pageId )
+            else:
+                keys.add( pageId )
+        return sorted( keys )
+
+    def values(self):
+        return [ self._get( pageId ) for pageId in self.keys() ]
+
+    def items(self):
+        return [ (pageId, self._get( pageId )) for pageId in self.keys() ]
+
+    def __iter__(self):
+        return iter( self.keys() )
+
+    def maxKey(self):
+        keys = self.keys()
+        if not keys:
+            raise ValueError( 'empty page store' )
+        return keys[-1]
+
+    def clear(self):
+        if self.changes is not None:
+            self.changes.reset()
+            self.changes.cleared = True
+        else:
+            self.pages.clear()
+
+    def commit(self):
+        ''' Writes the changes to the pages and makes them durable, called
+            when the transaction committed '''
+        changes = self.changes
+        if changes is not None:
+            if changes.cleared:
+                self.pages.clear()
+            for pageId, data in sorted( changes.pages.items() ):
+                if data is None:
+                    self.pages.delete( pageId )
+                else:
+                    self.pages.set( pageId, data )
+            changes.reset()
+        self.pages.sync()
+
+    def __len__(self):
+        if self.changes is not None:
+            return len(self.keys())
+        return len(self.pages)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+
+class MemoryPageStore(PageStore):
+    """ Keeps the pages in memory until the process ends """
+    pagesClass = MemoryPages
+
+    def __init__(self, location = None):
+        PageStore.__init__( self, location or uuid.uuid4().hex )
+
+
+class FilePageStore(PageStore):
+    """ Appends the pages to a local file, location is its path. Rewritten
+        pages leave their old versions behind until compact() is called. """
+    pagesClass = PageFile
+
+    def compact(self):
+        self.pages.compact()
+
+
+class SQLitePageStore(PageStore):
+    """ Keeps the pages in a table of a local SQLite database, location is the
+        path of the database """
+    pagesClass = PageTable
@@ -0,0 +1,115 @@
+''' Runs the queries of one index in several threads.
+
+    Every worker thread queries its own read-only tree handle. ctypes releases
+    the GIL while the C library traverses the tree, so the traversals run in
+    parallel. The handles load their pages through the storage of the index's
+    main tree, i.e. through its page cache. A lock serializes those loads
+    because the database connection isn't thread safe, so the parallelism pays
+    off for pages which are cached or buffered by the handles already.
+
+    The calling thread waits until all workers are done, so the connection is
+    never used by two threads at the same time.
+'''
+import threading
+from multiprocessing.pool import ThreadPool
+
+from rtree.index import Rtree, CustomStorage
+
+# the number of worker threads of the process wide pool
+workers = 4
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+def getPool():
+    ''' Returns the process wide pool of worker threads '''
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ThreadPool( workers )
+        return _pool
+
+
+class SharedPageStorage(CustomStorage):
+    """ The storage of a read-only tree handle. Pages are read with readPage,
+        one thread at a time. Writes (the C library stores the header when the
+        tree is destroyed) are ignored. """
+    def __init__(self, readPage, lock):
+        CustomStorage.__init__( self )
+        self.readPage = readPage
+        self.lock = lock
+
+    def create(self, returnError):
+        pass
+
+    def destroy(self, returnError):
+        pass
+
+    def clear(self):
+        raise TypeError( 'The tree handle is read-only' )
+
+    def loadByteArray(self, page, returnError):
+        try:
+            with self.lock:
+                return self.readPage( int(page) )
+        except KeyError:
+            returnError.contents.value = self.InvalidPageError
+
+    def storeByteArray(self, page, data, returnError):
+        return page
+
+    def deleteByteArray(self, page, returnError):
+        pass
+
+    hasData = property( lambda self: True )
+
+
+class TreeHandles(object):
+    """ Read-only tree handles over the pages of one tree. The handles buffer
+        the pages they read, so they must be discarded when the pages change. """
+    def __init__(self, readPage, properties, interleaved):
+        self.readPage = readPage
+        self.properties = properties
+        self.interleaved = interleaved
+        self.lock = threading.Lock()
+        self.handles = []
+
+    def get(self, count):
+        ''' Returns count tree handles, creates them as needed '''
+        while len(self.handles) < count:
+            storage = SharedPageStorage( self.readPage, self.lock )
+            self.handles.append( Rtree( storage, properties = self.properties(), interleaved = self.interleaved ) )
+        return self.handles[:count]
+
+
+def split(lows, highs, parts):
+    ''' Splits the box lows/highs into at most parts boxes of equal size along
+        its longest axis. Returns a list of (lows, highs). '''
+    extents = [ high - low for low, high in zip( lows, highs ) ]
+    axis = extents.index( max( extents ) )
+    if parts < 2 or extents[axis] <= 0:
+        return [ (lows, highs) ]
+    step = extents[axis] / parts
+    boxes = []
+    for i in range( parts ):
+        boxLows, boxHighs = list(lows), list(highs)
+        boxLows[axis] = lows[axis] + i * step
+        if i < parts - 1:
+            boxHighs[axis] = lows[axis] + (i + 1) * step
+        boxes.append( (tuple(boxLows), tuple(boxHighs)) )
+    return boxes
+
+def run(handles, queries, query):
+    ''' Returns [ query( tree, coordinates ) for coordinates in queries ]. The
+        queries are split into one consecutive chunk per handle and every chunk
+        runs in a worker thread of the pool. '''
+    size = max( 1, -(-len(queries) // len(handles)) )
+    chunks = [ (handle, queries[i:i + size]) for handle, i in zip( handles, range( 0, len(queries), size ) ) ]
+    def runChunk(chunk):
+        tree, coordinates = chunk
+        return [ query( tree, window ) for window in coordinates ]
+    results = []
+    for chunkResults in getPool().map( runChunk, chunks ):
+        results.extend( chunkResults )
+    return results
@@ -0,0 +1,254 @@
+''' A spatial index for points which lives in BTrees only.
+
+    Every point is quantized to a grid over the extent of the index and mapped
+    to its position on a hilbert or z-order curve. The points are stored in an
+    OOBTree keyed by (curve position, docid). There are no pages, no buffer and
+    no data manager, and the BTrees resolve concurrent inserts and deletes of
+    different points, so writers rarely conflict.
+
+    A query window is decomposed into the grid cells which overlap it. Every
+    cell is one range of curve positions, the cells are refined until there
+    would be more than maxRanges of them. The points in the ranges are then
+    checked against the window, points in cells which lie within the window
+    don't need to be checked.
+'''
+import itertools
+
+from persistent import Persistent
+from persistent.dict import PersistentDict
+import BTrees
+from BTrees.Length import Length
+import zope.interface
+from zope.index import interfaces as zopeindexinterfaces
+
+from coordinates import CoordinateMap
+from curve import quantize, hilbertKey, zorderKey
+from pages import toBounds, fromBounds, contains, intersects, distance
+
+curves = dict( hilbert = hilbertKey, zorder = zorderKey )
+
+
+class PointIndex(Persistent):
+    ''' A spatial index for points with the api of SpatialIndex. Queries take
+        points or bounding boxes, only points can be indexed.
+    '''
+    zope.interface.implements(
+        zopeindexinterfaces.IInjection,
+        zopeindexinterfaces.IStatistics,
+        zopeindexinterfaces.IIndexSearch,
+        )
+
+    default_family = BTrees.family32
+    # the maximum number of curve ranges a query window is decomposed into
+    maxRanges = 32
+
+    def __init__(self, settings = {}, initialValuesGenerator = None, extent = None, curve = 'hilbert', bits = 16):
+        ''' Init. Of the settings only dimension, interleaved and family are
+            used. extent are the coordinates of a bounding box around the data,
+            it's divided into a grid of 2 ** bits cells per axis. Points outside
+            the extent are stored in the closest cell. curve is "hilbert" or
+            "zorder".
+        '''
+        Persistent.__init__( self )
+        if extent is None:
+            raise ValueError( 'The extent of the point index is required' )
+        if curve not in curves:
+            raise ValueError( 'Unknown curve "%s"' % curve )
+        settings = dict( settings )
+        self.family = settings.pop( 'family', self.default_family )
+        self.settings = PersistentDict( settings )
+        self.dimension = settings.get( 'dimension', 2 )
+        self.interleaved = settings.get( 'interleaved', True )
+        self.extent = toBounds( extent, self.dimension, self.interleaved )
+        self.curve = curve
+        self.bits = bits
+        self.points = self.family.OO.BTree()            # (curve position, docid) -> point
+        self.idToCoordinates = CoordinateMap( self.family, self.dimension )
+        self.numDocuments = Length()
+        if initialValuesGenerator is not None:
+            self.index_docs( (docid, coordinates) for docid, coordinates, obj in initialValuesGenerator )
+
+    def index_doc(self, docid, coordinates):
+        ''' Inserts the point coordinates, moves docid if it's indexed already.
+            Bounding boxes must have the same lows and highs. '''
+        self._indexPoint( docid, coordinates )
+
+    def unindex_doc(self, docid):
+        self._unindexPoint( docid )
+
+    def _indexPoint(self, docid, coordinates):
+        ''' index_doc() for the batch methods. The catalog index classes
+            override index_doc() to take the coordinates from an object. '''
+        point = self._point( coordinates )
+        oldPoint = self.idToCoordinates.get( docid )
+        if oldPoint is not None:
+            if oldPoint == point:
+                return
+            del self.points[ (self._position( oldPoint ), docid) ]
+        else:
+            self.numDocuments.change( 1 )
+        self.points[ (self._position( point ), docid) ] = point
+        self.idToCoordinates[docid] = point
+
+    def _unindexPoint(self, docid):
+        point = self.idToCoordinates.pop( docid, None )
+        if point is None:
+            # docid was not indexed
+            return
+        del self.points[ (self._position( point ), docid) ]
+        self.numDocuments.change( -1 )
+
+    def index_docs(self, docs, chunkSize = 10000):
+        ''' Inserts many (docid, coordinates) pairs at once. chunkSize is
+            accepted for compatibility with SpatialIndex. '''
+        for docid, coordinates in sorted( dict( docs ).iteritems() ):
+            self._indexPoint( docid, coordinates )
+
+    def unindex_docs(self, docids, chunkSize = 10000):
+        for docid in sorted( set( docids ) ):
+            self._unindexPoint( docid )
+
+    def clear(self):
+        self.points.clear()
+        self.idToCoordinates.clear()
+        self.numDocuments.set( 0 )
+
+    def documentCount(self):
+        """See interface IStatistics"""
+        return self.numDocuments()
+
+    def wordCount(self):
+        """See interface IStatistics"""
+        return 0
+
+    def apply(self, queryName, *args, **keys):
+        if queryName == 'intersection' and not keys:
+            return self.family.IF.multiunion( list( self.intersection( *args ) ) )
+        queryFunc = getattr( self, queryName )
+        return self.family.IF.Set( queryFunc( *args, **keys ) )
+
+    def count(self, coordinates):
+        ''' Counts the number of points within coordinates '''
+        lows, highs = toBounds( coordinates, self.dimension, self.interleaved )
+        count = 0
+        for first, last, inside in self._ranges( lows, highs ):
+            entries = self.points.items( (first,), (last + 1,), excludemax = True )
+            if inside:
+                count += len(entries)
+            else:
+                count += len( [ key for key, point in entries if contains( lows, highs, point, point ) ] )
+        return count
+
+    def intersection(self, coordinates):
+        ''' Returns all docids whose points are within the given bounds. '''
+        lows, highs = toBounds( coordinates, self.dimension, self.interleaved )
+        for docid, point in self._within( lows, highs ):
+            yield docid
+
+    def nearest(self, coordinates, num_results = 1):
+        ''' Returns the num_results docids which are closest to coordinates.
+            Searches windows around coordinates which grow until they hold
+            num_results points which are closer than the window's border. '''
+        lows, highs = toBounds( coordinates, self.dimension, self.interleaved )
+        extentLows, extentHighs = self.extent
+        size = max( [ high - low for low, high in zip( extentLows, extentHighs ) ] ) or 1.0
+        radius = size / (1 << (self.bits // 2))
+        documents = self.documentCount()
+        while True:
+            windowLows = [ low - radius for low in lows ]
+            windowHighs = [ high + radius for high in highs ]
+            candidates = [ (distance( lows, highs, point, point ), docid)
+                           for docid, point in self._within( windowLows, windowHighs ) ]
+            candidates.sort()
+            if len(candidates) >= num_results and candidates[num_results - 1][0] <= radius or len(candidates) == documents:
+                break
+            radius *= 4
+        for docDistance, docid in candidates[:num_results]:
+            yield docid
+
+    def get_bounds(self, coordinate_interleaved = None):
+        ''' Returns the bounds of all points or None if the index is empty.
+            This visits all points. '''
+        points = self.idToCoordinates.values()
+        if not points:
+            return None
+        lows = [ min( [ point[axis] for point in points ] ) for axis in range( self.dimension ) ]
+        highs = [ max( [ point[axis] for point in points ] ) for axis in range( self.dimension ) ]
+        if coordinate_interleaved is None:
+            coordinate_interleaved = self.interleaved
+        return list( fromBounds( lows, highs, coordinate_interleaved ) )
+
+    bounds = property( get_bounds )
+
+    # implementation helpers
+
+    def _point(self, coordinates):
+        ''' Returns the point of coordinates as a tuple of floats '''
+        lows, highs = toBounds( coordinates, self.dimension, self.interleaved )
+        if lows != highs:
+            raise ValueError( 'Only points can be indexed, got %r' % (coordinates,) )
+        return lows
+
+    def _position(self, point):
+        ''' Returns the position of point on the curve '''
+        extentLows, extentHighs = self.extent
+        return curves[self.curve]( quantize( point, extentLows, extentHighs, self.bits ), self.bits )
+
+    def _within(self, lows, highs):
+        ''' Yields (docid, point) for the points within the box lows/highs '''
+        for first, last, inside in self._ranges( lows, highs ):
+            for (position, docid), point in self.points.items( (first,), (last + 1,), excludemax = True ):
+                if inside or contains( lows, highs, point, point ):
+                    yield docid, point
+
+    def _ranges(self, lows, highs):
+        ''' Returns a sorted list of (first, last, inside) curve position ranges
+            which hold all points within the box lows/highs. inside is True if
+            all points of the range are within the box. '''
+        bits, dimension = self.bits, self.dimension
+        extentLows, extentHighs = self.extent
+        gridLows = quantize( lows, extentLows, extentHighs, bits )
+        gridHighs = quantize( highs, extentLows, extentHighs, bits )
+        # the points in the grid cells on the border of the window may be
+        #  outside of it, all others are within
+        innerLows = [ low + 1 for low in gridLows ]
+        innerHighs = [ high - 1 for high in gridHighs ]
+        # the cells are (level, lows of the cell in grid coordinates), a cell of
+        #  level l is 2 ** (bits - l) grid cells wide
+        covered = []
+        partial = [ (0,) * dimension ]
+        level = 0
+        while partial and level < bits:
+            size = 1 << (bits - level - 1)
+            inside, overlapping = [], []
+            for cellLows in partial:
+                for offsets in itertools.product( (0, size), repeat = dimension ):
+                    childLows = tuple( [ low + offset for low, offset in zip( cellLows, offsets ) ] )
+                    childHighs = tuple( [ low + size - 1 for low in childLows ] )
+                    if not intersects( gridLows, gridHighs, childLows, childHighs ):
+                        continue
+                    if contains( innerLows, innerHighs, childLows, childHighs ):
+                        inside.append( childLows )
+                    else:
+                        overlapping.append( childLows )
+            if len(covered) + len(inside) + len(overlapping) > self.maxRanges:
+                break
+            level += 1
+            covered.extend( [ (level, cellLows, True) for cellLows in inside ] )
+            partial = overlapping
+        cells = covered + [ (level, cellLows, False) for cellLows in partial ]
+        ranges = []
+        key = curves[self.curve]
+        for cellLevel, cellLows, inside in cells:
+            shift = dimension * (bits - cellLevel)
+            # all grid cells of a cell share the leading bits of their position
+            prefix = key( cellLows, bits ) >> shift
+            ranges.append( (prefix << shift, ((prefix + 1) << shift) - 1, inside) )
+        ranges.sort()
+        merged = []
+        for first, last, inside in ranges:
+            if merged and merged[-1][1] + 1 == first and merged[-1][2] == inside:
+                merged[-1] = (merged[-1][0], last, inside)
+            else:
+                merged.append( (first, last, inside) )
+        return merged
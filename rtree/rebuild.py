@@ -0,0 +1,97 @@
+''' The state of an online rebuild, see SpatialIndex.rebuild().
+
+    A rebuild bulk loads a fresh tree from idToCoordinates in memory and copies
+    its pages to a shadow pageData in many small transactions. Meanwhile the
+    index keeps working with the old tree, and the writers record the
+    coordinates every docid had before they changed it in the index'
+    ChangeLog. The last transaction swaps the shadow pageData in and applies
+    the logged changes to the new tree.
+'''
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+from rtree.index import Rtree
+import BTrees
+
+from storage import Storage, PageIdAllocator
+
+
+class ChangeLog(Persistent):
+    """ The docids changed while an index is rebuilt. changes maps docid ->
+        the coordinates before the first change, () if the docid was not
+        indexed.
+        
+        Every transaction which changes the index joins the log, rebuilding or
+        not. The transactions which start, finish or cancel a rebuild change
+        the epoch, and a writer conflicts with them if it joined in another
+        epoch: a writer which started before the rebuild didn't log its
+        changes, the changes of a writer which started before the rebuild
+        finished would be logged too late. Writers of the same epoch are
+        merged. """
+    def __init__(self):
+        Persistent.__init__( self )
+        self.changes = {}
+        self.epoch = 0
+        # the number of transactions which joined, so every writer changes the log
+        self.writers = 0
+
+    def join(self):
+        ''' Called once by every transaction which changes the index '''
+        self.writers += 1
+
+    def record(self, entries):
+        ''' Records the (docid, coordinates before the change) entries, the
+            coordinates are None for docids which are not indexed '''
+        changes = self.changes
+        for docid, coordinates in entries:
+            if docid not in changes:
+                changes[docid] = tuple(coordinates) if coordinates is not None else ()
+        self._p_changed = True
+
+    def newEpoch(self):
+        ''' Called when a rebuild starts, finishes or is cancelled. Forgets the
+            changes. '''
+        self.epoch += 1
+        self.changes = {}
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        if not oldState['epoch'] == savedState['epoch'] == newState['epoch']:
+            raise ConflictError
+        changes = dict( savedState['changes'] )
+        for docid, coordinates in newState['changes'].items():
+            if docid not in oldState['changes']:
+                changes.setdefault( docid, coordinates )
+        state = dict( savedState )
+        state['changes'] = changes
+        state['writers'] = savedState['writers'] + newState['writers'] - oldState['writers']
+        return state
+
+
+class Rebuild(Persistent):
+    """ A rebuild in progress. pageIds is the allocator of the new tree. """
+    def __init__(self, family, pageIds, pageCount):
+        Persistent.__init__( self )
+        self.pageData = family.IO.BTree()
+        self.pageIds = pageIds
+        self.pageCount = pageCount
+        self.copiedPages = 0
+
+
+def buildPages(index):
+    ''' Bulk loads a tree with the documents of index in memory. Returns (pages,
+        pageIds), pages is a dict page id -> page as pageData stores it. '''
+    pages = {}
+    settings = index.settings
+    pageIds = PageIdAllocator( index.family, randomIds = settings.get( 'random_page_ids', False ) )
+    storage = Storage( pages, pageIds, convertToInt = (index.family == BTrees.family32) )
+    storage.compressor = index._getCompressor()
+    storage.pageObjects = index._pageObjects()
+    properties = index._getProperties()
+    interleaved = settings.get( 'interleaved', True )
+    if index.idToCoordinates:
+        entries = ( (docid, coordinates, None) for docid, coordinates in index.idToCoordinates.iteritems() )
+        tree = Rtree( storage, entries, properties = properties, interleaved = interleaved )
+    else:
+        tree = Rtree( storage, properties = properties, interleaved = interleaved )
+    # the tree stores its header when it's destroyed
+    del tree
+    return pages, pageIds
@@ -0,0 +1,343 @@
+''' A spatial index which is split into several shards.
+
+    Every shard is a SpatialIndex with its own pages, header and counters, so
+    writers which change different regions don't conflict. A partitioning maps
+    the center of the coordinates of a document to its shard:
+
+        grid        a regular grid over the extent
+        hilbert     ranges of the hilbert curve through the extent. Bulk loads
+                    into an empty index choose the ranges so every shard gets
+                    the same number of documents.
+        quadtree    the extent is split into quadrants (octants, ...) until
+                    there are at most shards cells. Bulk loads into an empty
+                    index split the cells with the most documents first.
+
+    A document is stored in exactly one shard, even if its bounds cross into
+    other shards' cells. Queries use the actual bounds of the shards' trees, so
+    they find such documents, and they only visit the shards which overlap the
+    query window.
+'''
+import bisect
+import multiprocessing
+
+from persistent import Persistent
+from persistent.dict import PersistentDict
+import BTrees
+import zope.interface
+from zope.index import interfaces as zopeindexinterfaces
+
+from baseIndex import SpatialIndex
+from curve import center, quantize, hilbertKey
+from pages import toBounds, fromBounds, intersects, distance
+
+
+class GridPartitioning(object):
+    """ Splits the extent into a regular grid with the same number of cells
+        along every axis """
+    bits = 16
+
+    def __init__(self, lows, highs, shards):
+        self.lows, self.highs = tuple(lows), tuple(highs)
+        self.cells = max( 1, int( round( shards ** (1.0 / len(lows)) ) ) )
+        self.shardCount = self.cells ** len(lows)
+
+    def fit(self, centers):
+        return self
+
+    def shardOf(self, point):
+        shard = 0
+        for value in reversed( quantize( point, self.lows, self.highs, self.bits ) ):
+            shard = shard * self.cells + ( (value * self.cells) >> self.bits )
+        return shard
+
+
+class HilbertPartitioning(object):
+    """ Splits the hilbert curve through the extent into shards ranges """
+    bits = 16
+
+    def __init__(self, lows, highs, shards, boundaries = None):
+        self.lows, self.highs = tuple(lows), tuple(highs)
+        self.shardCount = shards
+        if boundaries is None:
+            size = 1 << (self.bits * len(lows))
+            boundaries = [ size * i // shards for i in range( 1, shards ) ]
+        self.boundaries = boundaries
+
+    def key(self, point):
+        return hilbertKey( quantize( point, self.lows, self.highs, self.bits ), self.bits )
+
+    def fit(self, centers):
+        ''' Returns a partitioning with ranges holding equally many centers '''
+        keys = sorted( [ self.key( point ) for point in centers ] )
+        if len(keys) < self.shardCount:
+            return self
+        boundaries = [ keys[len(keys) * i // self.shardCount] for i in range( 1, self.shardCount ) ]
+        return HilbertPartitioning( self.lows, self.highs, self.shardCount, boundaries )
+
+    def shardOf(self, point):
+        return bisect.bisect_right( self.boundaries, self.key( point ) )
+
+
+class QuadtreePartitioning(object):
+    """ Splits the extent into quadrants recursively, the cell with the most
+        centers (or the biggest one) first, as long as there are at most shards
+        cells """
+    def __init__(self, lows, highs, shards, centers = ()):
+        self.lows, self.highs = tuple(lows), tuple(highs)
+        self.maxShards = shards
+        dimension = len(lows)
+        fanout = 2 ** dimension
+        cells = [ (self.lows, self.highs, list(centers)) ]
+        while len(cells) + fanout - 1 <= shards:
+            i = max( range( len(cells) ), key = lambda i: ( len(cells[i][2]), _volume( cells[i][0], cells[i][1] ) ) )
+            cellLows, cellHighs, points = cells.pop( i )
+            middle = [ (low + high) / 2.0 for low, high in zip( cellLows, cellHighs ) ]
+            for corner in range( fanout ):
+                upper = [ bool( corner >> axis & 1 ) for axis in range( dimension ) ]
+                childLows = tuple( [ middle[axis] if upper[axis] else cellLows[axis] for axis in range( dimension ) ] )
+                childHighs = tuple( [ cellHighs[axis] if upper[axis] else middle[axis] for axis in range( dimension ) ] )
+                childPoints = [ point for point in points
+                                if all( (point[axis] >= middle[axis]) == upper[axis] for axis in range( dimension ) ) ]
+                cells.append( (childLows, childHighs, childPoints) )
+        self.cells = [ (cellLows, cellHighs) for cellLows, cellHighs, points in cells ]
+        self.shardCount = len(self.cells)
+
+    def fit(self, centers):
+        return QuadtreePartitioning( self.lows, self.highs, self.maxShards, centers )
+
+    def shardOf(self, point):
+        point = [ min( max( value, low ), high ) for value, low, high in zip( point, self.lows, self.highs ) ]
+        for shard, (cellLows, cellHighs) in enumerate( self.cells ):
+            # cells contain their lower but not their upper bounds, except at
+            #  the upper bounds of the extent
+            if all( low <= value and (value < high or high == top)
+                    for value, low, high, top in zip( point, cellLows, cellHighs, self.highs ) ):
+                return shard
+        return 0
+
+
+partitionings = dict( grid = GridPartitioning, hilbert = HilbertPartitioning, quadtree = QuadtreePartitioning )
+
+
+class ShardedSpatialIndex(Persistent):
+    ''' A spatial index which stores its documents in several SpatialIndex
+        shards. It has the same api as SpatialIndex.
+    '''
+    zope.interface.implements(
+        zopeindexinterfaces.IInjection,
+        zopeindexinterfaces.IStatistics,
+        zopeindexinterfaces.IIndexSearch,
+        )
+
+    default_family = BTrees.family32
+
+    def __init__(self, settings = {}, initialValuesGenerator = None, extent = None, shards = 4, partitioning = 'grid'):
+        ''' Init. settings are the settings of the shards, see SpatialIndex.
+            extent are the coordinates of a bounding box around the data, it's
+            used to partition the space into at most shards parts. Documents
+            outside of the extent are stored in the shard of the closest part.
+            partitioning is "grid", "hilbert" or "quadtree".
+        '''
+        Persistent.__init__( self )
+        if extent is None:
+            raise ValueError( 'The extent of the sharded index is required' )
+        if partitioning not in partitionings:
+            raise ValueError( 'Unknown partitioning "%s"' % partitioning )
+        settings = dict( settings )
+        self.family = settings.pop( 'family', self.default_family )
+        self.settings = PersistentDict( settings )
+        self.dimension = settings.get( 'dimension', 2 )
+        self.interleaved = settings.get( 'interleaved', True )
+        lows, highs = toBounds( extent, self.dimension, self.interleaved )
+        self.partitioning = partitionings[partitioning]( lows, highs, shards )
+        self.shards = tuple( [ self._createShard( i ) for i in range( self.partitioning.shardCount ) ] )
+        if initialValuesGenerator is not None:
+            self.index_docs( (docid, coordinates) for docid, coordinates, obj in initialValuesGenerator )
+
+    def _createShard(self, number):
+        ''' Returns a new shard. The page stores outside of the database get a
+            location of their own for every shard, page_store_path.number '''
+        settings = dict( self.settings, family = self.family )
+        path = settings.get( 'page_store_path' )
+        if path:
+            settings['page_store_path'] = '%s.%d' % (path, number)
+        return SpatialIndex( settings )
+
+    def index_doc(self, docid, coordinates):
+        ''' Inserts docid into the shard of coordinates, moves it if it was in
+            another shard '''
+        shard = self._route( coordinates )
+        if docid not in shard.idToCoordinates:
+            self._unindexElsewhere( docid, shard )
+        shard.index_doc( docid, coordinates )
+
+    def unindex_doc(self, docid):
+        for shard in self.shards:
+            if docid in shard.idToCoordinates:
+                shard.unindex_doc( docid )
+                return
+
+    def index_docs(self, docs, chunkSize = 10000, processes = None):
+        ''' Inserts many (docid, coordinates) pairs at once. Adaptive
+            partitionings are fitted to the documents if the index is empty.
+            If processes is given, the shards which are empty are bulk loaded in
+            that many worker processes.
+        '''
+        docs = dict( docs )
+        if not docs:
+            return
+        empty = not self.documentCount()
+        if empty:
+            centers = [ center( coordinates, self.dimension, self.interleaved ) for coordinates in docs.itervalues() ]
+            self.partitioning = self.partitioning.fit( centers )
+        groups = [ [] for shard in self.shards ]
+        for docid, coordinates in docs.iteritems():
+            shard = self.partitioning.shardOf( center( coordinates, self.dimension, self.interleaved ) )
+            groups[shard].append( (docid, coordinates) )
+            if not empty and docid not in self.shards[shard].idToCoordinates:
+                self._unindexElsewhere( docid, self.shards[shard] )
+        built = []
+        if processes:
+            built = [ i for i, group in enumerate( groups ) if group and not self.shards[i].documentCount() ]
+            self._buildShards( [ (i, groups[i]) for i in built ], processes )
+        for i, group in enumerate( groups ):
+            if group and i not in built:
+                self.shards[i].index_docs( group, chunkSize )
+
+    def unindex_docs(self, docids, chunkSize = 10000):
+        docids = list( docids )
+        for shard in self.shards:
+            shard.unindex_docs( [ docid for docid in docids if docid in shard.idToCoordinates ], chunkSize )
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def documentCount(self):
+        """See interface IStatistics"""
+        return sum( [ shard.documentCount() for shard in self.shards ] )
+
+    def wordCount(self):
+        """See interface IStatistics"""
+        return 0
+
+    def statistics(self):
+        ''' Returns a dict with the number of documents and the statistics() of
+            every shard. This visits all pages of all shards. '''
+        return dict( documents = self.documentCount(),
+                     shards = [ shard.statistics() for shard in self.shards ] )
+
+    def apply(self, queryName, *args, **keys):
+        if queryName == 'intersection' and not keys:
+            ids = []
+            for shard in self._shardsWithin( args[0] ):
+                ids.extend( shard._intersectionIds( args[0] ) )
+            return self.family.IF.multiunion( ids )
+        queryFunc = getattr( self, queryName )
+        return self.family.IF.Set( queryFunc( *args, **keys ) )
+
+    def count(self, coordinates):
+        ''' Counts the number of objects within coordinates '''
+        return sum( [ shard.count( coordinates ) for shard in self._shardsWithin( coordinates ) ] )
+
+    def intersection(self, coordinates):
+        ''' Returns all docids which are within the given bounds. '''
+        for shard in self._shardsWithin( coordinates ):
+            for id in shard.intersection( coordinates ):
+                yield id
+
+    def nearest(self, coordinates, num_results = 1):
+        ''' Returns the num_results docids which are closest to coordinates.
+            The shards are visited by their distance to coordinates until no
+            closer documents can be found. '''
+        lows, highs = toBounds( coordinates, self.dimension, self.interleaved )
+        shards = sorted( [ (distance( lows, highs, shardLows, shardHighs ), i)
+                           for i, (shardLows, shardHighs) in self._shardBounds() ] )
+        candidates = []
+        for shardDistance, i in shards:
+            if len(candidates) >= num_results and shardDistance > candidates[num_results - 1][0]:
+                break
+            shard = self.shards[i]
+            for docid in shard.nearest( coordinates, num_results ):
+                docLows, docHighs = toBounds( shard.idToCoordinates[docid], self.dimension, self.interleaved )
+                candidates.append( (distance( lows, highs, docLows, docHighs ), docid) )
+            candidates.sort()
+        for docDistance, docid in candidates[:num_results]:
+            yield docid
+
+    def leaves(self):
+        for shard in self.shards:
+            if shard.documentCount():
+                for leaf in shard.leaves():
+                    yield leaf
+
+    def get_bounds(self, coordinate_interleaved = None):
+        ''' Returns the bounds of all shards or None if the index is empty '''
+        bounds = [ shardBounds for i, shardBounds in self._shardBounds() ]
+        if not bounds:
+            return None
+        lows = [ min( [ shardLows[axis] for shardLows, shardHighs in bounds ] ) for axis in range( self.dimension ) ]
+        highs = [ max( [ shardHighs[axis] for shardLows, shardHighs in bounds ] ) for axis in range( self.dimension ) ]
+        if coordinate_interleaved is None:
+            coordinate_interleaved = self.interleaved
+        return list( fromBounds( lows, highs, coordinate_interleaved ) )
+
+    bounds = property( get_bounds )
+
+    # implementation helpers
+
+    def _route(self, coordinates):
+        return self.shards[ self.partitioning.shardOf( center( coordinates, self.dimension, self.interleaved ) ) ]
+
+    def _unindexElsewhere(self, docid, shard):
+        ''' Removes docid from all shards but shard '''
+        for other in self.shards:
+            if other is not shard and docid in other.idToCoordinates:
+                other.unindex_doc( docid )
+                return
+
+    def _shardBounds(self):
+        ''' Yields (shard number, (lows, highs)) for every non-empty shard '''
+        for i, shard in enumerate( self.shards ):
+            if shard.documentCount():
+                yield i, toBounds( shard.bounds, self.dimension, self.interleaved )
+
+    def _shardsWithin(self, coordinates):
+        ''' Returns the shards whose bounds overlap coordinates '''
+        lows, highs = toBounds( coordinates, self.dimension, self.interleaved )
+        return [ self.shards[i] for i, (shardLows, shardHighs) in self._shardBounds()
+                 if intersects( lows, highs, shardLows, shardHighs ) ]
+
+    def _buildShards(self, groups, processes):
+        ''' Bulk loads the empty shards of groups, a list of (shard number,
+            docs), in worker processes and copies the pages into the shards '''
+        familyBits = 32 if self.family == BTrees.family32 else 64
+        # the workers build the pages in memory, the shards store them
+        tasks = [ (dict( self.settings, page_store = 'btree', page_store_path = None ), familyBits, docs) for i, docs in groups ]
+        pool = multiprocessing.Pool( processes )
+        try:
+            results = pool.map( _buildShard, tasks )
+        finally:
+            pool.close()
+            pool.join()
+        for (i, docs), (pages, nextPageId) in zip( groups, results ):
+            shard = self.shards[i]
+            shard._replacePages( pages, nextPageId )
+            shard.idToCoordinates.update( sorted( docs ) )
+            shard._changeDocumentCount( len(docs) )
+
+
+def _buildShard(task):
+    ''' Runs in a worker process. Bulk loads a new tree and returns its pages
+        and next page id. '''
+    settings, familyBits, docs = task
+    settings['family'] = BTrees.family32 if familyBits == 32 else BTrees.family64
+    index = SpatialIndex( settings, ( (docid, coordinates, None) for docid, coordinates in docs ) )
+    index._clearBuffer( False )
+    return dict( index.pageData.items() ), index.pageIds.counter()
+
+def _volume(lows, highs):
+    volume = 1.0
+    for low, high in zip( lows, highs ):
+        volume *= high - low
+    return volume
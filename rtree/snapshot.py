@@ -0,0 +1,216 @@
+''' Read-only snapshots of an index in a local file.
+
+    exportSnapshot() writes the committed state of a SpatialIndex (its tree
+    pages and its docid -> coordinates mapping) to a file. SnapshotIndex serves
+    queries from such a file through mmap, so it doesn't need a database
+    connection, and all processes on a host which open the same file share its
+    pages through the OS page cache. Use this for read-heavy front ends which
+    can live with a recent instead of the current view of the index. The
+    snapshot knows the transaction id of the index state it was taken from, so
+    a replica can check whether it needs a new one.
+
+    File layout, all numbers little endian:
+
+        header          magic, tid, page count, document count, offset of the
+                        page table, offset of the coordinates, length of the
+                        meta data
+        meta data       JSON with the settings, family and dimension
+        pages           the uncompressed page data as the C library stores it
+        page table      (page id int64, offset uint64, length uint32) per page
+        coordinates     (docid int64, number of values uint8, 2 * dimension
+                        doubles) per document, sorted by docid. Points use only
+                        the first half of the doubles.
+'''
+import json
+import mmap
+import os
+import struct
+
+from rtree.index import Rtree, Property, CustomStorage
+import BTrees
+from array import array
+
+from baseIndex import indexSettings, _intersectionIds
+
+magic = 'ZSISNAP1'
+_header = struct.Struct( '<8s8sQQQQI' )
+_pageEntry = struct.Struct( '<qQI' )
+
+
+def exportSnapshot(index, path):
+    ''' Writes the committed state of index to path and returns the transaction
+        id of that state. The file is written next to path and renamed, so
+        readers never see a partial snapshot. '''
+    generation = index.generation
+    if getattr( index, '_v_dataManagerRegistered', False ) or index._p_jar is None or \
+            ( generation is not None and ( generation._p_changed or generation._p_jar is None ) ):
+        # changed in this transaction or never committed
+        raise ValueError( 'The index has uncommitted changes' )
+    tid = generation._p_serial if generation is not None else index._p_serial
+    storage = index.tree.customstorage
+    settings = dict( (name, value) for name, value in index.settings.items() if name == 'interleaved' or name not in indexSettings )
+    dimension = index.tree.properties.dimension
+    meta = json.dumps( dict( settings = settings, dimension = dimension,
+                             family = 32 if index.family == BTrees.family32 else 64 ) )
+    coordinate = struct.Struct( '<qB%dd' % (2 * dimension) )
+
+    temporaryPath = path + '.tmp'
+    f = open( temporaryPath, 'wb' )
+    try:
+        f.write( '\0' * _header.size )
+        f.write( meta )
+        pageTable = []
+        offset = _header.size + len(meta)
+        for pageId in index.pageData.keys():
+            # bypass the page cache, every page is read once only
+            data = storage._loadPage( pageId )
+            f.write( data )
+            pageTable.append( _pageEntry.pack( pageId, offset, len(data) ) )
+            offset += len(data)
+        pageTableOffset = offset
+        f.write( ''.join( pageTable ) )
+        coordinatesOffset = pageTableOffset + len(pageTable) * _pageEntry.size
+        documents = 0
+        padding = ( 0.0, ) * (2 * dimension)
+        for docid, coordinates in index.idToCoordinates.items():
+            f.write( coordinate.pack( docid, len(coordinates), *(tuple(coordinates) + padding[len(coordinates):]) ) )
+            documents += 1
+        f.seek( 0 )
+        f.write( _header.pack( magic, tid, len(pageTable), documents, pageTableOffset, coordinatesOffset, len(meta) ) )
+    finally:
+        f.close()
+    os.rename( temporaryPath, path )
+    return tid
+
+
+class SnapshotStorage(CustomStorage):
+    """ Serves the pages of a snapshot file. The snapshot is read-only, writes
+        (the C library stores the header when the tree is destroyed) are
+        ignored. """
+    def __init__(self, data, pageTable):
+        CustomStorage.__init__( self )
+        self.data = data
+        self.pageTable = pageTable
+
+    def create(self, returnError):
+        pass
+
+    def destroy(self, returnError):
+        pass
+
+    def clear(self):
+        raise TypeError( 'Snapshots are read-only' )
+
+    def loadByteArray(self, page, returnError):
+        try:
+            offset, length = self.pageTable[page]
+        except KeyError:
+            returnError.contents.value = self.InvalidPageError
+            return None
+        return self.data[offset:offset + length]
+
+    def storeByteArray(self, page, data, returnError):
+        return page
+
+    def deleteByteArray(self, page, returnError):
+        pass
+
+    hasData = property( lambda self: True )
+
+
+class SnapshotIndex(object):
+    ''' A read-only index which serves the queries of SpatialIndex from a file
+        written by exportSnapshot(). '''
+    def __init__(self, path):
+        self.path = path
+        f = open( path, 'rb' )
+        try:
+            self.data = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+        finally:
+            f.close()
+        fileMagic, self.tid, pageCount, self.numDocuments, pageTableOffset, self.coordinatesOffset, metaLength = \
+            _header.unpack_from( self.data, 0 )
+        if fileMagic != magic:
+            raise ValueError( '%s is not a spatial index snapshot' % path )
+        meta = json.loads( self.data[_header.size:_header.size + metaLength] )
+        self.settings = dict( (str(name), value) for name, value in meta['settings'].items() )
+        self.dimension = meta['dimension']
+        self.family = BTrees.family32 if meta['family'] == 32 else BTrees.family64
+        pageTable = {}
+        for i in xrange( pageCount ):
+            pageId, offset, length = _pageEntry.unpack_from( self.data, pageTableOffset + i * _pageEntry.size )
+            pageTable[pageId] = ( offset, length )
+        self.coordinate = struct.Struct( '<qB%dd' % (2 * self.dimension) )
+        properties = Property()
+        for name, value in self.settings.items():
+            if name not in indexSettings:
+                setattr( properties, name, value )
+        self.tree = Rtree( SnapshotStorage( self.data, pageTable ), properties = properties,
+                           interleaved = self.settings.get( 'interleaved', True ) )
+
+    def close(self):
+        self.tree = None
+        self.data.close()
+
+    def documentCount(self):
+        return self.numDocuments
+
+    def wordCount(self):
+        return 0
+
+    def getCoordinates(self, docid, default = None):
+        ''' Returns the coordinates docid was indexed with or default '''
+        low, high = 0, self.numDocuments
+        size = self.coordinate.size
+        # binary search over the sorted docids
+        while low < high:
+            middle = (low + high) // 2
+            entry = self.coordinate.unpack_from( self.data, self.coordinatesOffset + middle * size )
+            if entry[0] < docid:
+                low = middle + 1
+            elif entry[0] > docid:
+                high = middle
+            else:
+                return entry[2:2 + entry[1]]
+        return default
+
+    def apply(self, queryName, *args, **keys):
+        if queryName == 'intersection' and not keys:
+            return self.family.IF.multiunion( _intersectionIds( self.tree, *args ) )
+        queryFunc = getattr( self, queryName )
+        return self.family.IF.Set( queryFunc( *args, **keys ) )
+
+    def count(self, coordinates):
+        ''' Counts the number of objects within coordinates '''
+        count = self.tree.count( coordinates )
+        if self.family == BTrees.family32:
+            count = int(count)
+        return count
+
+    def intersection(self, coordinates):
+        ''' Returns all docids which are within the given bounds. '''
+        convert = int if self.family == BTrees.family32 else None
+        for id in self.tree.intersection( coordinates, objects = False ):
+            yield convert( id ) if convert else id
+
+    def intersection_array(self, coordinates, sort = False):
+        ''' Returns all docids which are within the given bounds as an array '''
+        ids = _intersectionIds( self.tree, coordinates )
+        if sort:
+            ids.sort()
+        return array( 'i' if self.family == BTrees.family32 else 'l', ids )
+
+    def nearest(self, coordinates, num_results = 1):
+        ''' Returns the num_results docids which are closest to coordinates '''
+        convert = int if self.family == BTrees.family32 else None
+        for id in self.tree.nearest( coordinates, num_results, objects = False ):
+            yield convert( id ) if convert else id
+
+    def leaves(self):
+        return self.tree.leaves()
+
+    def get_bounds(self, coordinate_interleaved = None):
+        ''' Returns the bounds of the whole tree '''
+        return self.tree.get_bounds( coordinate_interleaved )
+
+    bounds = property( get_bounds )
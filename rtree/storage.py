@@ -1,12 +1,120 @@
 from rtree.index import CustomStorage
+from persistent import Persistent
+from BTrees.Length import Length
+import bisect
+import random
+import time
+
+from ZODB.POSException import ConflictError
+
+from compression import decompress, compressLike
+from pages import headerPageId, Header, childPageIds
+from instrumentation import Counters
+
+
+class PageIdAllocator(Persistent):
+    """ Hands out the ids of new pages in O(1).
+    
+        By default ids are taken from a counter. The counter is a BTrees.Length
+        so concurrent allocations don't conflict on the counter itself (they
+        still conflict in the page mapping if they got the same id). Ids of
+        deleted pages are put into a free list and are reused first.
+        
+        With randomIds = True new ids are drawn randomly instead. This spreads
+        the new pages of concurrent writers over different BTree buckets and
+        reduces ConflictErrors. The first two pages (the tree's root and header)
+        are always 0 and 1.
+    """
+    maxRandomId = 2 ** 31 - 1
+
+    def __init__(self, family, nextId = 0, randomIds = False):
+        Persistent.__init__( self )
+        self.counter = Length( nextId )
+        self.freeIds = family.IO.TreeSet()
+        self.randomIds = randomIds
+
+    def allocate(self, mapping):
+        """ Returns an unused page id for mapping """
+        if self.freeIds:
+            pageId = self.freeIds.minKey()
+            self.freeIds.remove( pageId )
+            return pageId
+        if self.randomIds and headerPageId in mapping:
+            while True:
+                pageId = random.randint( 1, self.maxRandomId )
+                if pageId not in mapping:
+                    return pageId
+        pageId = self.counter()
+        self.counter.change( 1 )
+        return pageId
+
+    def free(self, pageId):
+        """ Called when a page was deleted """
+        if not self.randomIds:
+            self.freeIds.insert( pageId )
+
+    def reset(self):
+        """ Called when all pages were deleted """
+        self.counter.set( 0 )
+        self.freeIds.clear()
+
+
+class Page(Persistent):
+    """ A page which is stored as its own persistent object. Rewriting the page
+        only changes this object, not the BTree bucket which holds it, so
+        writers which change different pages don't conflict. """
+    def __init__(self, data):
+        Persistent.__init__( self )
+        self.data = data
+
+
+class HeaderPage(Page):
+    """ The header page of the tree. Almost every insert and delete changes the
+        node and data counters in here, so concurrent changes which leave the
+        structure of the tree (root page and height) alone are merged. """
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        old, saved, new = [ Header( decompress( state['data'] ) ) for state in (oldState, savedState, newState) ]
+        if not saved.sameStructure( old ) or not new.sameStructure( old ):
+            raise ConflictError
+        saved.nodes += new.nodes - old.nodes
+        saved.data += new.data - old.data
+        for level, count in enumerate( new.nodesInLevel ):
+            saved.nodesInLevel[level] += count - old.nodesInLevel[level]
+        state = dict( savedState )
+        state['data'] = compressLike( saved.pack(), savedState['data'] )
+        return state
+
 
 class Storage(CustomStorage):
-    """ A storage which saves the pages in a BTree mapping """
-    def __init__(self, mapping, convertToInt = True):
+    """ A storage which saves the pages in a BTree mapping or one of the page
+        stores of pagestore.py """
+    stats = None            # the instrumentation Counters, see InstrumentedStorage
+
+    def __init__(self, mapping, pageIds, convertToInt = True):
         CustomStorage.__init__( self )
         self.mapping = mapping
+        self.pageIds = pageIds
         self.blockWrites = False
         self.convertToInt = convertToInt
+        # a shared cache for the pages. cacheKey() returns the key prefix for
+        #  the pages or None if the cache can't be used right now.
+        self.cache = None
+        self.cacheKey = None
+        # compresses the pages before they are stored, see compression.py
+        self.compressor = None
+        # store each page as its own Page object instead of directly in the mapping
+        self.pageObjects = False
+        # the pages loaded while a batch of queries runs, see beginBatch()
+        self.batchPages = None
+        # prefetch( objects ) asks the database to load objects in the
+        #  background, e.g. Connection.prefetch. If set, the children of every
+        #  index node which is loaded are prefetched, see _prefetchChildren().
+        self.prefetch = None
+        self.dimension = None
+        # the pages written in the current transaction, page id -> data or
+        #  None for deleted pages. Set by the index while it is changed in a
+        #  transaction, flush() writes the pages to the mapping on commit.
+        self.overlay = None
 
     def create(self, returnError):
         """ Called when the storage is created on the C side """
@@ -17,7 +125,19 @@ class Storage(CustomStorage):
     def clear(self):
         """ Clear all our data """   
         self.mapping.clear()
+        self.pageIds.reset()
+        if self.overlay is not None:
+            self.overlay.clear()
         
+    def detach(self):
+        """ Called before the tree of this storage is pooled or dropped. Forgets
+            the index' objects and ignores the header the tree stores when it's
+            destroyed, the index binds the storage again when it's reused. """
+        self.blockWrites = True
+        self.mapping = self.pageIds = None
+        self.cacheKey = self.prefetch = None
+        self.overlay = None
+
     def convertPage(self, page):
         if self.convertToInt:
             page = int(page)
@@ -25,12 +145,165 @@ class Storage(CustomStorage):
                 raise OverflowError(page)
         return page
 
+    def beginBatch(self):
+        """ Keeps all pages which are read or written in memory until endBatch()
+            is called, so a batch of queries loads every page only once """
+        self.batchPages = {}
+
+    def endBatch(self):
+        self.batchPages = None
+
+    def readPage(self, page):
+        """ Returns the data for page, raises KeyError if there is no such page """
+        overlay = self.overlay
+        if overlay and page in overlay:
+            data = overlay[page]
+            if data is None:
+                raise KeyError( page )
+            return data
+        batchPages = self.batchPages
+        if batchPages is None:
+            return self._readCachedPage( page )
+        data = batchPages.get( page )
+        if data is None:
+            data = batchPages[page] = self._readCachedPage( page )
+        return data
+
+    def _readCachedPage(self, page):
+        if self.cache is None:
+            return self._loadPage( page )
+        prefix = self.cacheKey()
+        if prefix is None:
+            return self._loadPage( page )
+        key = prefix + (page,)
+        data = self.cache.get( key )
+        if data is None:
+            data = self._loadPage( page )
+            self.cache.set( key, data )
+        return data
+
+    def writePage(self, page, data):
+        """ Replaces the data of an existing page """
+        if self.overlay is not None:
+            self.overlay[page] = data
+        else:
+            self._storePage( page, data )
+
+    def flush(self, returnError = None):
+        """ Writes the pages of the overlay to the mapping. Pages which were
+            written several times are stored once, pages which end up with the
+            bytes they are stored with already are not stored at all. Also
+            called by the C side when the tree is flushed. """
+        overlay = self.overlay
+        if overlay:
+            pages = sorted( overlay.items() )
+            overlay.clear()
+            for page, data in pages:
+                if data is None:
+                    if page in self.mapping:
+                        del self.mapping[page]
+                else:
+                    self._storePage( page, data )
+
+    def __contains__(self, page):
+        overlay = self.overlay
+        if overlay and page in overlay:
+            return overlay[page] is not None
+        return page in self.mapping
+
+    def pageCount(self):
+        """ Returns the number of pages in the mapping, counting the pages of
+            the overlay as if it was flushed """
+        count = len(self.mapping)
+        for page, data in (self.overlay or {}).items():
+            if page in self.mapping:
+                count -= data is None
+            else:
+                count += data is not None
+        return count
+
+    def storedBytes(self):
+        """ Returns the number of bytes stored in the mapping, pages of the
+            overlay count with the bytes they will be stored with """
+        overlay = self.overlay or {}
+        size = 0
+        for page, data in self.mapping.items():
+            if page in overlay:
+                continue
+            if isinstance( data, Page ):
+                data = data.data
+            size += len(data)
+        for data in overlay.values():
+            if data is None:
+                continue
+            if self.compressor is not None:
+                data = self.compressor( data )
+            size += len(data)
+        return size
+
+    def rewritePages(self):
+        """ Stores all pages again which are not stored with the current
+            compression and layout """
+        self.flush()
+        for page in list( self.mapping.keys() ):
+            self._storePage( page, self._loadPage( page ) )
+
+    def _loadPage(self, page):
+        data = self.mapping[page]
+        if isinstance( data, Page ):
+            data = data.data
+        data = decompress( data )
+        if self.prefetch is not None and page != headerPageId:
+            self._prefetchChildren( data )
+        return data
+
+    def _prefetchChildren(self, data):
+        """ Asks the database to load the objects holding the children of the
+            node page data, which are likely read next. The C side reads them
+            one by one, this way there is about one round trip per tree level
+            instead of one per page. """
+        pageIds = childPageIds( data, self.dimension )
+        if self.cache is not None and pageIds:
+            prefix = self.cacheKey()
+            if prefix is not None:
+                pageIds = [ pageId for pageId in pageIds if prefix + (pageId,) not in self.cache ]
+        if not pageIds:
+            return
+        ghosts = [ bucket for bucket in _buckets( self.mapping, pageIds ) if bucket._p_changed is None ]
+        if ghosts:
+            self.prefetch( ghosts )
+        if self.pageObjects:
+            # this waits for the buckets, the page objects are fetched together
+            pages = [ self.mapping.get( pageId ) for pageId in pageIds ]
+            ghosts = [ page for page in pages if isinstance( page, Page ) and page._p_changed is None ]
+            if ghosts:
+                self.prefetch( ghosts )
+
+    def _storePage(self, page, data):
+        if self.batchPages is not None:
+            self.batchPages[page] = data
+        if self.compressor is not None:
+            data = self.compressor( data )
+        stored = self.mapping.get( page )
+        if self.pageObjects:
+            if isinstance( stored, Page ):
+                if stored.data != data:
+                    stored.data = data
+                return
+            if page == headerPageId:
+                data = HeaderPage( data )
+            else:
+                data = Page( data )
+        elif stored == data:
+            return
+        self.mapping[page] = data
+
     def loadByteArray(self, page, returnError):
         """ Returns the data for page or returns an error """
         page = self.convertPage(page)
         #log( 'READ page:%s' % page )
         try:
-            return self.mapping[page]
+            return self.readPage( page )
         except KeyError:
             returnError.contents.value = self.InvalidPageError
 
@@ -41,17 +314,16 @@ class Storage(CustomStorage):
             #log( 'STORE BLOCKED page:%s' % page )
             return page
         if page == self.NewPage:
-            newPageId = len(self.mapping)
-            # TODO: should newPageId be random to better prevent ConflictErrors?
+            newPageId = self.pageIds.allocate( self )
             #log( 'STORE NEW pageId:%s' % newPageId )
-            self.mapping[newPageId] = data
+            self.writePage( newPageId, data )
             return newPageId
         else:
             #log( 'STORE pageId:%s' % page )
-            if page not in self.mapping:
+            if page not in self:
                 returnError.value = self.InvalidPageError
                 return 0
-            self.mapping[page] = data
+            self.writePage( page, data )
             #import struct
             #nodes = struct.unpack( 'I', self.mapping[0][8:12] ) if self.mapping else -1
             #log( 'STORE nodes:%s' % nodes )
@@ -61,11 +333,77 @@ class Storage(CustomStorage):
         """ Deletes a page """
         #log( 'DELETE pageId:%s' % page )
         page = self.convertPage(page)
-        try:
-            del self.mapping[page]
-        except KeyError:
+        if page not in self:
             returnError.contents.value = self.InvalidPageError
+            return
+        if self.overlay is not None:
+            self.overlay[page] = None
+        else:
+            del self.mapping[page]
+        self.pageIds.free( page )
+        if self.batchPages is not None:
+            self.batchPages.pop( page, None )
+
+    def _hasData(self):
+        if self.overlay:
+            for data in self.overlay.values():
+                if data is not None:
+                    return True
+        return bool(self.mapping)
 
-    hasData = property( lambda self: bool(self.mapping) )
+    # not __nonzero__, Rtree tests the truth of the storage it's passed
+    hasData = property( _hasData )
     """ Returns true if this storage contains some data """   
 
+
+def _buckets(tree, keys):
+    """ Returns the buckets of the BTree tree which hold keys. Only the
+        tree's inner nodes are loaded, not the buckets. """
+    state = tree.__getstate__()
+    if state is None or not isinstance( state[0][0], Persistent ):
+        # the tree is empty or a single bucket which is part of its state
+        return []
+    children, separators = state[0][0::2], state[0][1::2]
+    keysPerChild = {}
+    for key in keys:
+        keysPerChild.setdefault( bisect.bisect_right( separators, key ), [] ).append( key )
+    buckets = []
+    for i, childKeys in sorted( keysPerChild.items() ):
+        child = children[i]
+        if isinstance( child, tree.__class__ ):
+            buckets.extend( _buckets( child, childKeys ) )
+        else:
+            buckets.append( child )
+    return buckets
+
+
+class InstrumentedStorage(Storage):
+    """ A Storage which counts and times the page loads, stores and deletes of
+        the C side in stats """
+    def __init__(self, *args, **kw):
+        Storage.__init__( self, *args, **kw )
+        self.stats = Counters()
+
+    def loadByteArray(self, page, returnError):
+        stats = self.stats
+        start = time.time()
+        data = Storage.loadByteArray( self, page, returnError )
+        stats.loadTime += time.time() - start
+        stats.loads += 1
+        if data is not None:
+            stats.loadedBytes += len(data)
+        return data
+
+    def storeByteArray(self, page, data, returnError):
+        stats = self.stats
+        start = time.time()
+        page = Storage.storeByteArray( self, page, data, returnError )
+        stats.storeTime += time.time() - start
+        if not self.blockWrites:
+            stats.stores += 1
+            stats.storedBytes += len(data)
+        return page
+
+    def deleteByteArray(self, page, returnError):
+        self.stats.deletes += 1
+        return Storage.deleteByteArray( self, page, returnError )
@@ -190,7 +190,37 @@ Test more complex index/unindex/commit/savepoint/rollback/abort stuff.
   >>>
   >>> index.count( (0,0,100,100) )
   2L
-  
+
+New page ids are handed out by a counter, ids of deleted pages are put into a free list and reused.
+
+  >>> pageIds = index.pageIds
+  >>> sorted( list(index.pageData.keys()) + list(pageIds.freeIds) ) == range( pageIds.counter() )
+  True
+
+Committed pages are kept in a process wide cache which is shared between connections. Empty the rtree's own
+buffer twice, the second query gets its pages from the cache.
+
+  >>> from zope.index.SpatialIndex.cache import pageCache
+  >>> index._clearBuffer(True)
+  >>> index.count( (0,0,100,100) )
+  2L
+  >>> hits = pageCache.statistics()['hits']
+  >>> index._clearBuffer(True)
+  >>> index.count( (0,0,100,100) )
+  2L
+  >>> pageCache.statistics()['hits'] > hits
+  True
+
+The keys of the cache name the database by a number which is set on it once, so the pages of a database can't be
+found under the key of another database which was opened after it was closed.
+
+  >>> from zope.index.SpatialIndex.cache import databaseToken
+  >>> from ZODB.MappingStorage import DB as MappingDB
+  >>> first, second = MappingDB(), MappingDB()
+  >>> databaseToken( first ) == databaseToken( first ), databaseToken( first ) == databaseToken( second )
+  (True, False)
+  >>> first.close(); second.close()
+
 Clear the index.
 
   >>> index.clear()
@@ -200,13 +230,801 @@ Clear the index.
   >>> index.count( (0,0,100,100) )
   0L
 
-Run a little benchmark.
+Index and unindex many documents at once. The index is empty, so the first call bulk loads the tree.
+
+  >>> transaction.begin()
+  <...>
+  >>> index.index_docs( [ (1, (5,5,20,10)), (2, (20,20,25,25)) ] )
+  >>> index.documentCount()
+  2
+  >>> sorted( index.intersection( (0,0,100,100) ) )
+  [1L, 2L]
+
+Now the index is not empty anymore, the documents are inserted one chunk at a time. Docid 2 is moved.
+
+  >>> index.index_docs( [ (3, (30,30,40,40)), (2, (50,50,60,60)) ], chunkSize = 1 )
+  >>> index.documentCount()
+  3
+  >>> sorted( index.intersection( (0,0,45,45) ) )
+  [1L, 3L]
+  >>> index.unindex_docs( [1, 3, 4] )
+  >>> list( index.intersection( (0,0,100,100) ) )
+  [2L]
+  >>> index.documentCount()
+  1
+
+Indexing a docid again moves it. Nothing happens if the coordinates did not change, a move within the bounds of
+the leaf updates the leaf in place and any other move deletes and reinserts the entry.
+
+  >>> index.index_doc( 2, House('Cottage', (50,50,60,60)) )
+  >>> index.documentCount()
+  1
+  >>> index.index_doc( 2, House('Cottage', (51,51,59,59)) )
+  >>> list( index.intersection( (0,0,50.5,50.5) ) )
+  []
+  >>> list( index.intersection( (0,0,52,52) ) )
+  [2L]
+  >>> index.index_doc( 2, House('Cottage', (0,0,1,1)) )
+  >>> list( index.intersection( (0,0,2,2) ) )
+  [2L]
+  >>> index.count( (0,0,100,100) )
+  1L
+
+index_docs() moves docids in place too and flushes the buffer only once per chunk for that. An entry which is moved in
+place keeps its slot in the leaf, an entry which is deleted and inserted again is appended to the leaf.
+
+  >>> index.index_docs( [ (3, (10,10,20,20)), (4, (30,30,40,40)), (5, (12,12,14,14)) ] )
+  >>> from zope.index.SpatialIndex.pages import toBounds
+  >>> def slot(docid):
+  ...     return index._treeReader().findLeaf( docid, *toBounds( index.idToCoordinates[docid], 2, True ) )[1]
+  >>> slots = [ slot( docid ) for docid in (2, 3, 4) ]
+  >>> index.index_docs( [ (2, (0.5,0.5,1,1)), (3, (11,11,19,19)), (4, (30,30,40,40)) ] )
+  >>> [ slot( docid ) for docid in (2, 3, 4) ] == slots
+  True
+  >>> index.index_docs( [ (2, (100,100,101,101)) ] )
+  >>> slot( 2 ) == slots[0], sorted( index.intersection( (0,0,200,200) ) )
+  (False, [2L, 3L, 4L, 5L])
+  >>> index.unindex_docs( [3, 4, 5] )
+  >>> index.index_docs( [ (2, (0,0,1,1)) ] )
+
+Many queries can be run at once.
+
+  >>> index.index_doc( 3, House('Cottage', (30,30,40,40)) )
+  >>> windows = [ (0,0,45,45), (100,100,200,200), (35,35,50,50) ]
+  >>> [ list(ids) for ids in index.intersection_many( windows ) ] == [ [2, 3], [], [3] ]
+  True
+  >>> sorted( index.intersection_many( windows, flat = True ) ) == [ (0, 2), (0, 3), (2, 3) ]
+  True
+  >>> list( index.count_many( windows ) )
+  [2, 0, 1]
+  >>> index.nearest_many( [ (0,0), (50,50) ] ) == [ [2], [3] ]
+  True
+
+apply() builds the set of an intersection from the whole result at once. If a BTrees set isn't needed the ids can be
+returned as an array.
+
+  >>> list( index.apply( 'intersection', (0,0,45,45) ) ) == [2, 3]
+  True
+  >>> index.intersection_array( (0,0,45,45), sort = True )
+  array('l', [2, 3])
+
+The documents are counted by a conflict free counter. statistics() describes the shape of the tree.
+
+  >>> index.documentCount()
+  2
+  >>> stats = index.statistics()
+  >>> stats['documents'], stats['height'], stats['nodesInLevel'], stats['overlap']
+  (2, 1, [1], 0.0)
+  >>> stats['fillFactors'] == [ 2 / 20.0 ]
+  True
+
+The tree is walked, so the statistics are exact for trees which grew by single inserts and within a transaction.
+
+  >>> for i in range(500):
+  ...     index.index_doc( 1000 + i, House('Hut', (i, i, i + 1, i + 1)) )
+  >>> transaction.commit()
+  >>> index.index_doc( 2000, House('Hut', (7, 7, 8, 8)) )
+  >>> stats = index.statistics()
+  >>> stats['documents'], stats['height'], stats['nodesInLevel'][-1]
+  (503, 2, 1)
+  >>> stats['nodes'] == sum( stats['nodesInLevel'] ), stats['pages'] == stats['nodes'] + 1
+  (True, True)
+  >>> int( round( stats['fillFactors'][0] * stats['nodesInLevel'][0] * 20 ) )
+  503
+  >>> len( index.tree.customstorage.overlay ) > 0
+  True
+  >>> index.clear()
+  >>> transaction.commit()
+
+Pages can be stored compressed. Compressed and uncompressed pages can be mixed, pages are converted when they are
+written or by recompress().
+
+  >>> settings = dict( dimension = 2, leaf_capacity = 20, near_minimum_overlap_factor = 20, writethrough = False, buffering_capacity = 100, family = BTrees.family64, compression = 'zlib', compression_level = 9 )
+  >>> site['compressed'] = compressed = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> compressed.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> transaction.commit()
+  >>> compressed.count( (0,0,10,10) )
+  11L
+  >>> from zope.index.SpatialIndex.compression import decompress, compressLike, getCompressor
+  >>> page = compressed.pageData.values()[0]
+  >>> compressLike( decompress(page), page ) == page
+  True
+  >>> compressLike( 'x' * 1000, page ) == getCompressor( 'zlib', 9 )( 'x' * 1000 )
+  True
+  >>> compressed.settings['compression'] = None
+  >>> compressed.recompress()
+  >>> all( decompress(data) == data for data in compressed.pageData.values() )
+  True
+  >>> compressed.count( (0,0,10,10) )
+  11L
+  >>> del site['compressed']
+  >>> transaction.commit()
+
+With page_objects each page is stored as its own persistent object. The tree stores its header page when a
+transaction commits. The header page merges concurrent changes of the node and data counters, but not of the tree's
+structure. Conflicts are resolved by storages like DemoStorage or FileStorage.
+
+  >>> import ZODB, ZODB.DemoStorage
+  >>> from zope.index.SpatialIndex.pages import Header, headerPageId
+  >>> resolvingDb = ZODB.DB( ZODB.DemoStorage.DemoStorage() )
+  >>> firstManager, secondManager = transaction.TransactionManager(), transaction.TransactionManager()
+  >>> firstRoot = resolvingDb.open( transaction_manager = firstManager ).root()
+  >>> settings = dict( dimension = 2, leaf_capacity = 20, near_minimum_overlap_factor = 20, writethrough = False, buffering_capacity = 100, family = BTrees.family64, page_objects = True )
+  >>> firstRoot['objects'] = objects = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> firstManager.commit()
+  >>> objects.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> firstManager.commit()
+  >>> header = objects.pageData[headerPageId]
+  >>> header
+  <...HeaderPage object at ...>
+  >>> Header( decompress( header.data ) ).data
+  100L
+  >>> secondRoot = resolvingDb.open( transaction_manager = secondManager ).root()
+  >>> objects.index_doc( 100, House('Cottage', (0.2, 0.2, 0.3, 0.3)) )
+  >>> secondRoot['objects'].index_doc( 101, House('Shed', (98.2, 98.2, 98.3, 98.3)) )
+  >>> firstManager.commit()
+  >>> secondManager.commit()
+  >>> firstManager.begin()
+  <...>
+  >>> merged = Header( decompress( header.data ) )
+  >>> merged.data, merged.treeHeight, objects.count( (0, 0, 100, 100) )
+  (102L, 2, 102L)
+  >>> old = header.__getstate__()
+  >>> moved = Header( old['data'] )
+  >>> moved.rootId += 1
+  >>> counted = Header( old['data'] )
+  >>> counted.data += 1
+  >>> header._p_resolveConflict( old, dict( old, data = moved.pack() ), dict( old, data = counted.pack() ) )
+  Traceback (most recent call last):
+  ...
+  ConflictError: ...
+  >>> firstManager.abort()
+  >>> secondManager.abort()
+  >>> resolvingDb.close()
+
+Page I/O can be instrumented. Trees created after enable() count and time their page loads, stores, deletes and
+buffer flushes and report them at the end of each transaction.
+
+  >>> from zope.index.SpatialIndex import instrumentation
+  >>> reports = []
+  >>> instrumentation.enable( lambda key, counters, committed: reports.append( (counters, committed) ) )
+  >>> settings = dict( dimension = 2, leaf_capacity = 20, near_minimum_overlap_factor = 20, writethrough = False, buffering_capacity = 100, family = BTrees.family64 )
+  >>> site['instrumented'] = instrumented = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> transaction.commit()
+  >>> instrumented.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> transaction.commit()
+  >>> counters, committed = reports[-1]
+  >>> committed, counters['stores'] > 0, counters['flushes'] > 0
+  (True, True, True)
+  >>> instrumentation.statistics()[ instrumented._statsKey() ]['transactions']
+  1
+
+Queries don't join the transaction. The counters of a transaction which only queried the index are reported with
+committed None when the index is used in the next transaction.
+
+  >>> instrumented.count( (0,0,10,10) )
+  11L
+  >>> transaction.commit()
+  >>> len(reports)
+  1
+  >>> instrumented.count( (0,0,10,10) )
+  11L
+  >>> counters, committed = reports[-1]
+  >>> committed, counters['loads'] > 0, counters['stores']
+  (None, True, 0)
+  >>> instrumentation.statistics()[ instrumented._statsKey() ]['transactions']
+  2
+  >>> instrumentation.disable()
+  >>> del site['instrumented']
+  >>> transaction.commit()
+
+Queries don't join the transaction, only changes do. A tree which only buffered pages for reads discards them in the
+next transaction, so it sees the changes committed by other connections.
+
+  >>> otherManager = transaction.TransactionManager()
+  >>> otherConnection = db.open( transaction_manager = otherManager )
+  >>> dbroot['readonly'] = writer = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> transaction.commit()
+  >>> otherManager.begin()
+  <...>
+  >>> reader = otherConnection.root()['readonly']
+  >>> reader.count( (0,0,100,100) )
+  0L
+  >>> getattr( reader, '_v_dataManagerRegistered', False )
+  False
+  >>> writer.index_doc( 1, House('Mansion', (5,5,20,10)) )
+  >>> writer._v_dataManagerRegistered
+  True
+  >>> transaction.commit()
+  >>> otherManager.begin()
+  <...>
+  >>> reader.count( (0,0,100,100) )
+  1L
+  >>> otherManager.abort()
+  >>> otherConnection.close()
+  >>> del dbroot['readonly']
+  >>> transaction.commit()
+
+Read-only replicas can serve queries from a snapshot file instead of the database. The snapshot is tagged with the
+transaction id of the index state it was taken from.
+
+  >>> import os, tempfile
+  >>> from zope.index.SpatialIndex.snapshot import exportSnapshot, SnapshotIndex
+  >>> site['snapshotted'] = snapshotted = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> snapshotted.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> exportSnapshot( snapshotted, 'unused' )
+  Traceback (most recent call last):
+  ...
+  ValueError: The index has uncommitted changes
+  >>> transaction.commit()
+  >>> directory = tempfile.mkdtemp()
+  >>> path = os.path.join( directory, 'index.snapshot' )
+  >>> exportSnapshot( snapshotted, path ) == snapshotted.generation._p_serial
+  True
+  >>> snapshot = SnapshotIndex( path )
+  >>> snapshot.documentCount()
+  100L
+  >>> snapshot.count( (10, 10, 20, 20) ) == snapshotted.count( (10, 10, 20, 20) )
+  True
+  >>> sorted( snapshot.intersection( (10.5, 10.5, 12.5, 12.5) ) )
+  [10L, 11L, 12L]
+  >>> list( snapshot.nearest( (50.5, 50.5) ) )
+  [50L]
+  >>> list( snapshot.apply( 'intersection', (10.5, 10.5, 12.5, 12.5) ) ) == [10, 11, 12]
+  True
+  >>> snapshot.getCoordinates( 42 )
+  (42.0, 42.0, 43.0, 43.0)
+  >>> snapshot.getCoordinates( 1000 ) is None
+  True
+  >>> snapshot.close()
+  >>> import shutil
+  >>> shutil.rmtree( directory )
+  >>> del site['snapshotted']
+  >>> transaction.commit()
+
+With the result_cache setting the results of intersection(), count() and apply() are cached until a transaction
+changes the index. Results within a transaction which changed the index are not cached.
+
+  >>> from zope.index.SpatialIndex.cache import resultCache
+  >>> resultCache.clear()
+  >>> cachedSettings = dict( settings, result_cache = True )
+  >>> site['cached'] = cached = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = cachedSettings )
+  >>> cached.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> cached.count( (10.5, 10.5, 12.5, 12.5) )
+  3L
+  >>> resultCache.statistics()['entries']
+  0
+  >>> transaction.commit()
+  >>> cached.count( (10.5, 10.5, 12.5, 12.5) ), cached.count( (10.5, 10.5, 12.5, 12.5) )
+  (3L, 3L)
+  >>> sorted( cached.intersection( (10.5, 10.5, 12.5, 12.5) ) ) == list( cached.apply( 'intersection', (10.5, 10.5, 12.5, 12.5) ) ) == [10, 11, 12]
+  True
+  >>> statistics = resultCache.statistics()
+  >>> statistics['entries'], statistics['hits'], statistics['misses'], statistics['bytes'] > 0
+  (2, 2, 2, True)
+  >>> cached.unindex_doc( 11 )
+  >>> cached.count( (10.5, 10.5, 12.5, 12.5) )
+  2L
+  >>> transaction.commit()
+  >>> cached.count( (10.5, 10.5, 12.5, 12.5) )
+  2L
+  >>> del site['cached']
+  >>> transaction.commit()
+
+Batches of queries and huge windows can be run in several threads. Each thread queries its own read-only tree handle.
+
+  >>> site['threaded'] = threaded = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> threaded.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(1000) ] )
+  >>> windows = [ (i, i, i + 10, i + 10) for i in range(0, 1000, 7) ]
+  >>> [ list( ids ) for ids in threaded.intersection_many( windows, parallel = True ) ] == [ list( ids ) for ids in threaded.intersection_many( windows ) ]
+  True
+  >>> list( threaded.count_many( windows, parallel = True ) ) == list( threaded.count_many( windows ) )
+  True
+  >>> transaction.commit()
+  >>> threaded.nearest_many( [ (500.5, 500.5), (10.5, 10.5) ], parallel = True ) == [ [500], [10] ]
+  True
+  >>> found = threaded.intersection_parallel( (100.5, 100.5, 899.5, 899.5) )
+  >>> list( found ) == list( threaded.apply( 'intersection', (100.5, 100.5, 899.5, 899.5) ) )
+  True
+  >>> len( found )
+  800
+
+The handles read through the storage of the index's tree, they are dropped along with the tree, e.g. when a change
+is aborted.
+
+  >>> del site['threaded']
+  >>> site['threaded'] = threaded = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = dict( settings, buffering_capacity = 10 ) )
+  >>> threaded.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(5000) ] )
+  >>> transaction.commit()
+  >>> windows = [ (i, i, i + 50, i + 50) for i in range(0, 5000, 97) ]
+  >>> expected = [ list( ids ) for ids in threaded.intersection_many( windows ) ]
+  >>> [ list( ids ) for ids in threaded.intersection_many( windows, parallel = True ) ] == expected
+  True
+  >>> threaded.index_doc( 5000, House('Hut', (1, 1, 2, 2)) )
+  >>> transaction.abort()
+  >>> pageCache.clear()
+  >>> [ list( ids ) for ids in threaded.intersection_many( windows, parallel = True ) ] == expected
+  True
+  >>> del site['threaded']
+  >>> transaction.commit()
+
+A sharded index splits the documents into several SpatialIndex shards by the center of their coordinates. Queries only
+visit the shards which overlap the window. Documents which cross the border of their shard's cell are still found.
+
+  >>> from zope.index.SpatialIndex.index import ShardedSpatialIndex
+  >>> site['sharded'] = shardedIndex = ShardedSpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings, extent = (0, 0, 100, 100), shards = 4 )
+  >>> len( shardedIndex.shards )
+  4
+  >>> shardedIndex.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> shardedIndex.index_doc( 1000, House('Bridge', (40, 45, 60, 55)) )
+  >>> [ shard.documentCount() for shard in shardedIndex.shards ]
+  [51, 0, 0, 50]
+  >>> shardedIndex.documentCount()
+  101
+  >>> sorted( shardedIndex.intersection( (55, 46, 58, 48) ) )
+  [1000L]
+  >>> shardedIndex.count( (10.5, 10.5, 12.5, 12.5) )
+  3L
+  >>> list( shardedIndex.apply( 'intersection', (48.5, 48.5, 50.5, 50.5) ) ) == [48, 49, 50, 1000]
+  True
+  >>> list( shardedIndex.nearest( (75.5, 75.5), 3 ) ) == [75, 74, 76]
+  True
+  >>> shardedIndex.bounds
+  [0.0, 0.0, 100.0, 100.0]
+
+Moving a document to another shard removes it from its old shard.
+
+  >>> shardedIndex.index_doc( 1000, House('Bridge', (80, 10, 90, 20)) )
+  >>> [ shard.documentCount() for shard in shardedIndex.shards ]
+  [50, 1, 0, 50]
+  >>> shardedIndex.unindex_doc( 1000 )
+  >>> shardedIndex.documentCount()
+  100
+  >>> transaction.commit()
+
+Hilbert and quadtree partitionings fit the cells to the documents of a bulk load into an empty index. The shards of
+bulk loads can be built in worker processes.
+
+  >>> site['hilbert'] = hilbertIndex = ShardedSpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings, extent = (0, 0, 1000, 1000), shards = 4, partitioning = 'hilbert' )
+  >>> hilbertIndex.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ], processes = 2 )
+  >>> [ shard.documentCount() for shard in hilbertIndex.shards ]
+  [25, 25, 25, 25]
+  >>> hilbertIndex.count( (0, 0, 1000, 1000) )
+  100L
+  >>> site['quadtree'] = quadtreeIndex = ShardedSpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings, extent = (0, 0, 1000, 1000), shards = 7, partitioning = 'quadtree' )
+  >>> len( quadtreeIndex.shards )
+  7
+  >>> quadtreeIndex.index_docs( [ (i, (i * 10, i * 10, i * 10 + 1, i * 10 + 1)) for i in range(100) ] )
+  >>> sorted( [ shard.documentCount() for shard in quadtreeIndex.shards ] )
+  [0, 0, 0, 0, 25, 25, 50]
+  >>> transaction.commit()
+  >>> del site['sharded'], site['hilbert'], site['quadtree']
+  >>> transaction.commit()
+
+When a node page is loaded from the database, the objects which hold its children are prefetched, so a cold query
+waits for about one round trip per tree level.
+
+  >>> dbroot['prefetched'] = prefetched = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = dict( settings, page_cache = False ) )
+  >>> prefetched.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(3000) ] )
+  >>> transaction.commit()
+  >>> coldConnection = db.open( transaction_manager = transaction.TransactionManager() )
+  >>> cold = coldConnection.root()['prefetched']
+  >>> prefetches = []
+  >>> cold.tree.customstorage.prefetch = prefetches.append
+  >>> cold.count( (0, 0, 3000, 3000) )
+  3000L
+  >>> len( prefetches ) > 0
+  True
+  >>> coldConnection.close()
+  >>> del dbroot['prefetched']
+  >>> transaction.commit()
+
+Results can be limited and paged. The tree is only read until enough results were found. Cursors can be stored and
+passed back in to get the next page.
+
+  >>> site['paged'] = paged = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> paged.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(1000) ] )
+  >>> transaction.commit()
+  >>> window = (100.5, 100.5, 199.5, 199.5)
+  >>> everything = sorted( paged.intersection( window ) )
+  >>> len( list( paged.intersection( window, limit = 10 ) ) ), len( list( paged.intersection( window, offset = 95 ) ) )
+  (10, 5)
+  >>> pages, cursor = [], None
+  >>> while True:
+  ...     ids, cursor = paged.intersection_page( window, 30, cursor )
+  ...     pages.append( ids )
+  ...     if cursor is None:
+  ...         break
+  >>> [ len( ids ) for ids in pages ]
+  [30, 30, 30, 10]
+  >>> sorted( [ id for ids in pages for id in ids ] ) == everything
+  True
+  >>> paged.count( window ), paged.count( window, max_count = 10 ), paged.count( window, max_count = 1000 )
+  (100L, 10, 100)
+  >>> del site['paged']
+  >>> transaction.commit()
+
+nearest_iter() yields the closest objects with their distance, closest first, as far as they are consumed.
+within_distance() returns the objects within a radius.
+
+  >>> site['browsed'] = browsed = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> browsed.index_docs( [ (i, (i * 10, 0, i * 10 + 1, 1)) for i in range(100) ] )
+  >>> transaction.commit()
+  >>> from itertools import islice
+  >>> list( islice( browsed.nearest_iter( (255, 0) ), 3 ) )
+  [(25, 4.0), (26, 5.0), (24, 14.0)]
+  >>> [ id for id, distance in browsed.nearest_iter( (255, 0), max_distance = 30 ) ]
+  [25, 26, 24, 27, 23, 28]
+  >>> sorted( browsed.within_distance( (255, 0), 30 ) )
+  [23, 24, 25, 26, 27, 28]
+  >>> del site['browsed']
+  >>> transaction.commit()
+
+The coordinates of the documents are stored in blocks of packed doubles. Indexes created with a BTree of tuples can
+be migrated.
+
+  >>> from zope.index.SpatialIndex.coordinates import CoordinateMap
+  >>> site['compact'] = compact = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> isinstance( compact.idToCoordinates, CoordinateMap )
+  True
+  >>> compact.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(1000) ] )
+  >>> compact.index_doc( 5000, House('Shed', (7, 8)) )
+  >>> compact.idToCoordinates[5000], compact.idToCoordinates[999]
+  ((7.0, 8.0), (999.0, 999.0, 1000.0, 1000.0))
+  >>> blockCount = len( compact.idToCoordinates.blocks )
+  >>> blockCount > 1
+  True
+  >>> compact.unindex_docs( range(0, 1000, 2) )
+  >>> compact.documentCount(), len( compact.idToCoordinates ), compact.count( (0, 0, 1000, 1000) )
+  (501, 501, 501L)
+
+Blocks which shrink below half of their size are merged with a neighbor, empty blocks are deleted.
+
+  >>> blocks = compact.idToCoordinates.blocks
+  >>> len( blocks ) < blockCount, all( len(block) for block in blocks.values() )
+  (True, True)
+  >>> emptied = CoordinateMap( BTrees.family64, 4 )
+  >>> emptied.update( (i, (i, i)) for i in range(1000) )
+  >>> emptied.popMany( range(1, 1000) )[-1]
+  (999, (999.0, 999.0))
+  >>> len( emptied.blocks ), emptied.pop( 0 ), len( emptied.blocks ), bool( emptied )
+  (1, (0.0, 0.0), 0, False)
+  >>> compact.idToCoordinates = BTrees.family64.IO.BTree( compact.idToCoordinates.items() )
+  >>> compact.migrateCoordinates(), compact.migrateCoordinates()
+  (True, False)
+  >>> compact.idToCoordinates.getMany( [1, 2, 3, 5000] )
+  [(1, (1.0, 1.0, 2.0, 2.0)), (3, (3.0, 3.0, 4.0, 4.0)), (5000, (7.0, 8.0))]
+  >>> transaction.commit()
+
+Concurrent changes of different documents in the same block are merged.
+
+  >>> block = compact.idToCoordinates.blocks.values()[0]
+  >>> old = block.__getstate__()
+  >>> block.set( 1, (10, 10, 11, 11) )
+  >>> saved = block.__getstate__()
+  >>> block.__setstate__( old )
+  >>> block.remove( block.find( 3 ) )
+  >>> new = block.__getstate__()
+  >>> block.__setstate__( block._p_resolveConflict( old, saved, new ) )
+  >>> block.get( block.find( 1 ) ), block.find( 3 )
+  ((10.0, 10.0, 11.0, 11.0), -1)
+  >>> block._p_resolveConflict( old, saved, saved )
+  Traceback (most recent call last):
+  ...
+  ConflictError: ...
+  >>> transaction.abort()
+  >>> del site['compact']
+  >>> transaction.commit()
+
+The pages changed in a transaction are kept in an overlay until it commits. Then only the final version of every changed
+page is stored, pages which were written back unchanged are not stored at all.
+
+  >>> site['overlaid'] = overlaid = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> transaction.commit()
+  >>> pageCount = len( overlaid.pageData )
+  >>> for i in range(100):
+  ...     overlaid.index_doc( i, House('House', (i, i, i + 1, i + 1)) )
+  >>> overlaid.count( (0, 0, 200, 200) ), len( overlaid.pageData ) == pageCount
+  (100L, True)
+  >>> transaction.commit()
+  >>> len( overlaid.pageData ) > pageCount
+  True
+
+The tree is kept for the committed state, but it doesn't write anything until the index is changed again. So it never
+stores its header when it's destroyed, not even after its connection was closed.
+
+  >>> overlaid.tree.customstorage.blockWrites
+  True
+  >>> overlaid._markChanged()
+  >>> overlaid.tree.customstorage.blockWrites
+  False
+  >>> storage = overlaid.tree.customstorage
+  >>> stored = overlaid.pageData[1]
+  >>> storage.writePage( 1, 'changed' )
+  >>> storage.readPage( 1 )
+  'changed'
+  >>> storage.writePage( 1, stored[:1] + stored[1:] )
+  >>> storage.overlay.keys()
+  [1]
+  >>> storage.flush()
+  >>> overlaid.pageData[1] is stored, storage.overlay
+  (True, {})
+  >>> transaction.abort()
+  >>> del site['overlaid']
+  >>> transaction.commit()
+
+An index which isn't stored in a connection yet doesn't know the transaction it will be committed with. It doesn't
+join any, its changes are written straight to pageData.
+
+  >>> ownManager = transaction.TransactionManager()
+  >>> ownRoot = db.open( transaction_manager = ownManager ).root()
+  >>> ownRoot['unstored'] = unstored = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> unstored.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(10) ] )
+  >>> unstored.index_doc( 10, House('House', (10, 10, 11, 11)) )
+  >>> getattr( unstored, '_v_dataManagerRegistered', False ), unstored.tree.customstorage.overlay
+  (False, None)
+  >>> ownManager.commit()
+  >>> otherManager = transaction.TransactionManager()
+  >>> otherRoot = db.open( transaction_manager = otherManager ).root()
+  >>> otherRoot['unstored'].count( (0, 0, 100, 100) ), otherRoot['unstored'].documentCount()
+  (11L, 11)
+  >>> unstored.tree.customstorage.blockWrites
+  True
+  >>> kept = otherRoot['unstored']
+  >>> otherManager.abort()
+  >>> otherRoot._p_jar.close()
+  >>> del kept._v_tree
+  >>> del ownRoot['unstored']
+  >>> ownManager.commit()
+
+A degraded tree can be rebuilt while it's in use. The new tree is bulk loaded and copied to a shadow pageData in small
+transactions of its own connection, the documents which were changed meanwhile are updated in the last transaction.
+The index must not have uncommitted changes.
+
+  >>> site['rebuilt'] = rebuilt = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> transaction.commit()
+  >>> for i in range(200):
+  ...     rebuilt.index_doc( i, House('House', (i, i, i + 1, i + 1)) )
+  >>> rebuilt.unindex_docs( range(0, 200, 3) )
+  >>> rebuilt.rebuild()
+  Traceback (most recent call last):
+  ...
+  ValueError: The index has uncommitted changes
+  >>> transaction.commit()
+
+A writer which started before the rebuild didn't log its changes, it can't commit after the rebuild started.
+
+  >>> staleManager = transaction.TransactionManager()
+  >>> staleConnection = db.open( transaction_manager = staleManager )
+  >>> staleConnection.root()['site']['rebuilt'].index_doc( 2000, House('Barn', (60, 60)) )
+  >>> progress = []
+  >>> def changeWhileRebuilding(copiedPages, pageCount):
+  ...     progress.append( (copiedPages, pageCount) )
+  ...     if len(progress) == 1:
+  ...         _ = transaction.begin()
+  ...         rebuilt.index_doc( 1000, House('Shed', (50, 50)) )
+  ...         rebuilt.unindex_doc( 1 )
+  ...         transaction.commit()
+  >>> rebuilt.rebuild( pagesPerTransaction = 2, progress = changeWhileRebuilding )
+  True
+  >>> len(progress) > 1, progress[-1][0] == progress[-1][1]
+  (True, True)
+  >>> staleManager.commit()
+  Traceback (most recent call last):
+  ...
+  ConflictError: ...
+  >>> staleManager.abort()
+  >>> staleConnection.close()
+  >>> transaction.begin()
+  <...>
+  >>> rebuilt.rebuildProgress() is None, rebuilt.documentCount(), rebuilt.count( (0, 0, 2000, 2000) )
+  (True, 133, 133L)
+  >>> sorted( rebuilt.intersection( (0, 0, 2000, 2000) ) ) == sorted( rebuilt.idToCoordinates.keys() )
+  True
+  >>> rebuilt._treeDifferences()
+  []
+  >>> del site['rebuilt']
+  >>> transaction.commit()
+
+Point data can be stored in BTrees only. The points are kept in the order of a space filling curve, queries read the
+ranges of the curve which cross the query window.
+
+  >>> from zope.index.SpatialIndex.index import PointIndex
+  >>> points = [ (i * 10 + j, (i, j)) for i in range(10) for j in range(10) ]
+  >>> for curve in ('hilbert', 'zorder'):
+  ...     site[curve + 'Points'] = pointIndex = PointIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings, extent = (0, 0, 9, 9), curve = curve )
+  ...     pointIndex.index_docs( points )
+  ...     print sorted( pointIndex.intersection( (2.5, 2.5, 5, 4) ) ), pointIndex.count( (2.5, 2.5, 5, 4) ), pointIndex.count( (0, 0, 9, 9) ), list( pointIndex.nearest( (0.2, 0.1), 3 ) )
+  [33, 34, 43, 44, 53, 54] 6 100 [0, 10, 1]
+  [33, 34, 43, 44, 53, 54] 6 100 [0, 10, 1]
+  >>> pointIndex.index_doc( 33, House('Shed', (20, 20, 20, 20)) )
+  >>> pointIndex.unindex_doc( 34 )
+  >>> list( pointIndex.apply( 'intersection', (2.5, 2.5, 5, 4) ) ), list( pointIndex.intersection( (19, 19, 21, 21) ) )
+  ([43, 44, 53, 54], [33])
+  >>> pointIndex.documentCount(), pointIndex.bounds
+  (99, [0.0, 0.0, 20.0, 20.0])
+  >>> pointIndex.index_doc( 1000, House('Barn', (1, 1, 2, 2)) )
+  Traceback (most recent call last):
+  ...
+  ValueError: Only points can be indexed, got (1, 1, 2, 2)
+  >>> del site['hilbertPoints'], site['zorderPoints']
+  >>> transaction.commit()
+
+Trees of committed indexes are kept in a process wide pool when the index is deactivated, so the next activation
+doesn't have to create the tree again. The pool drops trees when another connection commits changes.
+
+  >>> from zope.index.SpatialIndex.cache import treePool
+  >>> site['pooled'] = pooled = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = settings )
+  >>> pooled.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(50) ] )
+  >>> transaction.commit()
+  >>> pooled.count( (0, 0, 100, 100) )
+  50L
+  >>> tree = pooled.tree
+  >>> pooled._p_deactivate()
+  >>> pooled.count( (0, 0, 100, 100) ), pooled.tree is tree
+  (50L, True)
+  >>> otherManager = transaction.TransactionManager()
+  >>> otherConnection = db.open( transaction_manager = otherManager )
+  >>> otherConnection.root()['site']['pooled'].index_doc( 100, House('Shed', (5, 5, 6, 6)) )
+  >>> otherManager.commit()
+  >>> otherConnection.close()
+  >>> transaction.begin()
+  <...>
+  >>> pooled.count( (0, 0, 100, 100) ), pooled.tree is tree
+  (51L, False)
+  >>> treePool.statistics()['hits'] > 0
+  True
+  >>> del site['pooled'], tree
+  >>> transaction.commit()
+
+Indexes which don't need to be durable in the database can keep their pages in memory, in a local file or in a local
+SQLite table. Only the location of the store is stored with the index.
+
+  >>> import tempfile, shutil, os.path
+  >>> from zope.index.SpatialIndex.pagestore import FilePageStore
+  >>> directory = tempfile.mkdtemp()
+  >>> for pageStore in ('memory', 'file', 'sqlite'):
+  ...     storeSettings = dict( settings, page_store = pageStore, page_store_path = os.path.join( directory, pageStore ) )
+  ...     site['stored'] = stored = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = storeSettings )
+  ...     stored.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  ...     transaction.commit()
+  ...     stored.unindex_docs( range(0, 100, 2) )
+  ...     transaction.commit()
+  ...     stored._p_invalidate()
+  ...     print pageStore, len(stored.pageData) > 1, stored.count( (0, 0, 200, 200) ), sorted( stored.intersection( (10, 10, 14, 14) ) )
+  ...     del site['stored']
+  ...     transaction.commit()
+  memory True 50 [9, 11, 13]
+  file True 50 [9, 11, 13]
+  sqlite True 50 [9, 11, 13]
+  >>> fileStore = FilePageStore( os.path.join( directory, 'file' ) )
+  >>> pages = fileStore.items()
+  >>> fileStore.compact()
+  >>> fileStore.items() == pages
+  True
+  >>> SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = dict( settings, page_store = 'file' ) )
+  Traceback (most recent call last):
+  ...
+  ValueError: The file page store needs a page_store_path
+
+The stores don't take part in the database's two phase commit. The pages changed in a transaction are written to the
+store when the transaction committed, an abort drops them, also when another data manager fails to vote.
+
+  >>> path = os.path.join( directory, 'changes' )
+  >>> site['changed'] = changed = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = dict( settings, page_store = 'file', page_store_path = path ) )
+  >>> transaction.commit()
+  >>> written = FilePageStore( path ).items()
+  >>> changed.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> changed.count( (0, 0, 200, 200) ), FilePageStore( path ).items() == written
+  (100L, True)
+  >>> transaction.abort()
+  >>> changed.count( (0, 0, 200, 200) ), FilePageStore( path ).items() == written
+  (0L, True)
+  >>> from ZODB.POSException import ConflictError
+  >>> class FailingVote(object):
+  ...     def tpc_vote(self, transaction):
+  ...         raise ConflictError()
+  ...     abort = tpc_begin = commit = tpc_abort = lambda self, transaction: None
+  ...     def sortKey(self):
+  ...         return 'failing vote'
+  >>> changed.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> transaction.get().join( FailingVote() )
+  >>> transaction.commit()
+  Traceback (most recent call last):
+  ...
+  ConflictError: ...
+  >>> transaction.abort()
+  >>> changed.count( (0, 0, 200, 200) ), FilePageStore( path ).items() == written
+  (0L, True)
+  >>> changed.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> transaction.commit()
+  >>> changed._p_invalidate()
+  >>> changed.count( (0, 0, 200, 200) ), FilePageStore( path ).items() == written
+  (100L, False)
+
+Concurrent writers of a store conflict, even in a database which resolves the conflicts of the other objects of the
+index: the pages they changed can't be merged.
+
+  >>> storeDb = ZODB.DB( ZODB.DemoStorage.DemoStorage() )
+  >>> firstManager, secondManager = transaction.TransactionManager(), transaction.TransactionManager()
+  >>> firstRoot = storeDb.open( transaction_manager = firstManager ).root()
+  >>> firstRoot['concurrent'] = SpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = dict( settings, page_store = 'memory' ) )
+  >>> firstManager.commit()
+  >>> secondRoot = storeDb.open( transaction_manager = secondManager ).root()
+  >>> firstRoot['concurrent'].index_doc( 1, House('First', (1, 1, 2, 2)) )
+  >>> secondRoot['concurrent'].index_doc( 2, House('Second', (5, 5, 6, 6)) )
+  >>> firstManager.commit()
+  >>> secondManager.commit()
+  Traceback (most recent call last):
+  ...
+  ConflictError: ...
+  >>> secondManager.abort()
+  >>> secondRoot['concurrent'].count( (0, 0, 10, 10) ), secondRoot['concurrent'].documentCount()
+  (1L, 1)
+  >>> storeDb.close()
+
+A store which lost its pages, e.g. a memory store after a restart, can't be used. The index can be rebuilt from its
+documents.
+
+  >>> os.remove( path )
+  >>> from zope.index.SpatialIndex import pagestore
+  >>> changed._p_invalidate()
+  >>> pagestore._openPages.clear(); treePool.clear(); pageCache.clear()
+  >>> changed.count( (0, 0, 200, 200) )
+  Traceback (most recent call last):
+  ...
+  ValueError: The page store at ... has no pages but the index has documents, rebuild() the index
+  >>> changed.rebuild()
+  True
+  >>> transaction.begin()
+  <...>
+  >>> changed.count( (0, 0, 200, 200) )
+  100L
+  >>> del site['changed']
+  >>> transaction.commit()
+
+The shards of a sharded index keep their pages apart, each shard's store is at page_store_path.<shard number>.
+
+  >>> storeSettings = dict( settings, page_store = 'file', page_store_path = os.path.join( directory, 'sharded' ) )
+  >>> site['shardedStore'] = shardedStore = ShardedSpatialIndex( field_name = 'boundingBox', interface = IBounded, field_callable=False, settings = storeSettings, extent = (0, 0, 100, 100), shards = 4 )
+  >>> shardedStore.index_docs( [ (i, (i, i, i + 1, i + 1)) for i in range(100) ] )
+  >>> transaction.commit()
+  >>> [ os.path.basename( shard.pageData.location ) for shard in shardedStore.shards ]
+  ['sharded.0', 'sharded.1', 'sharded.2', 'sharded.3']
+  >>> for shard in shardedStore.shards:
+  ...     shard._p_invalidate()
+  >>> shardedStore.count( (0, 0, 200, 200) ), sorted( shardedStore.intersection( (10, 10, 14, 14) ) )
+  (100, [9, 10, 11, 12, 13, 14])
+  >>> del site['shardedStore']
+  >>> transaction.commit()
+  >>> shutil.rmtree( directory )
+
+Insert 1000 random objects. For timings see the benchmarks module.
 
   >>> transaction.begin()
   <...>
-  >>> # benchmark inserting 1000 random objects
   >>> #  note: This is not the smart way. If you want to insert many objects
-  >>> #        at once, use the initialValuesGenerator.
+  >>> #        at once, use index_docs() or the initialValuesGenerator.
   >>> #        It's nice for testing though since it will cause lots of writes.
   >>> import random
   >>> def generate(count, minX, minY, maxX, maxY):
@@ -215,16 +1033,14 @@ Run a little benchmark.
   ...         x2, y2 = x1 + random.random() * maxX, y1 + random.random() * maxY
   ...         yield House( 'Random house #%d' % i, (x1, y1, x2, y2) )
   >>>              
-  >>> import time
-  >>> start = time.clock()
   >>> noObjects = 1000
   >>> for i, house in enumerate(generate(noObjects, 1000, 1000, 1000, 1000)):
   ...     index.index_doc( i, house )
-  >>> print 'Time to index 1000 houses', time.clock() - start
-  Time to...
   >>> transaction.commit()
-  >>> print 'Total time', time.clock() - start
-  Total time...
+  >>> index.documentCount()
+  1000
+  >>> index.count( (0,0,3000,3000) )
+  1000L
 
 Todo: test the index inside of a catalog. Too lazy now.
 
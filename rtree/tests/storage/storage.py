@@ -20,12 +20,10 @@ Exercise rtree's CustomStorage a bit.
   >>> 
   >>> storage = DictStorage()
   >>> r = Rtree( storage, properties = settings )
-  >>> import time
-  >>> start = time.clock()
   >>> for args in generate(10000, 100, 100, 100, 100):
   ...     r.insert( *args )
-  >>> print 'Inserting 10000 items took ', time.clock() - start
-  Inserting...
+  >>> r.count( (0, 0, 300, 300) )
+  10000L
   >>> 
   >>> print '10 nearest points to (0,0) ', list(r.nearest((0, 0), 10))[0:10]
   10...
@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import re
 import unittest
 import pkg_resources
+from zope.testing import renormalizing
 from zope.index.SpatialIndex import  tests
 #from zope.testing import doctest
 import doctest
 
+# ctypes returns int64 ids and counts as long or int depending on the platform
+checker = renormalizing.RENormalizing([
+    (re.compile(r'\b(\d+)L\b'), r'\1'),
+    ])
+
 
 def make_test(dottedname):
     test = doctest.DocTestSuite(
         dottedname, setUp=tests.siteSetUp, tearDown=tests.siteTearDown,
-        optionflags=doctest.ELLIPSIS + doctest.NORMALIZE_WHITESPACE)
+        optionflags=doctest.ELLIPSIS + doctest.NORMALIZE_WHITESPACE,
+        checker=checker)
     test.layer = tests.SpatialIndexCoreIndexSpatialLayer(tests)
     return test
 
@@ -35,7 +43,8 @@ def test_suite():
     suite = unittest.TestSuite()
     readme = doctest.DocFileSuite(
         '../README.txt', globs={'__name__': 'zope.index.SpatialIndex'},
-        optionflags=(doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS))
+        optionflags=(doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        checker=checker)
     readme.layer = tests.SpatialIndexCoreIndexSpatialLayer(tests)
     suite.addTest(readme)
     for name in ['storage', 'index']: